@@ -0,0 +1,85 @@
+"""
+Times writing a large book by chapter with 1 and more chapter workers,
+against a fake Notion API answering appends after `latency` seconds and
+rate limited like a real session.
+
+    python benchmarks/chapter_uploads.py [chapters] [latency] [workers...]
+"""
+
+import json
+import sys
+import time
+import uuid
+from datetime import datetime
+
+import httpx
+import notional
+from notional.blocks import Page
+
+from kindle2notion.exporting import _chapter_batches, _write_chapters
+from kindle2notion.models import Book, BookHeading, Highlight
+from kindle2notion.throttling import (
+    NOTION_BURST,
+    NOTION_REQUESTS_PER_SECOND,
+    RateLimiter,
+)
+
+HIGHLIGHTS_PER_CHAPTER = 200
+
+
+def fake_session(latency: float) -> notional.session.Session:
+    def handle(request):
+        time.sleep(latency)
+        children = json.loads(request.content)["children"]
+        results = [{**child, "id": str(uuid.uuid4())} for child in children]
+        return httpx.Response(200, json={"object": "list", "results": results})
+
+    limiter = RateLimiter(NOTION_REQUESTS_PER_SECOND, NOTION_BURST)
+    client = httpx.Client(
+        transport=httpx.MockTransport(handle),
+        event_hooks={"request": [lambda request: limiter.acquire()]},
+    )
+    return notional.connect(auth="token", client=client)
+
+
+def main() -> None:
+    chapter_count = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 1.5
+    worker_counts = [int(arg) for arg in sys.argv[3:]] or [1, 2, 4]
+    highlight_count = chapter_count * HIGHLIGHTS_PER_CHAPTER
+    book = Book(
+        title="A Long Book",
+        author="Some Author",
+        highlights=[
+            Highlight(
+                text=f"Highlight {i}",
+                page=None,
+                location=(i, i + 1),
+                date=datetime(2021, 4, 30),
+                is_note=False,
+            )
+            for i in range(highlight_count)
+        ],
+    )
+    headings = [
+        BookHeading(title=f"Chapter {i}", href=f"#c{i}") for i in range(chapter_count)
+    ]
+    heading_info = (
+        headings,
+        [i // HIGHLIGHTS_PER_CHAPTER for i in range(highlight_count)],
+    )
+    page = Page.parse_obj({"object": "page", "id": uuid.uuid4().hex})
+
+    for workers in worker_counts:
+        intro, chapters = _chapter_batches(book, heading_info, True, True, True)
+        started = time.monotonic()
+        _write_chapters(
+            fake_session(latency), page, "toggles", intro, chapters, workers
+        )
+        print(
+            f"{workers} chapter workers: {time.monotonic() - started:5.1f}s for {chapter_count} chapters of {HIGHLIGHTS_PER_CHAPTER} highlights"
+        )
+
+
+if __name__ == "__main__":
+    main()
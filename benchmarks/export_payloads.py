@@ -0,0 +1,77 @@
+"""
+Times building and encoding the append requests of a large book's page,
+with notional models and with payloads rendered straight to JSON.
+
+    python benchmarks/export_payloads.py [highlights] [repeat]
+"""
+
+import sys
+import timeit
+from datetime import datetime
+
+import httpx
+
+from kindle2notion.exporting import _page_batches
+from kindle2notion.models import Book, BookHeading, Highlight
+from kindle2notion.rendering import splice
+
+
+def make_book(highlight_count: int) -> Book:
+    return Book(
+        title="A Long Book",
+        author="Some Author",
+        highlights=[
+            Highlight(
+                text=f"Highlight {i}: " + "a fairly typical sentence, " * 8,
+                page=i // 3,
+                location=(i * 10, i * 10 + 4),
+                date=datetime(2021, 4, 30, 12, 31, 29),
+                is_note=i % 10 == 0,
+            )
+            for i in range(highlight_count)
+        ],
+    )
+
+
+def model_requests(book, heading_info) -> list[bytes]:
+    batches = _page_batches(book, heading_info, True, True, True, raw_payloads=False)
+    return [
+        httpx.Request(
+            "PATCH", "http://localhost", json={"children": [b.dict() for b in batch]}
+        ).content
+        for batch in batches
+    ]
+
+
+def raw_requests(book, heading_info) -> list[bytes]:
+    batches = _page_batches(book, heading_info, True, True, True, raw_payloads=True)
+    return [
+        splice({}, "children", [b.json for b in batch]).encode("utf-8")
+        for batch in batches
+    ]
+
+
+def main() -> None:
+    highlight_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    book = make_book(highlight_count)
+    headings = [BookHeading(title=f"Chapter {i}", href=f"#c{i}") for i in range(50)]
+    heading_info = (
+        headings,
+        [i * 50 // highlight_count for i in range(highlight_count)],
+    )
+
+    assert model_requests(book, heading_info) == raw_requests(book, heading_info)
+    for name, build in [("models", model_requests), ("raw payloads", raw_requests)]:
+        best = min(
+            timeit.repeat(
+                lambda build=build: build(book, heading_info),
+                number=1,
+                repeat=repeat,
+            )
+        )
+        print(f"{name:>12}: {best * 1000:8.1f} ms for {highlight_count} highlights")
+
+
+if __name__ == "__main__":
+    main()
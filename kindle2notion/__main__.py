@@ -1,95 +1,486 @@
 import os
+from functools import partial
 from typing import Optional
 
 import click
-import notional
 
-from kindle2notion.exporting import export_to_notion
-from kindle2notion.parsing import parse_raw_clippings_text
-from kindle2notion.reading import read_raw_clippings
-from kindle2notion.package_logger import logger
+# Only click is imported eagerly. Every command imports the stages it needs
+# when it runs, so that `--help` or a missing environment variable doesn't pay
+# for notional, dateparser, mobi and friends.
 
 
-@click.command()
-@click.argument("clippings_file")
+class DefaultCommandGroup(click.Group):
+    """
+    A group that falls back to `default_command` when the first argument is
+    not a subcommand, so `kindle2notion CLIPPINGS_FILE` keeps working.
+    """
+
+    def __init__(self, *args, default_command: str, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.default_command = default_command
+
+    def parse_args(self, ctx, args):
+        if (
+            args
+            and args[0] not in self.commands
+            and args[0] not in ctx.help_option_names
+        ):
+            args.insert(0, self.default_command)
+        return super().parse_args(ctx, args)
+
+
+SYNC_OPTIONS = [
+    click.option(
+        "--target",
+        type=click.Choice(["notion", "markdown", "jsonl"]),
+        default="notion",
+        help='Where to export the clippings. "markdown" writes a file per book and "jsonl" a file with a line per highlight into --output_dir, without needing a Notion token.',
+    ),
+    click.option(
+        "--output_dir",
+        type=str,
+        default="kindle2notion-export",
+        help="Directory the markdown and jsonl targets write to.",
+    ),
+    click.option(
+        "--enable_location",
+        default=True,
+        help='Set to False if you don\'t want to see the "Location" and "Page" information in Notion.',
+    ),
+    click.option(
+        "--enable_highlight_date",
+        default=True,
+        help='Set to False if you don\'t want to see the "Date Added" information in Notion.',
+    ),
+    click.option(
+        "--enable_book_cover",
+        default=True,
+        help="Set to False if you don't want to store the book cover in Notion.",
+    ),
+    click.option(
+        "--separate_blocks",
+        default=False,
+        help="Set to True to separate each clipping into a separate quote block. Enabling this option significantly decreases upload speed.",
+    ),
+    click.option(
+        "--page_layout",
+        type=click.Choice(["flat", "toggles", "child_pages"]),
+        default="flat",
+        help='How highlights are laid out on a book\'s Notion page. "toggles" and "child_pages" put every chapter under its own toggle or child page, which are written in parallel. Needs the headings found with --kindle_root.',
+    ),
+    click.option(
+        "--chapter_workers",
+        type=int,
+        default=4,
+        help="Number of chapters of a book written to Notion at the same time with the toggles and child_pages layouts.",
+    ),
+    click.option(
+        "--kindle_root",
+        type=str,
+        help="Path to kindle root when connected. This will help in fetching headings from the respective book when adding to notion",
+        default=None,
+    ),
+    click.option(
+        "--cache_dir",
+        type=str,
+        envvar="KINDLE2NOTION_CACHE_DIR",
+        help="Directory to persist indexes and caches across runs. Caching is disabled when not set.",
+        default=None,
+    ),
+    click.option(
+        "--heading_workers",
+        type=int,
+        default=2,
+        help="Number of worker processes that extract headings from upcoming books while earlier ones are uploaded. Set to 0 to extract them inline.",
+    ),
+    click.option(
+        "--heading_worker_memory_mb",
+        type=int,
+        default=None,
+        help="Address space limit for every heading worker process, in megabytes.",
+    ),
+    click.option(
+        "--heading_mode",
+        type=click.Choice(["text", "location"]),
+        default="text",
+        help='How highlights are placed under headings. "location" estimates positions from Kindle locations and only searches the text near chapter boundaries, which is much faster for large books.',
+    ),
+    click.option(
+        "--group_titles",
+        default=False,
+        help="Set to True to merge editions, sideloaded file names and subtitle variants of a book into one book.",
+    ),
+    click.option(
+        "--title_overrides",
+        type=str,
+        envvar="KINDLE2NOTION_TITLE_OVERRIDES",
+        default=None,
+        help="JSON file mapping titles to the title they should be grouped under. Map a title to itself to keep it apart.",
+    ),
+]
+
+
+def sync_options(f):
+    for option in reversed(SYNC_OPTIONS):
+        f = option(f)
+    return f
+
+
+def _get_notion_credentials() -> Optional[tuple[str, str]]:
+    from kindle2notion.package_logger import logger
+
+    notion_api_auth_token = os.environ.get("NOTION_AUTH_TOKEN", None)
+    notion_database_id = os.environ.get("NOTION_DBREF", None)
+    if notion_api_auth_token is None:
+        logger.error("please export the env var: NOTION_AUTH_TOKEN")
+        return None
+    if notion_database_id is None:
+        logger.error("please export the following env var: NOTION_DBREF")
+        return None
+
+    import notional
+
+    notion = notional.connect(auth=notion_api_auth_token)
+    db = notion.databases.retrieve(notion_database_id)
+    if not db:
+        logger.error(
+            "Notion page not found! Please check whether the Notion database ID is assigned properly."
+        )
+        return None
+    logger.info("Notion page is found. Analyzing clippings file...")
+    return notion_api_auth_token, notion_database_id
+
+
+@click.group(cls=DefaultCommandGroup, default_command="sync")
+def main():
+    """
+    Export your Kindle clippings to a Notion database, or to local files.
+    """
+
+
+HEADING_OPTIONS = (
+    "kindle_root",
+    "cache_dir",
+    "heading_workers",
+    "heading_worker_memory_mb",
+    "heading_mode",
+)
+
+# Options changing what is written for a book, a sync with other values
+# starts over from the first clipping
+RENDERING_OPTIONS = (
+    "enable_location",
+    "enable_highlight_date",
+    "enable_book_cover",
+    "separate_blocks",
+    "page_layout",
+    "kindle_root",
+    "heading_mode",
+)
+
+
+def _exporter_factory(target: str, output_dir: str, options: dict):
+    """
+    Returns a function creating a fresh exporter to `target` for every sync,
+    or None if the target is not usable.
+    """
+    if target == "notion":
+        credentials = _get_notion_credentials()
+        if credentials is None:
+            return None
+        notion_api_auth_token, notion_database_id = credentials
+
+        from kindle2notion.exporting import make_notion_exporter
+
+        return partial(
+            make_notion_exporter,
+            notion_api_auth_token,
+            notion_database_id,
+            enable_location=options["enable_location"],
+            enable_highlight_date=options["enable_highlight_date"],
+            enable_book_cover=options["enable_book_cover"],
+            separate_blocks=options["separate_blocks"],
+            cache_dir=options["cache_dir"],
+            heading_mode=options["heading_mode"],
+            page_layout=options["page_layout"],
+            chapter_workers=options["chapter_workers"],
+            kindle_root=options["kindle_root"],
+        )
+
+    from kindle2notion.exporters import make_local_exporter
+
+    return partial(
+        make_local_exporter,
+        target,
+        output_dir,
+        enable_location=options["enable_location"],
+        enable_highlight_date=options["enable_highlight_date"],
+    )
+
+
+def _clippings_state(
+    target: str,
+    output_dir: str,
+    group_titles: bool,
+    title_overrides: Optional[str],
+    options: dict,
+):
+    """
+    Returns the checkpoints of the clippings files synced to the target with
+    these options.
+    """
+    from kindle2notion.merging import ClippingsState
+
+    if target == "notion":
+        destination = os.environ["NOTION_DBREF"]
+    else:
+        destination = os.path.abspath(output_dir)
+    key = {
+        "target": target,
+        "destination": destination,
+        "group_titles": group_titles,
+        "title_overrides": title_overrides,
+        **{name: options[name] for name in RENDERING_OPTIONS},
+    }
+    return ClippingsState.for_sync(key, options["cache_dir"])
+
+
+@main.command()
+@click.argument("clippings_files", nargs=-1, required=True)
+@sync_options
+@click.option(
+    "--incremental",
+    default=False,
+    help="Set to True to only read the books with clippings added since the last sync of each file instead of every clipping.",
+)
+@click.option(
+    "--since",
+    type=str,
+    default=None,
+    help='Only sync books with clippings added since this date, e.g. "2024-05-01" or "3 days ago".',
+)
 @click.option(
-    "--enable_location",
-    default=True,
-    help='Set to False if you don\'t want to see the "Location" and "Page" information in Notion.',
+    "--book",
+    type=str,
+    default=None,
+    help='Only sync books whose title matches this pattern, e.g. "dune" or "*Vol. [12]".',
 )
 @click.option(
-    "--enable_highlight_date",
-    default=True,
-    help='Set to False if you don\'t want to see the "Date Added" information in Notion.',
+    "--author",
+    type=str,
+    default=None,
+    help="Only sync books whose author matches this pattern.",
 )
 @click.option(
-    "--enable_book_cover",
-    default=True,
-    help="Set to False if you don't want to store the book cover in Notion.",
+    "--shard_count",
+    type=int,
+    default=1,
+    help="Split the books into this many shards synced by separate workers, possibly on separate hosts.",
 )
 @click.option(
-    "--separate_blocks",
-    default=False,
-    help="Set to True to separate each clipping into a separate quote block. Enabling this option significantly decreases upload speed.",
+    "--shard_index",
+    type=int,
+    default=0,
+    help="The shard this worker syncs, from 0 to --shard_count - 1.",
 )
 @click.option(
-    "--kindle_root",
+    "--shard_dir",
     type=str,
-    help="Path to kindle root when connected. This will help in fetching headings from the respective book when adding to notion",
     default=None,
+    help="Directory on storage shared by all workers, holding book leases and shard summaries. Required with --shard_count.",
 )
-def main(
-    clippings_file,
-    enable_location,
-    enable_highlight_date,
-    enable_book_cover,
-    separate_blocks,
-    kindle_root: Optional[str],
+@click.option(
+    "--shard_run",
+    type=str,
+    default=None,
+    help="An id shared by the workers of one run, e.g. the id of the CI pipeline, so summaries of other runs are never merged. Defaults to a digest of the clippings files.",
+)
+def sync(
+    clippings_files,
+    target,
+    output_dir,
+    group_titles,
+    title_overrides,
+    incremental,
+    since,
+    book,
+    author,
+    shard_count,
+    shard_index,
+    shard_dir,
+    shard_run,
+    **options,
 ):
-    notion_api_auth_token = os.environ.get("NOTION_AUTH_TOKEN", None)
-    notion_database_id = os.environ.get("NOTION_DBREF", None)
-    if notion_api_auth_token is None:
-        logger.error("please export the env var: NOTION_AUTH_TOKEN")
+    """
+    Sync CLIPPINGS_FILES once. Clippings collected from several Kindles are
+    merged, without duplicates. This is the default command.
+    """
+    if shard_count > 1 and shard_dir is None:
+        raise click.UsageError("--shard_dir is required with --shard_count")
+    from kindle2notion.filtering import make_book_filter
+    from kindle2notion.grouping import make_title_grouper
+
+    try:
+        book_filter = make_book_filter(since, book, author)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--since")
+    grouper = make_title_grouper(group_titles, title_overrides)
+    make_exporter = _exporter_factory(target, output_dir, options)
+    if make_exporter is None:
         return
-    if notion_database_id is None:
-        logger.error("please export the following env var: NOTION_DBREF")
+
+    from kindle2notion.package_logger import logger
+
+    if shard_count > 1:
+        from kindle2notion.sharding import (
+            ShardCoordinator,
+            default_run_id,
+            sync_shard,
+        )
+
+        coordinator = ShardCoordinator(
+            shard_dir,
+            shard_index,
+            shard_count,
+            run_id=shard_run or default_run_id(list(clippings_files)),
+        )
+        summary = sync_shard(
+            list(clippings_files),
+            make_exporter(),
+            coordinator,
+            grouper=grouper,
+            book_filter=book_filter,
+            **{name: options[name] for name in HEADING_OPTIONS},
+        )
+        if not summary.ok:
+            raise SystemExit(1)
         return
-    notion = notional.connect(auth=notion_api_auth_token)
-    db = notion.databases.retrieve(notion_database_id)
 
-    if db:
-        logger.info("Notion page is found. Analyzing clippings file...")
-        # Open the clippings text file and load it into all_clippings
-        all_clippings = read_raw_clippings(clippings_file)
-
-        # Parse all_clippings file and format the content to be sent tp the Notion DB into all_books
-        all_books = parse_raw_clippings_text(all_clippings)
-        # Export all the contents in all_books into the Notion DB.
-
-        # ######### FIXME TESTING
-        # my_book = "Thinking in Bets"
-        # all_books = {my_book: all_books[my_book]}
-        # ###################
-        export_to_notion(
-            all_books,
-            enable_location,
-            enable_highlight_date,
-            enable_book_cover,
-            separate_blocks,
-            notion_api_auth_token,
-            notion_database_id,
-            kindle_root=kindle_root,
+    from kindle2notion.pipeline import sync_clippings_file
+
+    exporter = make_exporter()
+    clippings_state = None
+    if incremental and exporter.incremental:
+        clippings_state = _clippings_state(
+            target, output_dir, group_titles, title_overrides, options
         )
+    # Read, parse and export the clippings, books are written as soon as
+    # all of their clippings have been parsed
+    sync_clippings_file(
+        list(clippings_files),
+        exporter,
+        grouper=grouper,
+        book_filter=book_filter,
+        clippings_state=clippings_state,
+        **{name: options[name] for name in HEADING_OPTIONS},
+    )
 
-        # with open("my_kindle_clippings.json", "w") as out_file:
-        #     json.dump(all_books, out_file, indent=4)
+    logger.info("Transfer complete... Exiting script...")
 
-        logger.info("Transfer complete... Exiting script...")
-    else:
-        logger.error(
-            "Notion page not found! Please check whether the Notion database ID is assigned properly."
+
+@main.command()
+@click.argument("clippings_file")
+@sync_options
+@click.option(
+    "--debounce",
+    type=float,
+    default=5.0,
+    help="Seconds without further changes to wait for before syncing.",
+)
+def watch(
+    clippings_file,
+    debounce,
+    target,
+    output_dir,
+    group_titles,
+    title_overrides,
+    **options,
+):
+    """
+    Keep running and sync CLIPPINGS_FILE whenever it changes or the Kindle holding it is mounted.
+    """
+    from kindle2notion.grouping import make_title_grouper
+
+    grouper = make_title_grouper(group_titles, title_overrides)
+    make_exporter = _exporter_factory(target, output_dir, options)
+    if make_exporter is None:
+        return
+
+    from kindle2notion.exporters import export_books
+    from kindle2notion.watching import watch_clippings
+
+    # One exporter for every pass, e.g. the Notion page index is read once
+    exporter = make_exporter()
+
+    def sync_books(books) -> None:
+        export_books(
+            exporter,
+            books,
+            close=False,
+            **{name: options[name] for name in HEADING_OPTIONS},
         )
 
+    with exporter:
+        watch_clippings(clippings_file, sync_books, debounce=debounce, grouper=grouper)
+
+
+@main.command()
+@click.argument("clippings_file")
+@sync_options
+def compact(
+    clippings_file, target, output_dir, group_titles, title_overrides, **options
+):
+    """
+    Move the clippings of CLIPPINGS_FILE already synced to the target into a compressed archive, and shrink the file down to the clippings not synced yet. Takes the options of the sync.
+    """
+    if target == "notion" and "NOTION_DBREF" not in os.environ:
+        raise click.UsageError("please export the following env var: NOTION_DBREF")
+    from kindle2notion.compacting import compact_clippings
+
+    clippings_state = _clippings_state(
+        target, output_dir, group_titles, title_overrides, options
+    )
+    compact_clippings(clippings_file, clippings_state)
+
+
+@main.command()
+@click.argument("manifest_file")
+@click.option(
+    "--workers",
+    type=int,
+    default=4,
+    help="Number of jobs synced at the same time.",
+)
+@click.option(
+    "--cache_dir",
+    type=str,
+    envvar="KINDLE2NOTION_CACHE_DIR",
+    help="Directory to persist indexes and caches across runs, shared by all jobs. Caching is disabled when not set.",
+    default=None,
+)
+@click.option(
+    "--heading_workers",
+    type=int,
+    default=2,
+    help="Number of worker processes extracting headings, shared by all jobs.",
+)
+@click.option(
+    "--heading_worker_memory_mb",
+    type=int,
+    default=None,
+    help="Address space limit for every heading worker process, in megabytes.",
+)
+def batch(manifest_file, **options):
+    """
+    Sync every job of the JSON MANIFEST_FILE in one process.
+    """
+    from kindle2notion.batching import load_manifest, log_summary, run_batch
+
+    results = run_batch(load_manifest(manifest_file), **options)
+    log_summary(results)
+    if not all(result.ok for result in results):
+        raise SystemExit(1)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,158 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal, Optional
+
+from pydantic import BaseModel, Field
+
+from kindle2notion.compacting import with_archives
+from kindle2notion.exporting import export_to_notion
+from kindle2notion.grouping import make_title_grouper
+from kindle2notion.locating import HeadingWorkerPool
+from kindle2notion.package_logger import logger
+from kindle2notion.merging import MergedClippings
+from kindle2notion.parsing import iter_books_in_clippings
+from kindle2notion.throttling import get_session
+
+
+class SyncOptions(BaseModel):
+    """
+    Per job counterparts of the sync command line options.
+    """
+
+    enable_location: bool = True
+    enable_highlight_date: bool = True
+    enable_book_cover: bool = True
+    separate_blocks: bool = False
+    kindle_root: Optional[str] = None
+    heading_mode: Literal["text", "location"] = "text"
+    page_layout: Literal["flat", "toggles", "child_pages"] = "flat"
+    chapter_workers: int = 4
+    group_titles: bool = False
+    title_overrides: Optional[str] = None
+
+
+GROUPING_OPTIONS = {"group_titles", "title_overrides"}
+
+
+class BatchJob(BaseModel):
+    """
+    One clippings file synced to one Notion database. The token and database
+    may reference environment variables, e.g. "$ALICE_NOTION_TOKEN", so that
+    manifests don't have to hold secrets.
+    """
+
+    name: Optional[str] = None
+    clippings_file: str
+    notion_auth_token: str
+    notion_database_id: str
+    options: SyncOptions = Field(default_factory=SyncOptions)
+
+    @property
+    def label(self) -> str:
+        return self.name or self.clippings_file
+
+
+class JobResult(BaseModel):
+    job: str
+    books_written: int = 0
+    seconds: float = 0.0
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def load_manifest(manifest_path: str) -> list[BatchJob]:
+    """
+    Reads a JSON manifest, either a list of jobs or an object with a "jobs"
+    list.
+    """
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = data.get("jobs", [])
+    jobs = []
+    for entry in data:
+        job = BatchJob(**entry)
+        job.notion_auth_token = os.path.expandvars(job.notion_auth_token)
+        job.notion_database_id = os.path.expandvars(job.notion_database_id)
+        jobs.append(job)
+    return jobs
+
+
+def _run_job(
+    job: BatchJob,
+    cache_dir: Optional[str],
+    heading_pool: Optional[HeadingWorkerPool],
+) -> JobResult:
+    started = time.monotonic()
+    result = JobResult(job=job.label)
+    try:
+        notion = get_session(job.notion_auth_token)
+        if not notion.databases.retrieve(job.notion_database_id):
+            raise ValueError(f"Notion database {job.notion_database_id} not found")
+        grouper = make_title_grouper(
+            job.options.group_titles, job.options.title_overrides
+        )
+        clippings = MergedClippings(with_archives([job.clippings_file]))
+        all_books = {
+            book.title: book for book in iter_books_in_clippings(clippings, grouper)
+        }
+        result.books_written = export_to_notion(
+            all_books,
+            notion_api_auth_token=job.notion_auth_token,
+            notion_database_id=job.notion_database_id,
+            cache_dir=cache_dir,
+            heading_workers=0,
+            heading_pool=heading_pool,
+            **job.options.dict(exclude=GROUPING_OPTIONS),
+        )
+    except Exception as e:
+        logger.error(f"Job {job.label} failed", exc_info=True)
+        result.error = f"{type(e).__name__}: {e}"
+    result.seconds = time.monotonic() - started
+    return result
+
+
+def run_batch(
+    jobs: list[BatchJob],
+    workers: int = 4,
+    cache_dir: Optional[str] = None,
+    heading_workers: int = 2,
+    heading_worker_memory_mb: Optional[int] = None,
+) -> list[JobResult]:
+    """
+    Runs every job in this process. Up to `workers` jobs upload at once and
+    share one pool of heading workers, one rate limited Notion session per
+    token, and the ebook, extraction and cover caches. Results are returned
+    in the order of `jobs`, a failing job does not stop the others.
+    """
+    heading_pool = None
+    if heading_workers > 0 and any(job.options.kindle_root for job in jobs):
+        heading_pool = HeadingWorkerPool(heading_workers, heading_worker_memory_mb)
+    try:
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            futures = [
+                executor.submit(_run_job, job, cache_dir, heading_pool) for job in jobs
+            ]
+            return [future.result() for future in futures]
+    finally:
+        if heading_pool is not None:
+            heading_pool.close()
+
+
+def log_summary(results: list[JobResult]) -> None:
+    for result in results:
+        if result.ok:
+            logger.info(
+                f"[green]✓[/green] {result.job}: {result.books_written} books written in {result.seconds:.1f}s"
+            )
+        else:
+            logger.error(
+                f"[red]×[/red] {result.job}: failed after {result.seconds:.1f}s ({result.error})"
+            )
+    failed = sum(not result.ok for result in results)
+    logger.info(f"{len(results) - failed} of {len(results)} jobs succeeded.")
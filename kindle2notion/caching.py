@@ -0,0 +1,265 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from typing import IO, Iterator, Optional
+
+from kindle2notion import models
+from kindle2notion.package_logger import logger
+
+DEFAULT_CACHE_MAX_MB = 1024
+# Only the text parts of an unpacked book are needed for heading extraction,
+# images and fonts are never copied into the cache.
+CACHED_EXTENSIONS = (".html", ".htm", ".xhtml", ".ncx", ".opf")
+MAIN_FILE_MARKER = ".main"
+# Bumped whenever the meaning of heading positions changes
+HEADINGS_FILE_SUFFIX = ".headings.v3.json"
+
+
+def file_digest(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@contextmanager
+def atomic_writer(path: str, buffering: int = -1) -> Iterator[IO[str]]:
+    """
+    Opens a temporary file next to `path` for writing, which replaces `path`
+    only once the block completes. Readers never see a partially written file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", buffering=buffering) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+@contextmanager
+def file_lock(path: str) -> Iterator[None]:
+    """
+    Holds an exclusive lock on the file `path`, created if needed, against
+    other processes of this host. Nothing is locked where flock(2) is not
+    available.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(path, "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _write_atomic(path: str, data: str) -> None:
+    with atomic_writer(path) as f:
+        f.write(data)
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            total += os.path.getsize(os.path.join(dir_path, file_name))
+    return total
+
+
+class ExtractionCache:
+    """
+    Content addressed cache of unpacked ebooks.
+
+    Each entry lives in `<cache_dir>/extracted/<sha256 of the ebook>` and holds
+    the extracted html and toc files. The hash of an ebook is remembered per
+    (path, size, mtime) so unchanged files are never read twice. Entries are
+    evicted least recently used first once the cache grows past `max_bytes`,
+    along with the hashes remembered for them.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: Optional[int] = None) -> None:
+        if max_bytes is None:
+            max_mb = int(
+                os.environ.get("KINDLE2NOTION_CACHE_MAX_MB", DEFAULT_CACHE_MAX_MB)
+            )
+            max_bytes = max_mb * 1024 * 1024
+        self.max_bytes = max_bytes
+        self.root = os.path.join(cache_dir, "extracted")
+        self.stat_dir = os.path.join(cache_dir, "digests")
+        self.headings_dir = os.path.join(cache_dir, "headings")
+        self.assignments_dir = os.path.join(cache_dir, "assignments")
+        os.makedirs(self.root, exist_ok=True)
+        os.makedirs(self.stat_dir, exist_ok=True)
+        os.makedirs(self.headings_dir, exist_ok=True)
+        os.makedirs(self.assignments_dir, exist_ok=True)
+
+    def digest(self, path: str) -> str:
+        stat = os.stat(path)
+        stat_key = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        stat_path = os.path.join(
+            self.stat_dir, hashlib.sha1(stat_key.encode()).hexdigest()
+        )
+        try:
+            with open(stat_path, "r", encoding="utf-8") as f:
+                return f.read().strip()
+        except OSError:
+            pass
+        digest = file_digest(path)
+        _write_atomic(stat_path, digest)
+        return digest
+
+    def _entry_dir(self, digest: str) -> str:
+        return os.path.join(self.root, digest)
+
+    def get(self, path: str) -> Optional[tuple[str, str]]:
+        """
+        Returns (entry directory, main html file) if `path` has been extracted before.
+        """
+        entry_dir = self._entry_dir(self.digest(path))
+        try:
+            with open(os.path.join(entry_dir, MAIN_FILE_MARKER), encoding="utf-8") as f:
+                main_file = os.path.join(entry_dir, f.read().strip())
+        except OSError:
+            return None
+        # The directory mtime doubles as the last used time for eviction
+        os.utime(entry_dir)
+        logger.info("Using cached extraction of the book")
+        return entry_dir, main_file
+
+    def put(self, path: str, html_dir: str, html_file_path: str) -> tuple[str, str]:
+        """
+        Copies the text files of an extraction into the cache and returns the
+        cached (entry directory, main html file).
+        """
+        entry_dir = self._entry_dir(self.digest(path))
+        main_rel_path = os.path.relpath(html_file_path, html_dir)
+        staging_dir = tempfile.mkdtemp(dir=self.root, prefix=".tmp-")
+        for dir_path, _, file_names in os.walk(html_dir):
+            for file_name in file_names:
+                src = os.path.join(dir_path, file_name)
+                rel_path = os.path.relpath(src, html_dir)
+                if rel_path != main_rel_path and not file_name.lower().endswith(
+                    CACHED_EXTENSIONS
+                ):
+                    continue
+                dst = os.path.join(staging_dir, rel_path)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                shutil.copyfile(src, dst)
+        with open(
+            os.path.join(staging_dir, MAIN_FILE_MARKER), "w", encoding="utf-8"
+        ) as f:
+            f.write(main_rel_path)
+
+        try:
+            os.rename(staging_dir, entry_dir)
+        except OSError:
+            # Another process cached the same book in the meantime
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        self.evict(keep=entry_dir)
+        return entry_dir, os.path.join(entry_dir, main_rel_path)
+
+    def _headings_path(self, path: str) -> str:
+        return os.path.join(
+            self.headings_dir, f"{self.digest(path)}{HEADINGS_FILE_SUFFIX}"
+        )
+
+    def get_headings(self, path: str) -> Optional[list[models.BookHeading]]:
+        """
+        Returns the headings of the ebook at `path` with their positions, if
+        they were resolved before. Like assignments, they are kept whether the
+        book was unpacked to disk or read in memory, and never evicted.
+        """
+        try:
+            with open(self._headings_path(path), encoding="utf-8") as f:
+                return [models.BookHeading(**h) for h in json.load(f)]
+        except (OSError, ValueError):
+            return None
+
+    def put_headings(self, path: str, headings: list[models.BookHeading]) -> None:
+        _write_atomic(
+            self._headings_path(path), json.dumps([h.dict() for h in headings])
+        )
+
+    def _assignments_path(self, digest: str, heading_mode: str) -> str:
+        return os.path.join(self.assignments_dir, f"{digest}.{heading_mode}.json")
+
+    def get_assignments(
+        self, digest: str, heading_mode: str
+    ) -> Optional[tuple[list[models.BookHeading], dict[str, Optional[int]]]]:
+        """
+        Returns the headings of a book and the heading index of every highlight
+        fingerprint resolved on earlier runs. Unlike extractions these are
+        small and never evicted.
+        """
+        try:
+            with open(
+                self._assignments_path(digest, heading_mode), encoding="utf-8"
+            ) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        headings = [models.BookHeading(**h) for h in data["headings"]]
+        return headings, data["assignments"]
+
+    def put_assignments(
+        self,
+        digest: str,
+        heading_mode: str,
+        headings: list[models.BookHeading],
+        assignments: dict[str, Optional[int]],
+    ) -> None:
+        _write_atomic(
+            self._assignments_path(digest, heading_mode),
+            json.dumps(
+                {
+                    "headings": [h.dict() for h in headings],
+                    "assignments": assignments,
+                }
+            ),
+        )
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        entries = []
+        for name in os.listdir(self.root):
+            entry_dir = os.path.join(self.root, name)
+            if name.startswith(".") or not os.path.isdir(entry_dir):
+                continue
+            entries.append(
+                (os.stat(entry_dir).st_mtime, _dir_size(entry_dir), entry_dir)
+            )
+
+        total = sum(size for _, size, _ in entries)
+        evicted = set()
+        for _, size, entry_dir in sorted(entries):
+            if entry_dir == keep:
+                continue
+            if total <= self.max_bytes:
+                break
+            logger.info(f"Evicting {entry_dir} from the extraction cache")
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            evicted.add(os.path.basename(entry_dir))
+            total -= size
+        if evicted:
+            self._prune_digests(evicted)
+
+    def _prune_digests(self, digests: set[str]) -> None:
+        # The remembered hashes of evicted books go with them, a book synced
+        # again is hashed once more
+        for name in os.listdir(self.stat_dir):
+            stat_path = os.path.join(self.stat_dir, name)
+            try:
+                with open(stat_path, "r", encoding="utf-8") as f:
+                    if f.read().strip() not in digests:
+                        continue
+                os.unlink(stat_path)
+            except OSError:
+                continue
@@ -0,0 +1,159 @@
+import gzip
+import os
+import re
+import shutil
+import tempfile
+from typing import BinaryIO, Callable, Optional
+
+from pydantic import BaseModel
+
+from kindle2notion.merging import CLIPPING_SEPARATOR, ClippingsState
+from kindle2notion.package_logger import logger
+
+# Archives are kept next to the clippings file, e.g. on the Kindle itself, so
+# they are found wherever it is mounted and whatever cache is used
+ARCHIVE_DIR_NAME = "kindle2notion-archives"
+_BOM = b"\xef\xbb\xbf"
+
+
+def _archive_dir(clippings_file: str) -> str:
+    return os.path.join(
+        os.path.dirname(os.path.abspath(clippings_file)), ARCHIVE_DIR_NAME
+    )
+
+
+def _archive_stem(clippings_file: str) -> str:
+    return os.path.splitext(os.path.basename(clippings_file))[0]
+
+
+def _numbered_archives(clippings_file: str) -> list[tuple[int, str]]:
+    # Archives are numbered in the order they were written
+    archive_dir = _archive_dir(clippings_file)
+    pattern = re.compile(re.escape(_archive_stem(clippings_file)) + r"-(\d+)\.txt\.gz")
+    try:
+        names = os.listdir(archive_dir)
+    except OSError:
+        return []
+    numbered = []
+    for name in names:
+        match = pattern.fullmatch(name)
+        if match:
+            numbered.append((int(match.group(1)), os.path.join(archive_dir, name)))
+    return sorted(numbered)
+
+
+def archived_clippings(clippings_file: str) -> list[str]:
+    """
+    Returns the archives of the clippings compacted out of `clippings_file`,
+    oldest first.
+    """
+    return [archive for _, archive in _numbered_archives(clippings_file)]
+
+
+def with_archives(clippings_files: list[str]) -> list[str]:
+    """
+    Returns the archives of the files followed by the files themselves,
+    everything that has to be read to see the complete books.
+    """
+    archives = [
+        archive
+        for clippings_file in clippings_files
+        for archive in archived_clippings(clippings_file)
+    ]
+    return archives + list(clippings_files)
+
+
+def _write_durably(path: str, write: Callable[[BinaryIO], None]) -> None:
+    # Written next to `path` and flushed to the disk before it replaces it,
+    # a crash leaves either the old or the new file
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            try:
+                shutil.copymode(path, tmp_path)
+            except OSError:
+                pass
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        # e.g. on Windows, where directories can't be opened
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+class CompactionResult(BaseModel):
+    archive: Optional[str] = None
+    archived_clippings: int = 0
+    archived_bytes: int = 0
+    remaining_bytes: int = 0
+
+
+def compact_clippings(
+    clippings_file: str, clippings_state: ClippingsState
+) -> CompactionResult:
+    """
+    Moves the clippings of `clippings_file` synced with `clippings_state` into
+    a gzip compressed archive in a directory next to the file, and rewrites
+    the file with only the clippings not synced yet.
+
+    Each step leaves a state a sync reads correctly: the archive is complete
+    before the file is replaced atomically, and archives are always read
+    along with their file, so a crash in between only leaves duplicates the
+    merge drops. The checkpoints are updated last, until then the replaced
+    file is simply read in full.
+    """
+    offset = clippings_state.offsets([clippings_file]).get(clippings_file, 0)
+    with open(clippings_file, "rb") as f:
+        before = os.fstat(f.fileno())
+        data = f.read()
+    result = CompactionResult(remaining_bytes=len(data))
+    bom = _BOM if data.startswith(_BOM) else b""
+    synced, tail = data[:offset], data[offset:]
+    if offset <= len(bom):
+        logger.info(f"No clippings of {clippings_file} have been synced yet.")
+        return result
+
+    archive_dir = _archive_dir(clippings_file)
+    os.makedirs(archive_dir, exist_ok=True)
+    number = max((n for n, _ in _numbered_archives(clippings_file)), default=0) + 1
+    archive = os.path.join(
+        archive_dir, f"{_archive_stem(clippings_file)}-{number:04d}.txt.gz"
+    )
+
+    def write_archive(f: BinaryIO) -> None:
+        with gzip.GzipFile(fileobj=f, mode="wb", mtime=0) as archive_file:
+            archive_file.write(synced)
+
+    _write_durably(archive, write_archive)
+
+    after = os.stat(clippings_file)
+    if (after.st_size, after.st_mtime_ns) != (before.st_size, before.st_mtime_ns):
+        raise RuntimeError(
+            f"{clippings_file} changed while it was compacted, it was left as is"
+        )
+    _write_durably(clippings_file, lambda f: f.write(bom + tail))
+    # The archive has been synced as a whole, the new file not at all
+    clippings_state.advance({archive: offset, clippings_file: 0})
+
+    result.archive = archive
+    result.archived_clippings = synced.count(CLIPPING_SEPARATOR)
+    result.archived_bytes = len(synced)
+    result.remaining_bytes = len(bom) + len(tail)
+    logger.info(
+        f"[green]✓[/green] Archived {result.archived_clippings} synced clippings to {archive}, {clippings_file} went from {len(data)} to {result.remaining_bytes} bytes."
+    )
+    return result
@@ -0,0 +1,364 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from functools import partial
+from typing import Callable, Iterator, Optional, TextIO
+
+from kindle2notion import models
+from kindle2notion.caching import atomic_writer
+from kindle2notion.locating import (
+    HeadingInfo,
+    HeadingInfoPrefetcher,
+    HeadingWorkerPool,
+    get_heading_info,
+)
+from kindle2notion.package_logger import logger
+
+TARGETS = ("notion", "markdown", "jsonl")
+# Local sinks flush to disk in chunks of this size rather than per highlight
+WRITE_BUFFER_BYTES = 1 << 20
+JSONL_FILE_NAME = "highlights.jsonl"
+_UNSAFE_FILE_NAME_RE = re.compile(r'[\x00-\x1f/\\:*?"<>|]+')
+
+
+class Exporter(ABC):
+    """
+    A destination for the books of a sync. `export_books` feeds books one at a
+    time to `write_book`, which returns a message if the book was written and
+    None if there was nothing to do. Exporters are context managers, `close`
+    is called once every book has been written, or an error stopped the sync.
+    An exporter kept open across several exports, e.g. by `watch`, is
+    `flush`ed after each of them instead.
+    Exporters flagged `concurrent` accept `write_book` calls from several
+    threads at once. Exporters flagged `incremental` keep what earlier syncs
+    wrote, so they may be given only the books that changed since.
+    """
+
+    concurrent = False
+    incremental = False
+
+    def needs_writing(self, book: models.Book) -> bool:
+        """
+        Whether the book may have changed since it was last written. Books
+        that haven't are skipped before their headings or anything else is
+        fetched for them.
+        """
+        return True
+
+    def prepare_book(self, book: models.Book) -> None:
+        """
+        Called ahead of `write_book`, possibly from another thread, to fetch
+        whatever the book needs besides its headings.
+        """
+
+    @abstractmethod
+    def write_book(
+        self, book: models.Book, load_heading_info: Callable[[], HeadingInfo]
+    ) -> Optional[str]:
+        """
+        Writes the book, returns a message if it was written.
+        """
+
+    def flush(self, failed: bool = False) -> None:
+        """
+        Makes the books written so far visible, or drops them if `failed`.
+        """
+
+    def close(self, failed: bool = False) -> None:
+        self.flush(failed=failed)
+
+    def __enter__(self) -> "Exporter":
+        return self
+
+    def __exit__(self, exc_type, *exc) -> None:
+        self.close(failed=exc_type is not None)
+
+
+def iter_sections(
+    book: models.Book, heading_info: HeadingInfo
+) -> Iterator[tuple[Optional[models.BookHeading], models.Highlight]]:
+    """
+    Yields every highlight with the heading to print before it, which is None
+    unless the highlight starts a new section.
+    """
+    headings, highlight_to_heading_indices = heading_info
+    last_heading_idx = None
+    for heading_idx, highlight in zip(highlight_to_heading_indices, book.highlights):
+        heading = None
+        if heading_idx is not None and last_heading_idx != heading_idx:
+            heading = headings[heading_idx]
+            last_heading_idx = heading_idx
+        yield heading, highlight
+
+
+class MarkdownExporter(Exporter):
+    """
+    Writes every book to `<output_dir>/<title>.md`. A book whose file name is
+    taken by the file of another book, in this export or an earlier one, is
+    written to `<title> (<hash>).md`, the hash being of its title and author.
+    """
+
+    incremental = True
+
+    def __init__(
+        self, output_dir: str, enable_location: bool, enable_highlight_date: bool
+    ) -> None:
+        self.output_dir = output_dir
+        self.enable_location = enable_location
+        self.enable_highlight_date = enable_highlight_date
+        self._file_names: set[str] = set()
+        # (title, author) -> file name, a book written again keeps its file
+        self._book_files: dict[tuple[str, str], str] = {}
+        os.makedirs(output_dir, exist_ok=True)
+
+    def _header(self, book: models.Book) -> str:
+        return f"# {book.title}\n\n*{book.author}*\n\n"
+
+    def _is_taken(self, file_name: str, book: models.Book) -> bool:
+        if file_name.lower() in self._file_names:
+            return True
+        # Files of earlier exports start with the header of their book
+        header = self._header(book)
+        try:
+            with open(os.path.join(self.output_dir, file_name), encoding="utf-8") as f:
+                return f.read(len(header)) != header
+        except FileNotFoundError:
+            return False
+
+    def _file_name(self, book: models.Book) -> str:
+        file_name = self._book_files.get((book.title, book.author))
+        if file_name is not None:
+            return file_name
+        stem = _UNSAFE_FILE_NAME_RE.sub("_", book.title).strip(" .")[:200] or "Untitled"
+        file_name = f"{stem}.md"
+        if self._is_taken(file_name, book):
+            key = f"{book.title}\0{book.author}".encode("utf-8")
+            file_name = f"{stem} ({hashlib.sha1(key).hexdigest()[:8]}).md"
+        self._file_names.add(file_name.lower())
+        self._book_files[(book.title, book.author)] = file_name
+        return file_name
+
+    def write_book(
+        self, book: models.Book, load_heading_info: Callable[[], HeadingInfo]
+    ) -> Optional[str]:
+        heading_info = load_heading_info()
+        path = os.path.join(self.output_dir, self._file_name(book))
+        with atomic_writer(path, buffering=WRITE_BUFFER_BYTES) as f:
+            f.write(self._header(book))
+            for heading, highlight in iter_sections(book, heading_info):
+                if heading is not None:
+                    f.write(f"## {heading.title.strip()}\n\n")
+                f.write(
+                    highlight.make_aggregate_text(
+                        enable_location=self.enable_location,
+                        enable_highlight_date=self.enable_highlight_date,
+                    )
+                )
+        return f"{len(book.highlights)} notes/highlights written to {path}\n"
+
+
+class JsonLinesExporter(Exporter):
+    """
+    Writes one JSON object per highlight to `<output_dir>/highlights.jsonl`.
+    The file is replaced only once every book has been written, on `flush`.
+    The records of books not written in this export, e.g. left out by a
+    filter or synced by another shard, are carried over from the previous
+    file.
+    """
+
+    incremental = True
+
+    def __init__(
+        self, output_dir: str, enable_location: bool, enable_highlight_date: bool
+    ) -> None:
+        self.enable_location = enable_location
+        self.enable_highlight_date = enable_highlight_date
+        self.output_dir = output_dir
+        os.makedirs(output_dir, exist_ok=True)
+        self.path = os.path.join(output_dir, JSONL_FILE_NAME)
+        self._file: Optional[TextIO] = None
+        self._tmp_path = ""
+        self._written: set[tuple[str, str]] = set()
+
+    def _open(self) -> TextIO:
+        if self._file is None:
+            fd, self._tmp_path = tempfile.mkstemp(dir=self.output_dir, prefix=".tmp-")
+            self._file = os.fdopen(
+                fd, "w", encoding="utf-8", buffering=WRITE_BUFFER_BYTES
+            )
+        return self._file
+
+    def write_book(
+        self, book: models.Book, load_heading_info: Callable[[], HeadingInfo]
+    ) -> Optional[str]:
+        f = self._open()
+        self._written.add((book.title, book.author))
+        heading = None
+        for section_heading, highlight in iter_sections(book, load_heading_info()):
+            heading = section_heading or heading
+            record = {
+                "title": book.title,
+                "author": book.author,
+                "heading": heading.title.strip() if heading is not None else None,
+                "text": highlight.text,
+                "is_note": highlight.is_note,
+                "page": highlight.page,
+                "location": list(highlight.location),
+                "date": highlight.date.isoformat(),
+                "formatted": highlight.make_aggregate_text(
+                    enable_location=self.enable_location,
+                    enable_highlight_date=self.enable_highlight_date,
+                ),
+            }
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        return f"{len(book.highlights)} notes/highlights written to {self.path}\n"
+
+    def _carry_over(self, f: TextIO) -> None:
+        try:
+            previous = open(self.path, "r", encoding="utf-8")
+        except FileNotFoundError:
+            return
+        with previous:
+            for line in previous:
+                try:
+                    record = json.loads(line)
+                    key = (record["title"], record["author"])
+                except (ValueError, KeyError, TypeError):
+                    continue
+                if key not in self._written:
+                    f.write(line)
+
+    def flush(self, failed: bool = False) -> None:
+        f, self._file = self._file, None
+        if f is None:
+            return
+        try:
+            if not failed:
+                self._carry_over(f)
+        finally:
+            f.close()
+            self._written = set()
+        if failed:
+            # The previous export is left in place
+            os.unlink(self._tmp_path)
+        else:
+            os.replace(self._tmp_path, self.path)
+
+    def close(self, failed: bool = False) -> None:
+        if not failed:
+            # The file is written even if no book was
+            self._open()
+        self.flush(failed=failed)
+
+
+def make_local_exporter(
+    target: str, output_dir: str, enable_location: bool, enable_highlight_date: bool
+) -> Exporter:
+    exporter_cls = {"markdown": MarkdownExporter, "jsonl": JsonLinesExporter}[target]
+    return exporter_cls(
+        output_dir,
+        enable_location=enable_location,
+        enable_highlight_date=enable_highlight_date,
+    )
+
+
+def export_books(
+    exporter: Exporter,
+    all_books: dict[str, models.Book],
+    kindle_root: Optional[str],
+    cache_dir: Optional[str] = None,
+    heading_workers: int = 2,
+    heading_worker_memory_mb: Optional[int] = None,
+    heading_mode: str = "text",
+    heading_pool: Optional[HeadingWorkerPool] = None,
+    close: bool = True,
+) -> int:
+    """
+    Writes all books with `exporter`, extracting their headings ahead of time
+    when `kindle_root` is given. Returns how many books were written.
+    `heading_pool` shares heading workers with other exports running in the
+    same process instead of starting `heading_workers` new ones. Without
+    `close` the exporter is only flushed, so later exports can reuse it.
+    """
+    logger.info("Initiating transfer...\n")
+
+    books = []
+    for book in all_books.values():
+        if exporter.needs_writing(book):
+            books.append(book)
+        else:
+            log_unchanged(book)
+    written = 0
+    prefetcher = None
+    if kindle_root and (heading_workers > 0 or heading_pool is not None):
+        prefetcher = HeadingInfoPrefetcher(
+            books,
+            kindle_root,
+            cache_dir,
+            workers=heading_workers,
+            max_memory_mb=heading_worker_memory_mb,
+            heading_mode=heading_mode,
+            pool=heading_pool,
+        )
+
+    try:
+        with exporter if close else _flushing(exporter):
+            for idx, book in enumerate(books):
+                if prefetcher is not None:
+                    load_heading_info = partial(
+                        prefetcher.result, prefetcher.future(idx), book
+                    )
+                elif kindle_root:
+                    load_heading_info = partial(
+                        get_heading_info, book, kindle_root, cache_dir, heading_mode
+                    )
+                else:
+                    load_heading_info = partial(no_heading_info, book)
+                if export_book(exporter, book, load_heading_info):
+                    written += 1
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+    return written
+
+
+@contextmanager
+def _flushing(exporter: Exporter) -> Iterator[None]:
+    try:
+        yield
+    except BaseException:
+        exporter.flush(failed=True)
+        raise
+    exporter.flush()
+
+
+def export_book(
+    exporter: Exporter,
+    book: models.Book,
+    load_heading_info: Callable[[], HeadingInfo],
+) -> bool:
+    """
+    Writes one book and logs the outcome, returns whether it was written.
+    """
+    try:
+        message = exporter.write_book(book, load_heading_info)
+    except Exception as e:
+        logger.error(f"An error occured in writing: {book.title} ({book.author})")
+        raise e
+    if message:
+        logger.info(f"[green]✓[/green] {message}")
+        return True
+    logger.info("Nothing to add!")
+    return False
+
+
+def log_unchanged(book: models.Book) -> None:
+    logger.info(f"{book.title} ({book.author}) is unchanged, nothing to add!")
+
+
+def no_heading_info(book: models.Book) -> HeadingInfo:
+    return [], [None for _ in range(len(book.highlights))]
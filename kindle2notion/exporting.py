@@ -1,17 +1,160 @@
-import bisect
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Optional, cast
+from functools import lru_cache, partial
+from typing import Callable, Optional, Union, cast
 import notional
-from notional.blocks import Paragraph, Quote, Page, Heading2
+from notional import schema
+from notional.blocks import Block, Paragraph, Quote, Page, Heading2, Toggle
 from notional.query import TextCondition
-from notional.types import Date, ExternalFile, Number, RichText, Title, Checkbox
-from kindle2notion import models
-from kindle2notion.reading import find_mobi_file, MobiHandler
+from notional.types import (
+    Checkbox,
+    DatabaseRef,
+    Date,
+    ExternalFile,
+    Number,
+    RichText,
+    Title,
+)
+from kindle2notion import models, rendering
+from kindle2notion.exporters import Exporter, export_books, iter_sections
+from kindle2notion.journaling import BookProgress, SyncJournal
+from kindle2notion.locating import HeadingInfo, HeadingWorkerPool, get_heading_info
 from kindle2notion.package_logger import logger
-from requests import get
-from fuzzysearch import find_near_matches
+from kindle2notion.rendering import RawBlock
+from kindle2notion.throttling import get_session
 
 NO_COVER_IMG = "https://via.placeholder.com/150x200?text=No%20Cover"
+# Rich text property holding `Book.content_digest` of the page's content
+CONTENT_DIGEST_PROPERTY = "Content Digest"
+# Page content is rendered straight to JSON, or built as notional models
+PageBlock = Union[Block, RawBlock]
+# "flat" writes all highlights to the book's page, the others put every
+# chapter under its own toggle or child page
+PAGE_LAYOUTS = ("flat", "toggles", "child_pages")
+# Chapters of a book filled at the same time in the chapter layouts
+DEFAULT_CHAPTER_WORKERS = 4
+# The most blocks a single append accepts
+MAX_APPEND_BLOCKS = 100
+
+
+class NotionExporter(Exporter):
+    # Requests are rate limited per token, whichever thread makes them
+    concurrent = True
+    incremental = True
+
+    def __init__(
+        self,
+        notion_api_auth_token: str,
+        notion_database_id: str,
+        enable_location: bool,
+        enable_highlight_date: bool,
+        enable_book_cover: bool,
+        separate_blocks: bool,
+        heading_mode: str = "text",
+        journal: Optional[SyncJournal] = None,
+        page_layout: str = "flat",
+        chapter_workers: int = DEFAULT_CHAPTER_WORKERS,
+        kindle_root: Optional[str] = None,
+    ) -> None:
+        self.notion_api_auth_token = notion_api_auth_token
+        self.notion_database_id = notion_database_id
+        self.enable_location = enable_location
+        self.enable_highlight_date = enable_highlight_date
+        self.enable_book_cover = enable_book_cover
+        self.separate_blocks = separate_blocks
+        self.heading_mode = heading_mode
+        self.journal = journal
+        self.page_layout = page_layout
+        self.chapter_workers = chapter_workers
+        # Only tells whether the pages have headings, they are loaded by
+        # the `load_heading_info` every book is written with
+        self.kindle_root = kindle_root
+        self._page_index: Optional[dict[str, Page]] = None
+        self._page_index_lock = threading.Lock()
+
+    def _get_page_index(self) -> dict[str, Page]:
+        with self._page_index_lock:
+            if self._page_index is None:
+                self._page_index = _load_page_index(
+                    get_session(self.notion_api_auth_token), self.notion_database_id
+                )
+            return self._page_index
+
+    def needs_writing(self, book: models.Book) -> bool:
+        digest = book.content_digest(
+            self.enable_location,
+            self.enable_highlight_date,
+            self.separate_blocks,
+            self.page_layout,
+            self.heading_mode if self.kindle_root else None,
+        )
+        if self.journal is not None:
+            progress = self.journal.get(book.title, digest)
+            if progress is not None and progress.complete:
+                return False
+        page_block = self._get_page_index().get(book.title)
+        return page_block is None or _page_digest(page_block) != digest
+
+    def prepare_book(self, book: models.Book) -> None:
+        if self.enable_book_cover:
+            # Warms the cover cache for `_create_page`
+            _get_book_cover_uri(book.title, book.author)
+
+    def write_book(
+        self, book: models.Book, load_heading_info: Callable[[], HeadingInfo]
+    ) -> Optional[str]:
+        page_index = self._get_page_index()
+        return _add_book_to_notion(
+            book,
+            self.notion_api_auth_token,
+            self.notion_database_id,
+            self.enable_book_cover,
+            self.separate_blocks,
+            self.enable_location,
+            self.enable_highlight_date,
+            kindle_root=self.kindle_root,
+            load_heading_info=load_heading_info,
+            heading_mode=self.heading_mode,
+            journal=self.journal,
+            page_index=page_index,
+            page_layout=self.page_layout,
+            chapter_workers=self.chapter_workers,
+        )
+
+
+def make_notion_exporter(
+    notion_api_auth_token: str,
+    notion_database_id: str,
+    enable_location: bool,
+    enable_highlight_date: bool,
+    enable_book_cover: bool,
+    separate_blocks: bool,
+    cache_dir: Optional[str] = None,
+    heading_mode: str = "text",
+    page_layout: str = "flat",
+    chapter_workers: int = DEFAULT_CHAPTER_WORKERS,
+    kindle_root: Optional[str] = None,
+) -> NotionExporter:
+    """
+    Returns an exporter journaling its progress in `cache_dir` (or the
+    default journal directory), so an interrupted sync picks up where it
+    stopped.
+    """
+    return NotionExporter(
+        notion_api_auth_token,
+        notion_database_id,
+        enable_location=enable_location,
+        enable_highlight_date=enable_highlight_date,
+        enable_book_cover=enable_book_cover,
+        separate_blocks=separate_blocks,
+        heading_mode=heading_mode,
+        journal=SyncJournal.for_database(notion_database_id, cache_dir),
+        page_layout=page_layout,
+        chapter_workers=chapter_workers,
+        kindle_root=kindle_root,
+    )
 
 
 def export_to_notion(
@@ -23,93 +166,63 @@ def export_to_notion(
     notion_api_auth_token: str,
     notion_database_id: str,
     kindle_root: Optional[str],
-) -> None:
-    logger.info("Initiating transfer...\n")
-
-    for book in all_books.values():
-        try:
-            message = _add_book_to_notion(
-                book,
-                notion_api_auth_token,
-                notion_database_id,
-                enable_book_cover,
-                separate_blocks,
-                enable_location,
-                enable_highlight_date,
-                kindle_root=kindle_root,
-            )
-            if message:
-                logger.info(f"[green]✓[/green] {message}")
-            else:
-                logger.info("Nothing to add!")
-        except Exception as e:
-            logger.error(f"An error occured in writing: {book.title} ({book.author})")
-            raise e
-
-
-def get_heading_info(
-    book: models.Book, kindle_root: str
-) -> tuple[list[models.BookHeading], list[Optional[int]]]:
+    cache_dir: Optional[str] = None,
+    heading_workers: int = 2,
+    heading_worker_memory_mb: Optional[int] = None,
+    heading_mode: str = "text",
+    heading_pool: Optional[HeadingWorkerPool] = None,
+    page_layout: str = "flat",
+    chapter_workers: int = DEFAULT_CHAPTER_WORKERS,
+) -> int:
     """
-    Given a book, this will return a tuple
-    (l1, l2)
-    l1 -> list of all headings
-    l2 -> list of indices into l1 for each highlight in the book such that the highlight comes under that particular heading
+    Writes the books that changed since the last sync, returns how many were
+    written. See `export_books` for the heading options.
     """
-    headings = []
-    indices: list[Optional[int]] = [None for _ in range(len(book.highlights))]
-
-    mobi_path = find_mobi_file(book, kindle_root)
-    if mobi_path is None:
-        return headings, indices
-    mobi_handler = MobiHandler(mobi_path)
-    try:
-        headings = mobi_handler.process()
-    except Exception as e:
-        logger.error("An error occured in handling the mobi file", exc_info=True)
-        return headings, indices
-    headings = [h for h in headings if h.position != -1]
-    if len(headings) == 0:
-        logger.error(
-            "Could not extract positions for any heading, or no headings were found at all"
-        )
-        return headings, indices
-    headings = sorted(headings, key=lambda x: x.position)
-
-    assert mobi_handler.html_file_path is not None
-    html_str = open(mobi_handler.html_file_path, "r", errors="ignore").read()
-    for i, highlight in enumerate(book.highlights):
-        # NOTE: arbitrary first 50 characters
-        txt_short = highlight.text[:50].strip()
-        # txt_pos = html_str.find(txt_short)
-        # NOTE: allowing for a 4% error tolerance here
-        matches = find_near_matches(txt_short, html_str, max_l_dist=2)
-        if len(matches) == 0:
-            logger.warning(
-                f"Failed to find text in html:\n [italic]{txt_short}[/italic]"
-            )
-            continue
-        txt_pos = matches[0].start
-        heading_pos = bisect.bisect_right(headings, txt_pos, key=lambda x: x.position)
-        if heading_pos != 0:
-            indices[i] = heading_pos - 1
-    return (headings, indices)
+    exporter = make_notion_exporter(
+        notion_api_auth_token,
+        notion_database_id,
+        enable_location=enable_location,
+        enable_highlight_date=enable_highlight_date,
+        enable_book_cover=enable_book_cover,
+        separate_blocks=separate_blocks,
+        cache_dir=cache_dir,
+        heading_mode=heading_mode,
+        page_layout=page_layout,
+        chapter_workers=chapter_workers,
+        kindle_root=kindle_root,
+    )
+    return export_books(
+        exporter,
+        all_books,
+        kindle_root,
+        cache_dir,
+        heading_workers=heading_workers,
+        heading_worker_memory_mb=heading_worker_memory_mb,
+        heading_mode=heading_mode,
+        heading_pool=heading_pool,
+    )
 
 
-def _write_to_page(
-    notion: notional.session.Session,
-    page_block: Page,
-    separate_blocks: bool,
+def _page_batches(
     book: models.Book,
+    heading_info: HeadingInfo,
+    separate_blocks: bool,
     enable_location: bool,
     enable_highlight_date: bool,
-    kindle_root: Optional[str],
-):
-    headings = []
-    highlight_to_heading_indices = [None for _ in range(len(book.highlights))]
+    raw_payloads: bool = True,
+) -> list[list[PageBlock]]:
+    """
+    Splits the content of a book's page into batches of at most 100 blocks,
+    the most a single append accepts. The split only depends on the book and
+    the options, so a resumed sync sees the same batches. With `raw_payloads`
+    the blocks are rendered to JSON directly instead of built as notional
+    models, which serialize to the same bytes much more slowly.
+    """
 
-    if kindle_root:
-        headings, highlight_to_heading_indices = get_heading_info(book, kindle_root)
+    def block(block_type: type, text: str) -> PageBlock:
+        if raw_payloads:
+            return rendering.render(block_type, text)
+        return block_type[text]
 
     formatted_clippings = [
         h.make_aggregate_text(
@@ -117,25 +230,213 @@ def _write_to_page(
         )
         for h in book.highlights
     ]
-    if separate_blocks:
-        page_contents = []
-        last_heading_idx = None
-        for heading_idx, clip in zip(highlight_to_heading_indices, formatted_clippings):
-            if len(page_contents) >= 99:
-                notion.blocks.children.append(page_block, *page_contents)
-                page_contents = []
-            if heading_idx is not None and last_heading_idx != heading_idx:
-                page_contents.append(Heading2[headings[heading_idx].title.strip()])
-                last_heading_idx = heading_idx
+    if not separate_blocks:
+        # TODO: Special case for books with len(clippings) >= 100 characters. Character limit in a Paragraph block in Notion is 100
+        return [[block(Paragraph, "".join(formatted_clippings))]]
 
-            page_contents.append(Quote[clip.strip()])
+    batches = []
+    page_contents = []
+    for (heading, _), clip in zip(
+        iter_sections(book, heading_info), formatted_clippings
+    ):
+        if len(page_contents) >= 99:
+            batches.append(page_contents)
+            page_contents = []
+        if heading is not None:
+            page_contents.append(block(Heading2, heading.title.strip()))
 
-        notion.blocks.children.append(page_block, *page_contents)
+        page_contents.append(block(Quote, clip.strip()))
 
-    else:
-        # TODO: Special case for books with len(clippings) >= 100 characters. Character limit in a Paragraph block in Notion is 100
-        page_content = Paragraph["".join(formatted_clippings)]
-        notion.blocks.children.append(page_block, page_content)
+    batches.append(page_contents)
+    return batches
+
+
+Chapter = tuple[str, list[list[RawBlock]]]
+
+
+def _chapter_batches(
+    book: models.Book,
+    heading_info: HeadingInfo,
+    separate_blocks: bool,
+    enable_location: bool,
+    enable_highlight_date: bool,
+) -> tuple[list[list[RawBlock]], list[Chapter]]:
+    """
+    Splits the content of a book's page by chapter for the chapter layouts.
+    Returns the batches of the highlights before the first heading, which
+    stay on the page itself, and the title and batches of every chapter.
+    There are no chapters when the book has no headings.
+    """
+    intro: list[str] = []
+    chapters: list[tuple[str, list[str]]] = []
+    for heading, highlight in iter_sections(book, heading_info):
+        if heading is not None:
+            chapters.append((heading.title.strip(), []))
+        clippings = chapters[-1][1] if chapters else intro
+        clippings.append(
+            highlight.make_aggregate_text(
+                enable_location=enable_location,
+                enable_highlight_date=enable_highlight_date,
+            )
+        )
+
+    def batches(clippings: list[str]) -> list[list[RawBlock]]:
+        if not clippings:
+            return []
+        if not separate_blocks:
+            return [[rendering.render(Paragraph, "".join(clippings))]]
+        blocks = [rendering.render(Quote, clip.strip()) for clip in clippings]
+        return [
+            blocks[idx : idx + MAX_APPEND_BLOCKS]
+            for idx in range(0, len(blocks), MAX_APPEND_BLOCKS)
+        ]
+
+    return batches(intro), [(title, batches(clips)) for title, clips in chapters]
+
+
+def _headings_digest(heading_info: HeadingInfo) -> str:
+    """
+    Digest of the headings of a book and of the heading every highlight is
+    placed under, which the content digest leaves out.
+    """
+    headings, highlight_to_heading_indices = heading_info
+    digest = hashlib.sha256()
+    for heading in headings:
+        digest.update(f"{heading.title}\0".encode())
+    digest.update(repr(list(highlight_to_heading_indices)).encode())
+    return digest.hexdigest()
+
+
+def _load_heading_info(
+    book: models.Book,
+    kindle_root: Optional[str],
+    cache_dir: Optional[str] = None,
+    load_heading_info: Optional[Callable[[], HeadingInfo]] = None,
+    heading_mode: str = "text",
+) -> HeadingInfo:
+    if load_heading_info is not None:
+        return load_heading_info()
+    if kindle_root:
+        return get_heading_info(book, kindle_root, cache_dir, heading_mode)
+    return [], [None for _ in range(len(book.highlights))]
+
+
+def _write_to_page(
+    notion: notional.session.Session,
+    page_block: Page,
+    batches: list[list[PageBlock]],
+    skip_batches: int = 0,
+    on_batch: Optional[Callable[[list[PageBlock]], None]] = None,
+):
+    """
+    Appends the batches of blocks to the page, except for the first
+    `skip_batches`. `on_batch` is called with every batch once it has been
+    appended.
+    """
+    for page_contents in batches[skip_batches:]:
+        if page_contents and isinstance(page_contents[0], RawBlock):
+            rendering.append_blocks(notion, str(page_block.id), page_contents)
+        else:
+            notion.blocks.children.append(page_block, *page_contents)
+        if on_batch is not None:
+            on_batch(page_contents)
+
+
+def _create_chapter_parents(
+    notion: notional.session.Session,
+    page_block: Page,
+    page_layout: str,
+    chapters: list[Chapter],
+) -> list[str]:
+    """
+    Adds a toggle or child page for every chapter to the page, in order, and
+    returns their ids.
+    """
+    if page_layout == "toggles":
+        toggles = [rendering.render(Toggle, title) for title, _ in chapters]
+        for idx in range(0, len(toggles), MAX_APPEND_BLOCKS):
+            rendering.append_blocks(
+                notion, str(page_block.id), toggles[idx : idx + MAX_APPEND_BLOCKS]
+            )
+        if any(toggle.id is None for toggle in toggles):
+            raise RuntimeError("Notion did not return the ids of the chapter toggles")
+        return [cast(str, toggle.id) for toggle in toggles]
+
+    # Child pages are listed in the order they were created, so they are
+    # created one after the other
+    return [
+        notion.client.pages.create(
+            parent={"page_id": str(page_block.id)},
+            properties={"title": Title[title].dict()},
+        )["id"]
+        for title, _ in chapters
+    ]
+
+
+def _write_chapters(
+    notion: notional.session.Session,
+    page_block: Page,
+    page_layout: str,
+    intro: list[list[RawBlock]],
+    chapters: list[Chapter],
+    chapter_workers: int = DEFAULT_CHAPTER_WORKERS,
+) -> None:
+    """
+    Writes the highlights before the first heading to the page, and those of
+    every chapter under its toggle or child page. The appends to one parent
+    have to be sequential, but up to `chapter_workers` chapters are filled at
+    once. Their requests all go through the session's rate limiter.
+    """
+    _write_to_page(notion, page_block, intro)
+    parent_ids = _create_chapter_parents(notion, page_block, page_layout, chapters)
+
+    def fill(parent_id: str, batches: list[list[RawBlock]]) -> None:
+        for batch in batches:
+            rendering.append_blocks(notion, parent_id, batch)
+
+    with ThreadPoolExecutor(max_workers=max(chapter_workers, 1)) as executor:
+        futures = [
+            executor.submit(fill, parent_id, batches)
+            for parent_id, (_, batches) in zip(parent_ids, chapters)
+        ]
+        try:
+            for future in futures:
+                future.result()
+        except BaseException:
+            # Chapters not started yet are dropped, the page is rewritten on
+            # the next sync
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def _resume_page(
+    notion: notional.session.Session, progress: BookProgress
+) -> Optional[Page]:
+    """
+    Returns the page of an interrupted sync, without any block appended after
+    the last journaled batch, or None if it can't be resumed.
+    """
+    try:
+        page_block = notion.pages.retrieve(progress.page_id)
+    except Exception:
+        logger.warning("Could not retrieve the page of the interrupted sync")
+        return None
+    if page_block.archived:
+        return None
+
+    # A batch may have been appended without being journaled
+    children = list(notion.blocks.children.list(page_block))
+    keep = progress.blocks_done
+    if len(children) < keep:
+        return None
+    if progress.last_block_id is not None and (
+        keep == 0 or str(children[keep - 1].id) != progress.last_block_id
+    ):
+        return None
+    for child in children[keep:]:
+        notion.blocks.delete(child)
+    return page_block
 
 
 def _add_book_to_notion(
@@ -147,74 +448,251 @@ def _add_book_to_notion(
     enable_location: bool,
     enable_highlight_date: bool,
     kindle_root: Optional[str],
+    cache_dir: Optional[str] = None,
+    load_heading_info: Optional[Callable[[], HeadingInfo]] = None,
+    heading_mode: str = "text",
+    journal: Optional[SyncJournal] = None,
+    page_index: Optional[dict[str, Page]] = None,
+    page_layout: str = "flat",
+    chapter_workers: int = DEFAULT_CHAPTER_WORKERS,
 ) -> Optional[str]:
-    notion = notional.connect(auth=notion_api_auth_token)
-
-    query = (
-        notion.databases.query(notion_database_id)
-        .filter(property="Title", rich_text=TextCondition(equals=book.title))
-        .limit(1)
-    )
-    page_block: Page = cast(Page, query.first())
-    needs_writing: bool = False
+    """
+    Writes the book unless its page already holds the same content.
+    `page_index` maps titles to the pages of the database, it is queried for
+    the book when not given, and updated with the pages written. With a chapter `page_layout`, books with headings
+    are written by chapter, see `_write_chapters`.
+    """
+    notion = get_session(notion_api_auth_token)
 
     title_and_author = book.title + " (" + str(book.author) + ")"
     logger.info(title_and_author)
     logger.info("-" * len(title_and_author))
 
-    if page_block:
-        last_highlighted_dt = cast(
-            datetime,
-            page_block.properties["Last Highlighted"].date.start or datetime.min,
+    digest = book.content_digest(
+        enable_location,
+        enable_highlight_date,
+        separate_blocks,
+        page_layout,
+        heading_mode if kindle_root else None,
+    )
+    progress = journal.get(book.title, digest) if journal is not None else None
+    if progress is not None and progress.complete:
+        # This exact content has been written before
+        return
+
+    page_block = None
+    if progress is not None:
+        page_block = _resume_page(notion, progress)
+    if page_block is None:
+        progress = None
+        if page_index is not None:
+            existing_page = page_index.get(book.title)
+        else:
+            existing_page = _query_page(notion, notion_database_id, book.title)
+        if existing_page is not None and _page_digest(existing_page) == digest:
+            if journal is not None:
+                journal.complete(book.title, digest, str(existing_page.id))
+            return
+        page_highlights = (
+            _page_highlights(existing_page) if existing_page is not None else None
+        )
+        if page_highlights is not None and page_highlights > len(book.highlights):
+            # Clippings are only ever appended, a book with fewer highlights
+            # was read from incomplete clippings, e.g. without its archives
+            logger.error(
+                f"[red]×[/red] The page holds {page_highlights} highlights but only "
+                f"{len(book.highlights)} were found, it was left as is. "
+                "Delete the page to write it again."
+            )
+            return
+    else:
+        logger.info(f"Resuming after {progress.batches_done} written batches")
+
+    heading_info = _load_heading_info(
+        book, kindle_root, cache_dir, load_heading_info, heading_mode
+    )
+    book_headings_digest = _headings_digest(heading_info)
+    if page_block is not None and progress.headings_digest != book_headings_digest:
+        # e.g. the ebook was found since, its batches would be split otherwise
+        logger.info("The headings changed since the interrupted sync, starting over")
+        notion.pages.delete(page_block)
+        page_block, progress, existing_page = None, None, None
+    intro, chapters = [], []
+    if page_layout != "flat":
+        intro, chapters = _chapter_batches(
+            book, heading_info, separate_blocks, enable_location, enable_highlight_date
         )
-        blockquoted = cast(bool, page_block.properties["Blockquoted"].checkbox)
-        includes_location = cast(
-            bool, page_block.properties["Includes Location"].checkbox
+    # Chapters are written concurrently, so their progress isn't journaled
+    # by batch. An interrupted page is emptied and written again.
+    batches = (
+        []
+        if chapters
+        else _page_batches(
+            book,
+            heading_info,
+            separate_blocks,
+            enable_location,
+            enable_highlight_date,
         )
-        includes_timestamp = cast(
-            bool, page_block.properties["Includes Timestamp"].checkbox
+    )
+
+    if page_block is None:
+        # Clear the contents of the existing page if we are rewriting.
+        if existing_page is not None:
+            notion.pages.delete(existing_page)
+        # A book that fits in one batch is complete as soon as it's created
+        page_block = _create_page(
+            notion,
+            book,
+            notion_database_id,
+            enable_book_cover,
+            separate_blocks,
+            enable_location,
+            enable_highlight_date,
+            children=batches[0] if batches else [],
+            digest=digest if len(batches) == 1 else None,
         )
-        current_highlight_count = page_block.properties["Highlights"].number or 0
+        if len(batches) == 1:
+            if journal is not None:
+                journal.complete(book.title, digest, str(page_block.id))
+            if page_index is not None:
+                page_index[book.title] = page_block
+            return str(len(book.highlights)) + " notes/highlights added successfully.\n"
+        if journal is not None:
+            progress = journal.begin(
+                book.title, digest, str(page_block.id), book_headings_digest
+            )
+            if batches:
+                # Blocks created with the page carry no ids in the response
+                journal.record_batch(book.title, None, len(batches[0]))
+        else:
+            progress = BookProgress(digest=digest, batches_done=1 if batches else 0)
 
-        needs_writing = (
-            (
-                last_highlighted_dt.replace(second=0, tzinfo=None)
-                < book.last_highlighted_date.replace(second=0, tzinfo=None)
+    try:
+        if chapters:
+            _write_chapters(
+                notion, page_block, page_layout, intro, chapters, chapter_workers
             )
-            | (includes_location ^ enable_location)
-            | (includes_timestamp ^ enable_highlight_date)
-            | (blockquoted ^ separate_blocks)
-            | (current_highlight_count != len(book.highlights))
+        _write_to_page(
+            notion,
+            page_block,
+            batches,
+            skip_batches=progress.batches_done if progress is not None else 0,
+            on_batch=partial(_record_batch, journal, book.title)
+            if journal is not None
+            else None,
         )
+        # Only write this once content has been succesfully written to page
+        notion.pages.update(
+            page_block,
+            **{
+                "Highlights": Number[len(book.highlights)],
+                "Last Synced": Date[datetime.now().isoformat()],
+                CONTENT_DIGEST_PROPERTY: RichText[digest],
+            },
+        )
+    except Exception as e:
+        # The page is kept, the next sync resumes it from the journal
+        logger.error("Failed writing to notion")
+        raise e
+    if journal is not None:
+        journal.complete(book.title, digest, str(page_block.id))
+    if page_index is not None:
+        # `pages.update` refreshed the page, digest included
+        page_index[book.title] = page_block
+    return str(len(book.highlights)) + " notes/highlights added successfully.\n"
+
+
+def _record_batch(journal: SyncJournal, title: str, batch: list[PageBlock]) -> None:
+    last_block_id = batch[-1].id
+    journal.record_batch(
+        title, str(last_block_id) if last_block_id is not None else None, len(batch)
+    )
 
-    else:
-        needs_writing = True
 
-    if not needs_writing:
-        return
+def _load_page_index(
+    notion: notional.session.Session, notion_database_id: str
+) -> dict[str, Page]:
+    """
+    Returns the pages of the database by title, read with one paginated query.
+    Adds the content digest property to databases created before it existed.
+    """
+    database = notion.databases.retrieve(notion_database_id)
+    if CONTENT_DIGEST_PROPERTY not in database.properties:
+        logger.info(f'Adding the "{CONTENT_DIGEST_PROPERTY}" property to the database')
+        notion.databases.update(
+            database, schema={CONTENT_DIGEST_PROPERTY: schema.RichText()}
+        )
 
-    # Clear the contents of the existing page if we are rewriting.
-    if page_block:
-        notion.pages.delete(page_block)
+    page_index = {}
+    for page_block in notion.databases.query(notion_database_id).execute():
+        title = page_block.properties.get("Title")
+        if title is not None:
+            page_index.setdefault(title.Value, page_block)
+    return page_index
 
-    # Create a brand new page block with the correct properties
-    page_block = notion.pages.create(
-        parent=notion.databases.retrieve(notion_database_id),
-        properties={
-            "Title": Title[book.title],
-            "Author": RichText[book.author],
-            "Last Highlighted": Date[book.last_highlighted_date.isoformat()],
-            "Blockquoted": Checkbox[separate_blocks],
-            "Includes Location": Checkbox[enable_location],
-            "Includes Timestamp": Checkbox[enable_highlight_date],
-        },
-        children=[],
+
+def _query_page(
+    notion: notional.session.Session, notion_database_id: str, title: str
+) -> Optional[Page]:
+    query = (
+        notion.databases.query(notion_database_id)
+        .filter(property="Title", rich_text=TextCondition(equals=title))
+        .limit(1)
     )
+    return cast(Page, query.first())
+
+
+def _page_digest(page_block: Page) -> Optional[str]:
+    # Pages written before the digest existed have none and are rewritten once
+    digest = page_block.properties.get(CONTENT_DIGEST_PROPERTY)
+    return digest.Value if digest is not None else None
+
+
+def _page_highlights(page_block: Page) -> Optional[int]:
+    highlights = page_block.properties.get("Highlights")
+    if highlights is None or highlights.Value is None:
+        return None
+    return int(highlights.Value)
+
+
+def _create_page(
+    notion: notional.session.Session,
+    book: models.Book,
+    notion_database_id: str,
+    enable_book_cover: bool,
+    separate_blocks: bool,
+    enable_location: bool,
+    enable_highlight_date: bool,
+    children: list[PageBlock],
+    digest: Optional[str] = None,
+) -> Page:
+    """
+    Creates the page of the book with its cover, properties and first batch
+    of blocks in a single request. A `digest` is given when the batch holds
+    all of the book's blocks, the page then also gets the properties
+    otherwise set once writing is done.
+    """
+    properties = {
+        "Title": Title[book.title],
+        "Author": RichText[book.author],
+        "Last Highlighted": Date[book.last_highlighted_date.isoformat()],
+        "Blockquoted": Checkbox[separate_blocks],
+        "Includes Location": Checkbox[enable_location],
+        "Includes Timestamp": Checkbox[enable_highlight_date],
+    }
+    if digest is not None:
+        properties["Highlights"] = Number[len(book.highlights)]
+        properties["Last Synced"] = Date[datetime.now().isoformat()]
+        properties[CONTENT_DIGEST_PROPERTY] = RichText[digest]
+    request = {
+        "parent": DatabaseRef[notion_database_id].dict(),
+        "properties": {name: prop.dict() for name, prop in properties.items()},
+    }
 
     if enable_book_cover:
-        # Fetch a book cover from Google Books if the cover for the page is not set
-        if page_block.cover is None:
-            result = _get_book_cover_uri(book.title, book.author)
+        # Fetch a book cover from Google Books
+        result = _get_book_cover_uri(book.title, book.author)
 
         if result is None:
             # Set the page cover to a placeholder image
@@ -227,31 +705,14 @@ def _add_book_to_notion(
             # Set the page cover to that of the book
             cover = ExternalFile[result]
             logger.info("[green]✓[/green] Added book cover.")
+        request["cover"] = cover.dict()
 
-        notion.pages.set(page_block, cover=cover)
-    try:
-        _write_to_page(
-            notion=notion,
-            page_block=page_block,
-            separate_blocks=separate_blocks,
-            book=book,
-            enable_location=enable_location,
-            enable_highlight_date=enable_highlight_date,
-            kindle_root=kindle_root,
-        )
-        # Only write this once content has been succesfully written to page
-        notion.pages.update(
-            page_block,
-            **{
-                "Highlights": Number[len(book.highlights)],
-                "Last Synced": Date[datetime.now().isoformat()],
-            },
-        )
-        return str(len(book.highlights)) + " notes/highlights added successfully.\n"
-    except Exception as e:
-        logger.error("Failed writing to notion")
-        notion.pages.delete(page_block)
-        raise e
+    if children and isinstance(children[0], RawBlock):
+        body = rendering.splice(request, "children", [child.json for child in children])
+        return Page.parse_obj(rendering.send(notion, "POST", "pages", body))
+    request["children"] = [child.dict() for child in children]
+    # notional's pages.create can't set a cover, so the request is sent as is
+    return Page.parse_obj(notion.client.pages.create(**request))
 
 
 # def _create_rich_text_object(text):
@@ -283,7 +744,11 @@ def _add_book_to_notion(
 #     return para
 
 
+# Covers are looked up once per process, however many jobs sync the same book
+@lru_cache(maxsize=1024)
 def _get_book_cover_uri(title: str, author: str):
+    from requests import get
+
     req_uri = "https://www.googleapis.com/books/v1/volumes?q="
 
     if title is None:
@@ -0,0 +1,97 @@
+import fnmatch
+from datetime import datetime
+from typing import Optional
+
+from pydantic import BaseModel
+
+_WILDCARDS = set("*?[")
+
+
+class BookIndexEntry(BaseModel):
+    """
+    What the first, cheap pass over a clippings file knows about a book.
+    """
+
+    title: str
+    author: str
+    clippings: int = 0
+    # clippings added since the last checkpoint of their file
+    new_clippings: int = 0
+    last_added: Optional[datetime] = None
+
+
+def _matches(pattern: str, value: str) -> bool:
+    pattern = pattern.lower()
+    if not _WILDCARDS & set(pattern):
+        # A plain word matches anywhere
+        pattern = f"*{pattern}*"
+    return fnmatch.fnmatchcase(value.lower(), pattern)
+
+
+class BookFilter:
+    """
+    Selects the books of a sync: `since` keeps books with a clipping added
+    at or after it, `book` and `author` are case insensitive glob patterns,
+    or words to look for, matched against the title and author. A book has
+    to pass every filter that is set.
+    """
+
+    def __init__(
+        self,
+        since: Optional[datetime] = None,
+        book: Optional[str] = None,
+        author: Optional[str] = None,
+    ) -> None:
+        self.since = since
+        self.book = book
+        self.author = author
+
+    @property
+    def needs_dates(self) -> bool:
+        return self.since is not None
+
+    def accepts(self, entry: BookIndexEntry) -> bool:
+        if self.book is not None and not _matches(self.book, entry.title):
+            return False
+        if self.author is not None and not _matches(self.author, entry.author):
+            return False
+        if self.since is not None and (
+            entry.last_added is None or entry.last_added < self.since
+        ):
+            return False
+        return True
+
+
+def parse_since(value: str) -> datetime:
+    """
+    Reads an ISO date, e.g. 2024-05-01, or anything dateparser understands,
+    e.g. "3 days ago". Dates with a time zone are converted to local time,
+    which clippings are dated in.
+    """
+    try:
+        since = datetime.fromisoformat(value)
+    except ValueError:
+        from dateparser import parse
+
+        since = parse(value)
+        if since is None:
+            raise ValueError(f"Could not read the date {value!r}")
+    if since.tzinfo is not None:
+        since = since.astimezone().replace(tzinfo=None)
+    return since
+
+
+def make_book_filter(
+    since: Optional[str], book: Optional[str], author: Optional[str]
+) -> Optional[BookFilter]:
+    """
+    Returns the filter for the command line options, None if every book is
+    synced.
+    """
+    if since is None and book is None and author is None:
+        return None
+    return BookFilter(
+        since=parse_since(since) if since is not None else None,
+        book=book,
+        author=author,
+    )
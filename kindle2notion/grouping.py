@@ -0,0 +1,202 @@
+import json
+import re
+from collections import Counter
+from typing import Optional
+
+from kindle2notion.indexing import tokenize
+from kindle2notion.package_logger import logger
+
+# Two titles whose canonical forms share this much of their trigrams (Dice
+# coefficient) are variants of each other, given their authors agree
+MIN_TRIGRAM_SIMILARITY = 0.9
+# Trigrams shared by more titles than this are too common to find candidates
+MAX_TRIGRAM_POSTINGS = 64
+
+# Sideloaded file names carry the ASIN or a store suffix
+_STORE_SUFFIX_RE = re.compile(r"[_\-\s](B0[0-9A-Z]{8}|EBOK)\b", re.IGNORECASE)
+_BRACKETS_RE = re.compile(r"[(\[]([^)\]]*)[)\]]")
+_EDITION_RE = re.compile(
+    r"\b(\d+(st|nd|rd|th)|first|second|third|kindle|revised|updated|expanded|"
+    r"anniversary|illustrated|annotated|special|deluxe|international)\s+edition\b",
+    re.IGNORECASE,
+)
+_SUBTITLE_RE = re.compile(r"\s*[:|]\s+|\s+-\s+")
+_ARTICLES = ("the", "a", "an")
+# Words numbering volumes and parts, e.g. "Part Two" or "Book III". "I", "V"
+# and "X" are left out, they are words or initials as often as numbers.
+_NUMBER_WORDS = {
+    word: str(n)
+    for words in (
+        "one two three four five six seven eight nine ten eleven twelve",
+        "first second third fourth fifth sixth seventh eighth ninth tenth",
+        "- ii iii iv - vi vii viii ix - xi xii",
+    )
+    for n, word in enumerate(words.split(), start=1)
+    if word != "-"
+}
+
+
+def _canonical_tokens(text: str) -> list[str]:
+    tokens = tokenize(text)
+    if len(tokens) > 1 and tokens[0] in _ARTICLES:
+        tokens = tokens[1:]
+    return tokens
+
+
+def canonicalize_title(title: str) -> tuple[str, str]:
+    """
+    Returns the canonical form of a title, and of the title without its
+    subtitle. Store suffixes, edition markers and bracketed remarks are
+    dropped, except for brackets holding numbers, which tell volumes apart.
+    """
+    title = _STORE_SUFFIX_RE.sub(" ", title).replace("_", " ")
+    title = _BRACKETS_RE.sub(
+        lambda m: m.group(0) if any(c.isdigit() for c in m.group(1)) else " ", title
+    )
+    title = _EDITION_RE.sub(" ", title)
+    key = " ".join(_canonical_tokens(title))
+    base = " ".join(_canonical_tokens(_SUBTITLE_RE.split(title, maxsplit=1)[0]))
+    return key, base or key
+
+
+def _numbers(key: str) -> set[str]:
+    numbers = {str(int(n)) for n in re.findall(r"\d+", key)}
+    numbers.update(_NUMBER_WORDS[t] for t in key.split() if t in _NUMBER_WORDS)
+    return numbers
+
+
+def _trigrams(key: str) -> set[str]:
+    padded = f"  {key} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class _Group:
+    def __init__(self, title: str, author: str, key: str, base: str) -> None:
+        self.title = title
+        self.author_tokens = set(tokenize(author))
+        self.key = key
+        self.base = base
+        self.trigrams = _trigrams(key)
+        self.numbers = _numbers(key)
+
+    def author_agrees(self, author_tokens: set[str]) -> bool:
+        return (
+            not self.author_tokens
+            or not author_tokens
+            or bool(self.author_tokens & author_tokens)
+        )
+
+
+class TitleGrouper:
+    """
+    Maps the title variants of a book (editions, sideloaded file names,
+    subtitles) to a single title, the first variant seen.
+
+    Titles are matched on their canonical form, on their form without a
+    subtitle, and failing that by trigram similarity against candidates
+    found through a trigram index, so grouping stays close to linear in the
+    number of titles. Authors have to agree for titles to be grouped.
+    `overrides` maps titles to the title they should be grouped under, a
+    title mapped to itself is never grouped with others.
+    """
+
+    def __init__(self, overrides: Optional[dict[str, str]] = None) -> None:
+        self.overrides = overrides or {}
+        self._groups: list[_Group] = []
+        self._by_key: dict[str, list[int]] = {}
+        self._postings: dict[str, list[int]] = {}
+        self._assigned: dict[tuple[str, str], str] = {}
+
+    def group_title(self, title: str, author: str) -> str:
+        assigned = self._assigned.get((title, author))
+        if assigned is None:
+            assigned = self._assign(title, author)
+            self._assigned[(title, author)] = assigned
+            if assigned != title:
+                logger.info(
+                    f"Grouping [bold]{title}[/bold] under [bold]{assigned}[/bold]"
+                )
+        return assigned
+
+    def _assign(self, title: str, author: str) -> str:
+        if title in self.overrides:
+            return self.overrides[title]
+
+        key, base = canonicalize_title(title)
+        author_tokens = set(tokenize(author))
+        group = self._match(key, base, author_tokens)
+        if group is not None:
+            return group.title
+
+        group = _Group(title, author, key, base)
+        idx = len(self._groups)
+        self._groups.append(group)
+        self._by_key.setdefault(key, []).append(idx)
+        for trigram in group.trigrams:
+            self._postings.setdefault(trigram, []).append(idx)
+        return title
+
+    def _match(self, key: str, base: str, author_tokens: set[str]) -> Optional[_Group]:
+        numbers = _numbers(key)
+        # Same title, or a subtitled title and a group of the title without.
+        # A bare title never joins a subtitled group, whose subtitle may name
+        # a volume of its own.
+        for idx in self._by_key.get(key, []) + (
+            self._by_key.get(base, []) if base != key else []
+        ):
+            group = self._groups[idx]
+            if group.numbers == numbers and group.author_agrees(author_tokens):
+                return group
+
+        trigrams = _trigrams(key)
+        shared: Counter = Counter()
+        for trigram in trigrams:
+            postings = self._postings.get(trigram, [])
+            if len(postings) <= MAX_TRIGRAM_POSTINGS:
+                shared.update(postings)
+        best, best_score = None, MIN_TRIGRAM_SIMILARITY
+        for idx, _ in shared.most_common():
+            group = self._groups[idx]
+            # The similarity can't exceed what the sizes of the trigram sets allow
+            if 2 * min(len(trigrams), len(group.trigrams)) < best_score * (
+                len(trigrams) + len(group.trigrams)
+            ):
+                continue
+            score = (
+                2
+                * len(trigrams & group.trigrams)
+                / (len(trigrams) + len(group.trigrams))
+            )
+            if (
+                score >= best_score
+                and group.numbers == numbers
+                and group.author_agrees(author_tokens)
+            ):
+                best, best_score = group, score
+        return best
+
+
+def load_title_overrides(path: str) -> dict[str, str]:
+    """
+    Reads a JSON object mapping titles to the title to group them under.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        overrides = json.load(f)
+    if not isinstance(overrides, dict) or not all(
+        isinstance(k, str) and isinstance(v, str) for k, v in overrides.items()
+    ):
+        raise ValueError(f"{path} must hold a JSON object mapping titles to titles")
+    return overrides
+
+
+def make_title_grouper(
+    group_titles: bool, title_overrides: Optional[str] = None
+) -> Optional[TitleGrouper]:
+    """
+    Returns the grouper for the command line options, None if titles are
+    taken as they are.
+    """
+    if not group_titles:
+        return None
+    overrides = load_title_overrides(title_overrides) if title_overrides else None
+    return TitleGrouper(overrides)
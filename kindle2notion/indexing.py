@@ -0,0 +1,260 @@
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+from difflib import SequenceMatcher
+from typing import Iterator, Optional
+
+from pydantic import BaseModel
+
+from kindle2notion.caching import atomic_writer
+from kindle2notion.package_logger import logger
+
+EBOOK_EXTENSIONS = (".mobi", ".azw", ".azw3", ".prc")
+
+# A candidate has to score at least this much, and beat the runner-up by
+# MIN_MARGIN, before the ranked search is trusted to pick a file on its own.
+MIN_SCORE = 0.6
+MIN_MARGIN = 0.1
+MAX_RANKED_CANDIDATES = 10
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+_NON_ALNUM_RE = re.compile(r"[^a-z0-9]")
+
+
+def normalize_key(text: str) -> str:
+    return _NON_ALNUM_RE.sub("", text.lower())
+
+
+def tokenize(text: str) -> list[str]:
+    return _TOKEN_RE.findall(text.lower())
+
+
+class EbookEntry(BaseModel):
+    path: str
+    size: int
+    mtime: float
+    # normalized relative path, used for substring lookups
+    key: str = ""
+    # normalized file name without extension, used for ranking
+    stem_key: str = ""
+    tokens: list[str] = []
+
+
+class RankedEbook(BaseModel):
+    path: str
+    score: float
+
+
+class EbookInventory:
+    """
+    All ebook files found under a Kindle root, indexed by the tokens of their
+    relative paths so that looking up a book does not touch the filesystem.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        entries: list[EbookEntry],
+        dir_mtimes: Optional[dict[str, float]] = None,
+    ) -> None:
+        self.root = root
+        self.entries = entries
+        self.dir_mtimes = dir_mtimes or {}
+        self._postings: dict[str, set[int]] = {}
+        for i, entry in enumerate(self.entries):
+            rel_path = os.path.relpath(entry.path, root)
+            entry.key = normalize_key(rel_path)
+            entry.stem_key = normalize_key(
+                os.path.splitext(os.path.basename(rel_path))[0]
+            )
+            entry.tokens = tokenize(rel_path)
+            for token in set(entry.tokens):
+                self._postings.setdefault(token, set()).add(i)
+
+    @classmethod
+    def scan(cls, root: str) -> "EbookInventory":
+        entries = []
+        dir_mtimes = {}
+        for dir_path, dir_names, file_names in os.walk(root):
+            # Skip the `.sdr` sidecar folders the Kindle keeps next to every book
+            dir_names[:] = [d for d in dir_names if not d.endswith(".sdr")]
+            dir_mtimes[dir_path] = os.stat(dir_path).st_mtime
+            for file_name in file_names:
+                if not file_name.lower().endswith(EBOOK_EXTENSIONS):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                stat = os.stat(path)
+                entries.append(
+                    EbookEntry(path=path, size=stat.st_size, mtime=stat.st_mtime)
+                )
+        logger.info(
+            f"Indexed [white on dodger_blue1]{len(entries)}[/white on dodger_blue1] ebook files under {root}"
+        )
+        return cls(root, entries, dir_mtimes)
+
+    @classmethod
+    def load(cls, inventory_path: str, root: str) -> Optional["EbookInventory"]:
+        """
+        Loads a persisted inventory, returning None if it is missing or if any
+        directory under the root changed since it was saved.
+        """
+        try:
+            with open(inventory_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get("root") != root:
+            return None
+        dir_mtimes: dict[str, float] = data.get("dir_mtimes", {})
+        for dir_path, mtime in dir_mtimes.items():
+            try:
+                if os.stat(dir_path).st_mtime != mtime:
+                    return None
+            except OSError:
+                return None
+        entries = [EbookEntry(**e) for e in data.get("entries", [])]
+        return cls(root, entries, dir_mtimes)
+
+    def save(self, inventory_path: str) -> None:
+        """
+        Persists the inventory, a failure is logged since the inventory is
+        only an optimization.
+        """
+        data = {
+            "root": self.root,
+            "dir_mtimes": self.dir_mtimes,
+            "entries": [
+                {"path": e.path, "size": e.size, "mtime": e.mtime} for e in self.entries
+            ],
+        }
+        try:
+            with atomic_writer(inventory_path) as f:
+                json.dump(data, f)
+        except OSError:
+            logger.warning(
+                f"Could not save the ebook inventory to {inventory_path}", exc_info=True
+            )
+
+    def _idf(self, token: str) -> float:
+        return (
+            math.log((len(self.entries) + 1) / (len(self._postings.get(token, ())) + 1))
+            + 1
+        )
+
+    def _iter_containing(self, query: str) -> Iterator[EbookEntry]:
+        key = normalize_key(query)
+        if not key:
+            return
+        tokens = tokenize(query)
+        postings = [self._postings.get(t, set()) for t in tokens]
+        candidates = set.intersection(*postings) if postings else set()
+        if candidates:
+            for i in sorted(candidates):
+                if key in self.entries[i].key:
+                    yield self.entries[i]
+        else:
+            # The query tokens may be glued together in the file name
+            # (e.g. "ThinkinginBets.mobi"), so fall back to the precomputed keys
+            for entry in self.entries:
+                if key in entry.key:
+                    yield entry
+
+    def rank(self, title: str, author: str = "") -> list[RankedEbook]:
+        """
+        Scores every file that shares a token with the title, weighting rare
+        tokens higher and giving a bonus to files that also mention the author.
+        """
+        title_tokens = set(tokenize(title))
+        author_tokens = set(tokenize(author))
+        if not title_tokens:
+            return []
+        title_weight = sum(self._idf(t) for t in title_tokens)
+        author_weight = sum(self._idf(t) for t in author_tokens)
+
+        overlap: Counter[int] = Counter()
+        for token in title_tokens:
+            for i in self._postings.get(token, ()):
+                overlap[i] += self._idf(token)
+
+        title_key = normalize_key(title)
+        ranked = []
+        for i, weight in overlap.most_common(MAX_RANKED_CANDIDATES):
+            entry = self.entries[i]
+            score = 0.7 * weight / title_weight
+            score += 0.3 * SequenceMatcher(None, title_key, entry.stem_key).ratio()
+            if author_weight:
+                shared = author_tokens.intersection(entry.tokens)
+                score += 0.2 * sum(self._idf(t) for t in shared) / author_weight
+            ranked.append(RankedEbook(path=entry.path, score=score))
+        return sorted(ranked, key=lambda x: -x.score)
+
+    def lookup(self, title: str, author: str = "") -> Optional[str]:
+        for search_by in [title, author]:
+            logger.info(
+                f"Searching mobi file with keyword: [white on dodger_blue1]{normalize_key(search_by)}[/white on dodger_blue1]"
+            )
+            matching_books = [e.path for e in self._iter_containing(search_by)]
+            if len(matching_books) == 1:
+                return matching_books[0]
+            else:
+                logger.warning(
+                    f"Attempt to search failed. Matching candidates: {matching_books}"
+                )
+
+        ranked = self.rank(title, author)
+        if len(ranked) == 0 or ranked[0].score < MIN_SCORE:
+            return None
+        if len(ranked) > 1 and ranked[0].score - ranked[1].score < MIN_MARGIN:
+            logger.warning(
+                f"Ranked search was ambiguous. Top candidates: {[r.path for r in ranked[:2]]}"
+            )
+            return None
+        logger.info(f"Ranked search picked {ranked[0].path} ({ranked[0].score:.2f})")
+        return ranked[0].path
+
+
+_INVENTORIES: dict[str, EbookInventory] = {}
+_INVENTORIES_LOCK = threading.Lock()
+
+
+def get_inventory(kindle_root: str, cache_dir: Optional[str] = None) -> EbookInventory:
+    """
+    Returns the inventory of `kindle_root`, scanning it at most once per
+    process. Heading workers are handed the ebooks looked up by the process
+    that started them, so they never need an inventory of their own. When
+    `cache_dir` is given, the inventory is also persisted across runs.
+    """
+    kindle_root = os.path.abspath(kindle_root)
+    with _INVENTORIES_LOCK:
+        if kindle_root not in _INVENTORIES:
+            _INVENTORIES[kindle_root] = _load_or_scan(kindle_root, cache_dir)
+        return _INVENTORIES[kindle_root]
+
+
+def _load_or_scan(kindle_root: str, cache_dir: Optional[str]) -> EbookInventory:
+
+    inventory = None
+    inventory_path = None
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        root_digest = hashlib.sha1(kindle_root.encode()).hexdigest()[:12]
+        inventory_path = os.path.join(cache_dir, f"inventory-{root_digest}.json")
+        inventory = EbookInventory.load(inventory_path, kindle_root)
+
+    if inventory is None:
+        inventory = EbookInventory.scan(kindle_root)
+        if inventory_path is not None:
+            inventory.save(inventory_path)
+    return inventory
+
+
+def forget_inventories() -> None:
+    """
+    Drops the inventories scanned in this process, e.g. after a Kindle was mounted.
+    """
+    with _INVENTORIES_LOCK:
+        _INVENTORIES.clear()
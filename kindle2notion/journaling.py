@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Optional
+
+from pydantic import BaseModel
+
+from kindle2notion.caching import atomic_writer, file_lock
+
+DEFAULT_JOURNAL_DIR = os.path.join("~", ".cache", "kindle2notion")
+
+
+class BookProgress(BaseModel):
+    # `Book.content_digest` of the version being written
+    digest: str
+    page_id: Optional[str] = None
+    # digest of the headings and of the heading of every highlight the page
+    # was started with, batches written with other headings can't be continued
+    headings_digest: Optional[str] = None
+    # number of block batches and blocks written to the page so far
+    batches_done: int = 0
+    blocks_done: int = 0
+    last_block_id: Optional[str] = None
+    complete: bool = False
+
+
+class SyncJournal:
+    """
+    Durable record of how far the books of a Notion database have been
+    written, so an interrupted sync resumes at the batch where it stopped
+    instead of starting over. It is rewritten atomically after every step,
+    merged with what other processes writing to the same database, e.g. the
+    shards of a sharded sync, recorded in the meantime.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self.books: dict[str, BookProgress] = self._read()
+
+    def _read(self) -> dict[str, BookProgress]:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+            return {
+                title: BookProgress(**progress)
+                for title, progress in data["books"].items()
+            }
+        except (OSError, ValueError, KeyError, TypeError):
+            return {}
+
+    @classmethod
+    def for_database(
+        cls, notion_database_id: str, journal_dir: Optional[str] = None
+    ) -> "SyncJournal":
+        """
+        Returns the journal of a database, shared by every export of the
+        process that writes to it.
+        """
+        journal_dir = os.path.expanduser(journal_dir or DEFAULT_JOURNAL_DIR)
+        key = hashlib.sha1(notion_database_id.encode("utf-8")).hexdigest()[:12]
+        path = os.path.abspath(os.path.join(journal_dir, f"journal-{key}.json"))
+        with _JOURNALS_LOCK:
+            if path not in _JOURNALS:
+                os.makedirs(journal_dir, exist_ok=True)
+                _JOURNALS[path] = cls(path)
+            return _JOURNALS[path]
+
+    def _save(self, title: str) -> None:
+        # Only the entry of `title` changed in this process
+        with file_lock(f"{self.path}.lock"):
+            books = self._read()
+            books[title] = self.books[title]
+            with atomic_writer(self.path) as f:
+                json.dump({"books": {t: p.dict() for t, p in books.items()}}, f)
+        self.books = books
+
+    def get(self, title: str, digest: str) -> Optional[BookProgress]:
+        """
+        Returns the progress of `title` if it was for the same content.
+        """
+        progress = self.books.get(title)
+        if progress is None or progress.digest != digest:
+            return None
+        return progress
+
+    def begin(
+        self,
+        title: str,
+        digest: str,
+        page_id: str,
+        headings_digest: Optional[str] = None,
+    ) -> BookProgress:
+        with self._lock:
+            progress = self.books[title] = BookProgress(
+                digest=digest, page_id=page_id, headings_digest=headings_digest
+            )
+            self._save(title)
+        return progress
+
+    def record_batch(
+        self, title: str, last_block_id: Optional[str], block_count: int
+    ) -> None:
+        with self._lock:
+            progress = self.books[title]
+            progress.batches_done += 1
+            progress.blocks_done += block_count
+            progress.last_block_id = last_block_id
+            self._save(title)
+
+    def complete(self, title: str, digest: str, page_id: Optional[str]) -> None:
+        with self._lock:
+            self.books[title] = BookProgress(
+                digest=digest, page_id=page_id, complete=True
+            )
+            self._save(title)
+
+
+_JOURNALS: dict[str, SyncJournal] = {}
+_JOURNALS_LOCK = threading.Lock()
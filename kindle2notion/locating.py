@@ -0,0 +1,577 @@
+import bisect
+import multiprocessing
+import re
+import threading
+from collections import Counter
+from functools import lru_cache
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional
+
+from kindle2notion import models
+from kindle2notion.caching import ExtractionCache
+from kindle2notion.package_logger import logger
+from kindle2notion.reading import BookText, MobiHandler, find_mobi_file
+
+# Markup and entities are matched only so that they can be skipped. Non-ascii
+# characters are kept inside words and dropped on normalization, the same way
+# `read_raw_clippings` drops them from the clippings file.
+_TOKEN_RE = re.compile(r"<[^>]*>|&#?\w+;|([A-Za-z0-9][A-Za-z0-9'\u0080-\uffff]*)")
+_WORD_RE = re.compile(r"([A-Za-z0-9][A-Za-z0-9'\u0080-\uffff]*)")
+_NON_ALNUM_RE = re.compile(r"[^a-z0-9]")
+
+# Number of words per indexed shingle, and the stride between indexed shingles.
+# Any query of at least SHINGLE_SIZE + SHINGLE_STRIDE - 1 words is guaranteed
+# to contain one indexed shingle if it occurs verbatim in the book.
+SHINGLE_SIZE = 3
+SHINGLE_STRIDE = 3
+# NOTE: arbitrary first 50 characters are used for the fuzzy confirmation
+FUZZY_QUERY_CHARS = 50
+# Extra words around a seeded candidate that the fuzzy match may drift into
+WINDOW_SLACK_WORDS = 8
+
+# (headings, index into headings for every highlight of the book)
+HeadingInfo = tuple[list[models.BookHeading], list[Optional[int]]]
+
+# "text" finds every highlight in the book text, "location" places highlights
+# by their Kindle location and only searches text near chapter boundaries
+HEADING_MODES = ("text", "location")
+# Highlights located by text to calibrate the location -> offset map
+CALIBRATION_ANCHORS = 8
+# Highlights estimated within this many locations of a heading are verified by text
+BOUNDARY_MARGIN_LOCATIONS = 2
+_PLAIN_RUN_RE = re.compile(r"[A-Za-z0-9]+(?: [A-Za-z0-9]+)*")
+
+
+def normalize_words(text: str, skip_markup: bool = True) -> tuple[list[str], list[int]]:
+    """
+    Returns the normalized words of `text` along with their start offsets.
+    """
+    words = []
+    starts = []
+    token_re = _TOKEN_RE if skip_markup else _WORD_RE
+    for m in token_re.finditer(text):
+        word = m.group(1)
+        if word is None:
+            continue
+        word = _NON_ALNUM_RE.sub("", word.lower())
+        if word:
+            words.append(word)
+            starts.append(m.start(1))
+    return words, starts
+
+
+class TextLocator:
+    """
+    Finds highlights in the text of a book.
+
+    A shingle index over the normalized words of the book is built once, so
+    that locating a highlight is a handful of dictionary lookups followed by
+    an exact comparison, or a bounded fuzzy match inside a small window when
+    the highlight does not occur verbatim.
+    """
+
+    def __init__(self, text: str, skip_markup: bool = True) -> None:
+        self.words, self.word_starts = normalize_words(text, skip_markup)
+        # Normalized words joined by single spaces, and where each word starts in it
+        self.norm_text = " ".join(self.words)
+        self.norm_starts = []
+        offset = 0
+        for word in self.words:
+            self.norm_starts.append(offset)
+            offset += len(word) + 1
+
+        self.index: dict[str, list[int]] = {}
+        for i in range(0, len(self.words) - SHINGLE_SIZE + 1, SHINGLE_STRIDE):
+            shingle = " ".join(self.words[i : i + SHINGLE_SIZE])
+            self.index.setdefault(shingle, []).append(i)
+        self.fuzzy_scans = 0
+
+    def _word_offset(self, word_idx: int) -> int:
+        return self.word_starts[min(word_idx, len(self.word_starts) - 1)]
+
+    def _seed_candidates(self, query_words: list[str]) -> list[int]:
+        votes: Counter[int] = Counter()
+        for j in range(len(query_words) - SHINGLE_SIZE + 1):
+            shingle = " ".join(query_words[j : j + SHINGLE_SIZE])
+            for i in self.index.get(shingle, ()):
+                votes[i - j] += 1
+        return [start for start, _ in votes.most_common(3)]
+
+    def _fuzzy_in_window(
+        self, query: str, first_word: int, last_word: int
+    ) -> Optional[int]:
+        first_word = max(first_word, 0)
+        last_word = min(last_word, len(self.words))
+        if first_word >= last_word:
+            return None
+        window_start = self.norm_starts[first_word]
+        window_end = (
+            self.norm_starts[last_word]
+            if last_word < len(self.words)
+            else len(self.norm_text)
+        )
+        from fuzzysearch import find_near_matches
+
+        self.fuzzy_scans += 1
+        max_l_dist = max(2, len(query) // 25)
+        matches = find_near_matches(
+            query, self.norm_text[window_start:window_end], max_l_dist=max_l_dist
+        )
+        if len(matches) == 0:
+            return None
+        best = min(matches, key=lambda m: (m.dist, m.start))
+        word_idx = bisect.bisect_right(self.norm_starts, window_start + best.start) - 1
+        return self._word_offset(word_idx)
+
+    def locate(self, text: str) -> Optional[int]:
+        """
+        Returns the offset in the book text where `text` starts, or None.
+        """
+        query_words, _ = normalize_words(text)
+        if len(query_words) == 0 or len(self.words) == 0:
+            return None
+        query = " ".join(query_words)
+        short_query = query[:FUZZY_QUERY_CHARS].strip()
+        short_len = len(short_query.split(" "))
+
+        for start in self._seed_candidates(query_words):
+            if self.words[max(start, 0) : start + short_len] == query_words[:short_len]:
+                return self._word_offset(max(start, 0))
+            pos = self._fuzzy_in_window(
+                short_query,
+                start - WINDOW_SLACK_WORDS,
+                start + short_len + WINDOW_SLACK_WORDS,
+            )
+            if pos is not None:
+                return pos
+
+        # Too short to be seeded, or too mangled for any shingle to survive
+        norm_pos = self.norm_text.find(short_query)
+        if norm_pos != -1:
+            word_idx = bisect.bisect_right(self.norm_starts, norm_pos) - 1
+            return self._word_offset(word_idx)
+        if len(query_words) < SHINGLE_SIZE + SHINGLE_STRIDE - 1:
+            return self._fuzzy_in_window(short_query, 0, len(self.words))
+        return None
+
+
+class LocationMap:
+    """
+    Piecewise linear map from Kindle locations to html offsets of a book,
+    calibrated from a few highlights whose text was found in the book.
+    """
+
+    def __init__(self, points: list[tuple[int, int]]) -> None:
+        assert len(points) >= 2, "at least two calibration points are needed"
+        self.locations = [p[0] for p in points]
+        self.offsets = [p[1] for p in points]
+        self.bytes_per_location = max(
+            (self.offsets[-1] - self.offsets[0])
+            / max(self.locations[-1] - self.locations[0], 1),
+            1.0,
+        )
+
+    @classmethod
+    def from_anchors(cls, anchors: list[tuple[int, int]]) -> Optional["LocationMap"]:
+        """
+        Builds a map from (location, offset) anchors, dropping the anchors that
+        are out of order (the longest increasing run of offsets is kept).
+        """
+        anchors = sorted(set(anchors))
+        best: list[list[tuple[int, int]]] = []
+        for i, anchor in enumerate(anchors):
+            best.append([anchor])
+            for j in range(i):
+                if anchors[j][0] < anchor[0] and anchors[j][1] < anchor[1]:
+                    if len(best[j]) + 1 > len(best[i]):
+                        best[i] = best[j] + [anchor]
+        kept = max(best, key=len, default=[])
+        if len(kept) < 2:
+            return None
+        return cls(kept)
+
+    def offset(self, location: int) -> int:
+        i = bisect.bisect_right(self.locations, location)
+        if i == 0:
+            lo, hi = 0, 1
+        elif i == len(self.locations):
+            lo, hi = i - 2, i - 1
+        else:
+            lo, hi = i - 1, i
+        slope = (self.offsets[hi] - self.offsets[lo]) / max(
+            self.locations[hi] - self.locations[lo], 1
+        )
+        return max(int(self.offsets[lo] + (location - self.locations[lo]) * slope), 0)
+
+
+def _find_anchor(text: str, highlight_text: str) -> Optional[int]:
+    """
+    Finds a highlight verbatim through its longest run of plain words, which
+    survives the punctuation the clippings file strips. Returns None unless the
+    run occurs exactly once in `text`.
+    """
+    run = max(_PLAIN_RUN_RE.findall(highlight_text), key=len, default="")
+    if len(run) < 20:
+        return None
+    pos = text.find(run)
+    if pos == -1 or text.find(run, pos + 1) != -1:
+        return None
+    return max(pos - highlight_text.index(run), 0)
+
+
+def calibrate_location_map(
+    book: models.Book, book_text: BookText
+) -> Optional[LocationMap]:
+    by_location = sorted(book.highlights, key=lambda h: h.location[0])
+    step = max(len(by_location) // (CALIBRATION_ANCHORS * 3), 1)
+    anchors = []
+    for highlight in by_location[::step]:
+        pos = _find_anchor(book_text.text, highlight.text)
+        if pos is not None:
+            anchors.append((highlight.location[0], book_text.html_offset(pos)))
+    return LocationMap.from_anchors(anchors)
+
+
+def _assign_by_location(
+    book: models.Book,
+    headings: list[models.BookHeading],
+    book_text: BookText,
+    highlights: Optional[list[models.Highlight]] = None,
+) -> Optional[list[Optional[int]]]:
+    """
+    Returns the heading index of each of `highlights` (all highlights of the
+    book by default), calibrating locations on all highlights of the book.
+    """
+    if highlights is None:
+        highlights = book.highlights
+    location_map = calibrate_location_map(book, book_text)
+    if location_map is None:
+        return None
+
+    positions = [h.position for h in headings]
+    margin = BOUNDARY_MARGIN_LOCATIONS * location_map.bytes_per_location
+    locator = None
+    verified = 0
+    indices: list[Optional[int]] = []
+    for highlight in highlights:
+        pos = location_map.offset(highlight.location[0])
+        heading_pos = bisect.bisect_right(positions, pos)
+        near_boundary = (
+            heading_pos < len(positions) and positions[heading_pos] - pos < margin
+        ) or (heading_pos > 0 and pos - positions[heading_pos - 1] < margin)
+        if near_boundary:
+            if locator is None:
+                locator = TextLocator(book_text.text, skip_markup=False)
+            txt_pos = locator.locate(highlight.text)
+            if txt_pos is not None:
+                verified += 1
+                pos = book_text.html_offset(txt_pos)
+                heading_pos = bisect.bisect_right(positions, pos)
+        indices.append(heading_pos - 1 if heading_pos != 0 else None)
+
+    logger.info(
+        f"Placed {len(highlights)} highlights by location, {verified} verified by text"
+    )
+    return indices
+
+
+def get_heading_info(
+    book: models.Book,
+    kindle_root: str,
+    cache_dir: Optional[str] = None,
+    heading_mode: str = "text",
+) -> HeadingInfo:
+    """
+    Given a book, this will return a tuple
+    (l1, l2)
+    l1 -> list of all headings
+    l2 -> list of indices into l1 for each highlight in the book such that the highlight comes under that particular heading
+    """
+    mobi_path = find_mobi_file(book, kindle_root, cache_dir)
+    return get_book_heading_info(book, mobi_path, cache_dir, heading_mode)
+
+
+def get_book_heading_info(
+    book: models.Book,
+    mobi_path: Optional[str],
+    cache_dir: Optional[str] = None,
+    heading_mode: str = "text",
+) -> HeadingInfo:
+    """
+    `get_heading_info` for the ebook at `mobi_path`, once it has been looked
+    up. There is nothing to extract if it wasn't found.
+    """
+    headings = []
+    indices: list[Optional[int]] = [None for _ in range(len(book.highlights))]
+
+    if mobi_path is None:
+        return headings, indices
+    cache = ExtractionCache(cache_dir) if cache_dir is not None else None
+
+    # highlight fingerprint -> heading index, for highlights resolved on earlier runs
+    assignments: dict[str, Optional[int]] = {}
+    stored_headings = None
+    if cache is not None:
+        digest = cache.digest(mobi_path)
+        stored = cache.get_assignments(digest, heading_mode)
+        if stored is not None:
+            stored_headings, assignments = stored
+            if all(h.fingerprint in assignments for h in book.highlights):
+                logger.info("Using cached heading assignments")
+                return stored_headings, [
+                    assignments[h.fingerprint] for h in book.highlights
+                ]
+
+    mobi_handler = MobiHandler(mobi_path, cache=cache)
+    try:
+        headings = mobi_handler.process()
+    except Exception as e:
+        logger.error("An error occured in handling the mobi file", exc_info=True)
+        return [], indices
+    headings = [h for h in headings if h.position != -1]
+    if len(headings) == 0:
+        logger.error(
+            "Could not extract positions for any heading, or no headings were found at all"
+        )
+        return headings, indices
+    headings = sorted(headings, key=lambda x: x.position)
+    if stored_headings != headings:
+        assignments = {}
+
+    pending = [h for h in book.highlights if h.fingerprint not in assignments]
+    book_text = mobi_handler.get_book_text()
+    resolved = None
+    if heading_mode == "location":
+        resolved = _assign_by_location(book, headings, book_text, pending)
+        if resolved is None:
+            logger.warning(
+                "Could not calibrate locations for this book, falling back to text search"
+            )
+    if resolved is None:
+        resolved = _assign_by_text(pending, headings, book_text)
+    assignments.update(zip((h.fingerprint for h in pending), resolved))
+
+    if cache is not None:
+        cache.put_assignments(digest, heading_mode, headings, assignments)
+    return (headings, [assignments[h.fingerprint] for h in book.highlights])
+
+
+def _assign_by_text(
+    highlights: list[models.Highlight],
+    headings: list[models.BookHeading],
+    book_text: BookText,
+) -> list[Optional[int]]:
+    indices: list[Optional[int]] = [None for _ in range(len(highlights))]
+    locator = TextLocator(book_text.text, skip_markup=False)
+    for i, highlight in enumerate(highlights):
+        txt_pos = locator.locate(highlight.text)
+        if txt_pos is None:
+            logger.warning(
+                f"Failed to find text in html:\n [italic]{highlight.text[:50].strip()}[/italic]"
+            )
+            continue
+        txt_pos = book_text.html_offset(txt_pos)
+        heading_pos = bisect.bisect_right(headings, txt_pos, key=lambda x: x.position)
+        if heading_pos != 0:
+            indices[i] = heading_pos - 1
+    logger.info(
+        f"Located {len(highlights)} highlights with {locator.fuzzy_scans} fuzzy scans"
+    )
+    return indices
+
+
+def _limit_worker_memory(max_memory_mb: Optional[int]) -> None:
+    if max_memory_mb is None:
+        return
+    try:
+        import resource
+    except ImportError:
+        logger.warning("Worker memory limits are not supported on this platform")
+        return
+    limit = max_memory_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+@lru_cache(maxsize=None)
+def _worker_context() -> multiprocessing.context.BaseContext:
+    # Pools are started from pipeline and batch threads while other threads
+    # hold locks (the console, http clients, the journal), which forked
+    # workers would inherit held
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+class HeadingWorkerPool:
+    """
+    Process pool running `get_heading_info`, which may be shared by several
+    prefetchers (e.g. every job of a batch sync). The pool is replaced when a
+    worker dies, whichever of its users notices first. Workers are never
+    forked from the threaded parent.
+    """
+
+    def __init__(self, workers: int = 2, max_memory_mb: Optional[int] = None) -> None:
+        self.workers = workers
+        self.max_memory_mb = max_memory_mb
+        self.mp_context = _worker_context()
+        self._lock = threading.Lock()
+        self._executor = self._new_executor()
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=self.mp_context,
+            initializer=_limit_worker_memory,
+            initargs=(self.max_memory_mb,),
+        )
+
+    def __enter__(self) -> "HeadingWorkerPool":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def submit(
+        self,
+        book: models.Book,
+        kindle_root: str,
+        cache_dir: Optional[str],
+        heading_mode: str,
+    ) -> Future:
+        # The ebook is looked up here, so the Kindle root is scanned once in
+        # this process rather than once in every worker
+        mobi_path = find_mobi_file(book, kindle_root, cache_dir)
+        with self._lock:
+            return self._executor.submit(
+                get_book_heading_info, book, mobi_path, cache_dir, heading_mode
+            )
+
+    def load(
+        self,
+        book: models.Book,
+        kindle_root: str,
+        cache_dir: Optional[str],
+        heading_mode: str,
+    ) -> Callable[[], HeadingInfo]:
+        """
+        Submits the book right away and returns a function waiting for its
+        heading info. If the pool breaks in the meantime the book is retried
+        once, since the crash may have been caused by another book.
+        """
+        future = self.submit(book, kindle_root, cache_dir, heading_mode)
+
+        def result() -> HeadingInfo:
+            nonlocal future
+            for attempt in range(2):
+                try:
+                    return future.result()
+                except BrokenProcessPool:
+                    logger.error(
+                        f"Heading worker crashed while processing {book.title}, restarting the pool"
+                    )
+                    self.restart()
+                    if attempt == 0:
+                        future = self.submit(book, kindle_root, cache_dir, heading_mode)
+                except Exception:
+                    logger.error("An error occured in fetching headings", exc_info=True)
+                    break
+            return [], [None for _ in range(len(book.highlights))]
+
+        return result
+
+    def restart(self) -> None:
+        """
+        Replaces the executor if it is broken, futures submitted before have
+        to be resubmitted.
+        """
+        with self._lock:
+            try:
+                self._executor.submit(int)
+                return
+            except BrokenProcessPool:
+                pass
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = self._new_executor()
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class HeadingInfoPrefetcher:
+    """
+    Runs `get_heading_info` for upcoming books in a process pool, so that
+    unpacking and matching the next books overlaps with uploading the
+    current one.
+
+    Books are submitted in order, at most `lookahead` books ahead of the last
+    one requested, which bounds the memory held by pending results. A private
+    pool of `workers` processes is used unless a shared `pool` is given.
+    """
+
+    def __init__(
+        self,
+        books: list[models.Book],
+        kindle_root: str,
+        cache_dir: Optional[str] = None,
+        workers: int = 2,
+        max_memory_mb: Optional[int] = None,
+        lookahead: Optional[int] = None,
+        heading_mode: str = "text",
+        pool: Optional[HeadingWorkerPool] = None,
+    ) -> None:
+        self.books = books
+        self.kindle_root = kindle_root
+        self.cache_dir = cache_dir
+        self.heading_mode = heading_mode
+        self._owns_pool = pool is None
+        self.pool = pool or HeadingWorkerPool(workers, max_memory_mb)
+        self.lookahead = lookahead if lookahead is not None else 2 * self.pool.workers
+        self._futures: dict[int, Future] = {}
+        self._submitted = 0
+
+    def __enter__(self) -> "HeadingInfoPrefetcher":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _submit(self, idx: int) -> Future:
+        return self.pool.submit(
+            self.books[idx], self.kindle_root, self.cache_dir, self.heading_mode
+        )
+
+    def _submit_until(self, idx: int) -> None:
+        while self._submitted < min(idx, len(self.books)):
+            self._futures[self._submitted] = self._submit(self._submitted)
+            self._submitted += 1
+
+    def future(self, idx: int) -> Future:
+        """
+        Returns the future holding the heading info of `self.books[idx]`.
+        """
+        self._submit_until(idx + 1 + self.lookahead)
+        return self._futures.pop(idx)
+
+    def result(self, future: Future, book: models.Book) -> HeadingInfo:
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            # A worker died (most likely by hitting the memory limit), so
+            # every pending book has to be resubmitted to a fresh pool.
+            logger.error(
+                f"Heading worker crashed while processing {book.title}, restarting the pool"
+            )
+            self.pool.restart()
+            for idx in list(self._futures):
+                self._futures[idx] = self._submit(idx)
+        except Exception:
+            logger.error("An error occured in fetching headings", exc_info=True)
+        return [], [None for _ in range(len(book.highlights))]
+
+    def close(self) -> None:
+        if self._owns_pool:
+            self.pool.close()
+        else:
+            for future in self._futures.values():
+                future.cancel()
@@ -0,0 +1,210 @@
+import gzip
+import hashlib
+import heapq
+import json
+import os
+from datetime import datetime
+from typing import BinaryIO, Iterator, Optional, cast
+
+from pydantic import BaseModel
+
+from kindle2notion.caching import atomic_writer
+from kindle2notion.journaling import DEFAULT_JOURNAL_DIR
+from kindle2notion.package_logger import logger
+from kindle2notion.parsing import parse_added_on
+
+CLIPPING_SEPARATOR = b"=========="
+# A checkpoint remembers a digest of this many bytes before its offset, so a
+# file that was replaced or rewritten since is noticed
+CHECKPOINT_DIGEST_BYTES = 4096
+_READ_BUFFER_BYTES = 1 << 20
+
+
+def _decode_clipping(data: bytes) -> list[str]:
+    # Decoded like `read_raw_clippings`
+    text = data.decode("utf-8", errors="ignore").replace("\ufeff", "")
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text.encode("ascii", errors="ignore").decode().strip().split("\n")
+
+
+def open_clippings(clippings_file: str) -> BinaryIO:
+    """
+    Opens a clippings file, or a gzip compressed archive of one, for reading.
+    """
+    if clippings_file.endswith(".gz"):
+        return cast(BinaryIO, gzip.open(clippings_file, "rb"))
+    return open(clippings_file, "rb", buffering=_READ_BUFFER_BYTES)
+
+
+def iter_file_clippings(
+    clippings_file: str,
+) -> Iterator[tuple[list[str], int, int]]:
+    """
+    Streams the clippings of a file as their lines, along with the byte
+    offsets where each starts and where the next one starts. A clipping that
+    is still being written, without its separator, is left out.
+    """
+    with open_clippings(clippings_file) as f:
+        start = offset = 0
+        lines: list[bytes] = []
+        for line in f:
+            offset += len(line)
+            if line.strip() == CLIPPING_SEPARATOR:
+                yield _decode_clipping(b"".join(lines)), start, offset
+                start, lines = offset, []
+            else:
+                lines.append(line)
+
+
+class MergedClippings:
+    """
+    The clippings of several files, e.g. collected from several Kindles, as
+    one stream ordered by the date they were added. Every file is read
+    line by line and is already in date order, so a k-way merge holds only
+    one clipping per file at a time. Exact duplicates are dropped as they
+    pass: they were added at the same time, so it is enough to remember the
+    clippings of the current date.
+
+    Iterating yields the lines of every clipping and whether it starts at or
+    after the file's offset in `checkpoints`, i.e. is new. `end_offsets`
+    holds the offset every file was read up to once iteration is done.
+    Iterating again yields the same clippings: the files are only read up to
+    the offsets of the first iteration, clippings added since are left for
+    the next sync.
+    """
+
+    def __init__(
+        self,
+        clippings_files: list[str],
+        checkpoints: Optional[dict[str, int]] = None,
+    ) -> None:
+        self.clippings_files = clippings_files
+        self.checkpoints = checkpoints or {}
+        self.end_offsets: dict[str, int] = {}
+        # `end_offsets` of the first complete iteration
+        self._limits: Optional[dict[str, int]] = None
+        self.clippings = 0
+        self.duplicates = 0
+
+    def _iter_dated(
+        self, source: int, clippings_file: str
+    ) -> Iterator[tuple[datetime, int, list[str], bool]]:
+        checkpoint = self.checkpoints.get(clippings_file, 0)
+        limit = self._limits.get(clippings_file) if self._limits is not None else None
+        self.end_offsets[clippings_file] = 0
+        # Clippings without a readable date keep their place in the file
+        added = datetime.min
+        for lines, start, end in iter_file_clippings(clippings_file):
+            if limit is not None and end > limit:
+                break
+            if len(lines) >= 2:
+                added = parse_added_on(lines) or added
+            self.end_offsets[clippings_file] = end
+            yield added, source, lines, start >= checkpoint
+
+    def __iter__(self) -> Iterator[tuple[list[str], bool]]:
+        streams = [
+            self._iter_dated(source, clippings_file)
+            for source, clippings_file in enumerate(self.clippings_files)
+        ]
+        current_date = None
+        seen: set[tuple[str, ...]] = set()
+        self.clippings = self.duplicates = 0
+        for added, _, lines, is_new in heapq.merge(*streams, key=lambda c: c[0]):
+            if added != current_date:
+                current_date, seen = added, set()
+            key = tuple(lines)
+            if key in seen:
+                self.duplicates += 1
+                continue
+            seen.add(key)
+            self.clippings += 1
+            yield lines, is_new
+        if self._limits is not None:
+            return
+        self._limits = dict(self.end_offsets)
+        if len(self.clippings_files) > 1:
+            logger.info(
+                f"Merged {self.clippings} clippings from {len(self.clippings_files)} files, dropped {self.duplicates} duplicates.\n"
+            )
+
+
+class ClippingsCheckpoint(BaseModel):
+    # bytes of the file synced so far, and the digest of the bytes before
+    offset: int = 0
+    digest: str = ""
+
+
+def _tail_digest(clippings_file: str, offset: int) -> Optional[str]:
+    start = max(offset - CHECKPOINT_DIGEST_BYTES, 0)
+    try:
+        with open_clippings(clippings_file) as f:
+            f.seek(start)
+            data = f.read(offset - start)
+    except (OSError, EOFError):
+        return None
+    if len(data) != offset - start:
+        return None
+    return hashlib.sha1(data).hexdigest()
+
+
+class ClippingsState:
+    """
+    Durable per file checkpoints of the clippings synced to one destination
+    with one set of options. A checkpoint is the offset up to which a file
+    has been synced, it only holds while the bytes before it are unchanged.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.files: dict[str, ClippingsCheckpoint] = {}
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            self.files = {
+                clippings_file: ClippingsCheckpoint(**checkpoint)
+                for clippings_file, checkpoint in data["files"].items()
+            }
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    @classmethod
+    def for_sync(cls, key: dict, state_dir: Optional[str] = None) -> "ClippingsState":
+        """
+        Returns the state of the syncs identified by `key`, the destination
+        and every option that changes what is written there.
+        """
+        state_dir = os.path.expanduser(state_dir or DEFAULT_JOURNAL_DIR)
+        os.makedirs(state_dir, exist_ok=True)
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf-8"))
+        return cls(os.path.join(state_dir, f"clippings-{digest.hexdigest()[:12]}.json"))
+
+    def _save(self) -> None:
+        with atomic_writer(self.path) as f:
+            json.dump({"files": {p: c.dict() for p, c in self.files.items()}}, f)
+
+    def offsets(self, clippings_files: list[str]) -> dict[str, int]:
+        """
+        Returns the checkpoints of the files that still hold.
+        """
+        offsets = {}
+        for clippings_file in clippings_files:
+            checkpoint = self.files.get(os.path.abspath(clippings_file))
+            if checkpoint is None:
+                continue
+            if _tail_digest(clippings_file, checkpoint.offset) == checkpoint.digest:
+                offsets[clippings_file] = checkpoint.offset
+            else:
+                logger.info(
+                    f"{clippings_file} changed since the last sync, reading it all"
+                )
+        return offsets
+
+    def advance(self, end_offsets: dict[str, int]) -> None:
+        for clippings_file, offset in end_offsets.items():
+            digest = _tail_digest(clippings_file, offset)
+            if digest is not None:
+                self.files[os.path.abspath(clippings_file)] = ClippingsCheckpoint(
+                    offset=offset, digest=digest
+                )
+        self._save()
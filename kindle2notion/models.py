@@ -1,3 +1,4 @@
+import hashlib
 from datetime import datetime
 from typing import Optional
 
@@ -11,6 +12,17 @@ class Highlight(BaseModel):
     location: tuple[int, int]
     date: datetime
     is_note: bool
+    # The title the clipping was filed under, if it was grouped under the
+    # title of another edition. Locations only compare within an edition.
+    edition: Optional[str] = None
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        Stable identifier of a highlight across runs.
+        """
+        key = f"{self.location[0]}-{self.location[1]}|{self.is_note}|{self.text}"
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
 
     def make_aggregate_text(
         self, enable_location: bool, enable_highlight_date: bool
@@ -38,17 +50,21 @@ class Book(BaseModel):
     highlights: list[Highlight]
 
     def prune_subset_highlights(self):
-        sorted_highlights = sorted(
-            self.highlights, key=lambda x: (x.location[0], -x.location[1])
-        )
-        max_end_loc = 0
+        editions: dict[Optional[str], list[Highlight]] = {}
+        for highlight in self.highlights:
+            editions.setdefault(highlight.edition, []).append(highlight)
 
         filtered_highlights = []
-        for highlight in sorted_highlights:
-            end_loc = highlight.location[1]
-            if max_end_loc < end_loc:
-                filtered_highlights.append(highlight)
-            max_end_loc = end_loc
+        for highlights in editions.values():
+            sorted_highlights = sorted(
+                highlights, key=lambda x: (x.location[0], -x.location[1])
+            )
+            max_end_loc = 0
+            for highlight in sorted_highlights:
+                end_loc = highlight.location[1]
+                if max_end_loc < end_loc:
+                    filtered_highlights.append(highlight)
+                max_end_loc = end_loc
 
         if len(filtered_highlights) < len(self.highlights):
             logger.info(
@@ -62,8 +78,38 @@ class Book(BaseModel):
         all_timestamps = [h.date for h in self.highlights]
         return max(all_timestamps)
 
+    def content_digest(
+        self,
+        enable_location: bool,
+        enable_highlight_date: bool,
+        separate_blocks: bool,
+        page_layout: str = "flat",
+        heading_mode: Optional[str] = None,
+    ) -> str:
+        """
+        Digest of everything that ends up on the book's page: its (pruned)
+        highlights and the options they are rendered with. `heading_mode` is
+        the mode the headings are looked up with, None without a Kindle root.
+        """
+        digest = hashlib.sha256()
+        digest.update(
+            f"{self.title}|{self.author}|{enable_location:d}{enable_highlight_date:d}{separate_blocks:d}".encode()
+        )
+        if page_layout != "flat":
+            # Left out for the flat layout, so pages written before layouts
+            # existed keep their digest
+            digest.update(f"|{page_layout}".encode())
+        if heading_mode is not None:
+            # Left out without headings, for the same reason
+            digest.update(f"|headings={heading_mode}".encode())
+        for h in self.highlights:
+            digest.update(f"\0{h.fingerprint}|{h.page}|{h.date.isoformat()}".encode())
+        return digest.hexdigest()
+
 
 class BookHeading(BaseModel):
     title: str
     href: str
     position: int = -1
+    # nesting level of the entry in the toc, 0 for top level entries
+    depth: int = 0
@@ -3,8 +3,10 @@ from datetime import datetime
 import pydantic
 from kindle2notion import models
 from re import findall
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 from dateparser import parse
+from kindle2notion.filtering import BookFilter, BookIndexEntry
+from kindle2notion.grouping import TitleGrouper
 from kindle2notion.package_logger import logger
 
 BOOKS_WO_AUTHORS = []
@@ -84,8 +86,13 @@ ACADEMIC_TITLES = [
 
 DELIMITERS = ["; ", " & ", " and "]
 
+# "Added on" formats of English Kindles, tried before falling back to dateparser
+ADDED_ON_FORMATS = ["%A, %B %d, %Y %I:%M:%S %p", "%A, %d %B %Y %H:%M:%S"]
 
-def parse_raw_clippings_text(raw_clippings_text: str) -> Dict:
+
+def parse_raw_clippings_text(
+    raw_clippings_text: str, grouper: Optional[TitleGrouper] = None
+) -> Dict:
     raw_clippings_list = raw_clippings_text.split("==========")
     logger.info(
         f"Found [white on yellow]{len(raw_clippings_list)}[/white on yellow] notes and highlights.\n"
@@ -98,26 +105,17 @@ def parse_raw_clippings_text(raw_clippings_text: str) -> Dict:
         raw_clipping_list = each_raw_clipping.strip().split("\n")
 
         if _is_valid_clipping(raw_clipping_list):
-            author, title = _parse_author_and_title(raw_clipping_list)
-            page, location, date, is_note = _parse_page_location_date_and_note(
-                raw_clipping_list
+            author, title, edition = _parse_author_title_and_edition(
+                raw_clipping_list, grouper
             )
-            highlight = raw_clipping_list[3]
-
             if title not in all_books:
                 all_books[title] = models.Book(
                     title=title, author=author, highlights=[]
                 )
-            try:
-                highlight_pyd = models.Highlight(
-                    text=highlight,
-                    page=page,
-                    location=location,
-                    date=date,
-                    is_note=is_note,
-                )
-                all_books[title].highlights.append(highlight_pyd)
-            except pydantic.ValidationError:
+            highlight = _parse_highlight(raw_clipping_list, edition)
+            if highlight is not None:
+                all_books[title].highlights.append(highlight)
+            else:
                 passed_clippings_count += 1
 
         else:
@@ -139,15 +137,181 @@ def parse_raw_clippings_text(raw_clippings_text: str) -> Dict:
     return all_books
 
 
+def iter_complete_books(
+    raw_clippings_text: str,
+    grouper: Optional[TitleGrouper] = None,
+    book_filter: Optional[BookFilter] = None,
+) -> Iterator[models.Book]:
+    """
+    Parses the clippings in order and yields every book, pruned, as soon as
+    its last clipping has been parsed. See `iter_books_in_clippings`.
+    """
+    clippings = [
+        (raw_clipping.strip().split("\n"), True)
+        for raw_clipping in raw_clippings_text.split("==========")
+    ]
+    return iter_books_in_clippings(clippings, grouper, book_filter)
+
+
+def iter_books_in_clippings(
+    clippings: Iterable[Tuple[List[str], bool]],
+    grouper: Optional[TitleGrouper] = None,
+    book_filter: Optional[BookFilter] = None,
+    only_new: bool = False,
+) -> Iterator[models.Book]:
+    """
+    Yields the books of the clippings, given as their lines and whether they
+    are new, as soon as their last clipping has been parsed. `clippings` is
+    iterated twice and must yield the same clippings both times, e.g. a
+    `MergedClippings`, so they are never all held at once. A cheap first pass
+    over the title lines finds where every book's clippings end, the
+    expensive date parsing happens in the second pass. With a `grouper`, the
+    clippings of title variants are collected under one title.
+
+    The first pass also indexes every book with the date of its latest
+    clipping. Books `book_filter` rejects on that index are never parsed,
+    nor are books without any new clipping when `only_new` is set.
+    """
+    # (author, title, edition) of every clipping, None if it isn't parsed.
+    # Equal tuples are shared, so this stays small for large files.
+    authors_and_titles: list[Optional[Tuple[str, str, Optional[str]]]] = []
+    shared: dict[Tuple[str, str, Optional[str]], Tuple[str, str, Optional[str]]] = {}
+    last_clipping: dict[str, int] = {}
+    index: dict[str, BookIndexEntry] = {}
+    for idx, (raw_clipping_list, is_new) in enumerate(clippings):
+        author_and_title = None
+        if _is_valid_clipping(raw_clipping_list):
+            author_and_title = _parse_author_title_and_edition(
+                raw_clipping_list, grouper
+            )
+            author_and_title = shared.setdefault(author_and_title, author_and_title)
+            author, title, _ = author_and_title
+            last_clipping[title] = idx
+            if title not in index:
+                index[title] = BookIndexEntry(title=title, author=author)
+            entry = index[title]
+            entry.clippings += 1
+            if is_new:
+                entry.new_clippings += 1
+            if book_filter is not None and book_filter.needs_dates:
+                added = parse_added_on(raw_clipping_list)
+                if added is not None and (
+                    entry.last_added is None or added > entry.last_added
+                ):
+                    entry.last_added = added
+        authors_and_titles.append(author_and_title)
+    logger.info(
+        f"Found [white on yellow]{len(authors_and_titles)}[/white on yellow] notes and highlights.\n"
+    )
+
+    if book_filter is not None or only_new:
+        selected = {
+            t
+            for t, entry in index.items()
+            if (book_filter is None or book_filter.accepts(entry))
+            and (not only_new or entry.new_clippings > 0)
+        }
+        logger.info(
+            f"Selected {len(selected)} of {len(index)} books, skipping the others.\n"
+        )
+        authors_and_titles = [
+            a_t if a_t is None or a_t[1] in selected else None
+            for a_t in authors_and_titles
+        ]
+
+    books: dict[str, models.Book] = {}
+    passed_clippings_count = 0
+    for idx, ((raw_clipping_list, _), author_and_title) in enumerate(
+        zip(clippings, authors_and_titles)
+    ):
+        if author_and_title is None:
+            # clippings of books filtered out are not counted
+            if not _is_valid_clipping(raw_clipping_list):
+                passed_clippings_count += 1
+            continue
+        author, title, edition = author_and_title
+        if title not in books:
+            books[title] = models.Book(title=title, author=author, highlights=[])
+        highlight = _parse_highlight(raw_clipping_list, edition)
+        if highlight is not None:
+            books[title].highlights.append(highlight)
+        else:
+            passed_clippings_count += 1
+
+        if last_clipping[title] == idx:
+            book = books.pop(title)
+            if len(book.highlights) > 0:
+                book.prune_subset_highlights()
+                yield book
+
+    logger.warning(
+        f"[red]×[/red] Parsed {passed_clippings_count} bookmarks or unsupported clippings.\n"
+    )
+
+
+def _parse_highlight(
+    raw_clipping_list: List, edition: Optional[str] = None
+) -> Optional[models.Highlight]:
+    page, location, date, is_note = _parse_page_location_date_and_note(
+        raw_clipping_list
+    )
+    try:
+        return models.Highlight(
+            text=raw_clipping_list[3],
+            page=page,
+            location=location,
+            date=date,
+            is_note=is_note,
+            edition=edition,
+        )
+    except pydantic.ValidationError:
+        return None
+
+
+def parse_added_on(raw_clipping_list: List) -> Optional[datetime]:
+    """
+    Reads just the date of a clipping, with strptime where possible.
+    """
+    second_line = raw_clipping_list[1].lower()
+    if "added on" not in second_line:
+        return None
+    added_on = second_line[second_line.find("added on") :].replace("added on", "")
+    added_on = added_on.strip()
+    for date_format in ADDED_ON_FORMATS:
+        try:
+            return datetime.strptime(added_on, date_format)
+        except ValueError:
+            pass
+    return parse(added_on)
+
+
 def _is_valid_clipping(raw_clipping_list: List) -> bool:
     return len(raw_clipping_list) >= 3
 
 
-def _parse_author_and_title(raw_clipping_list: List) -> Tuple[str, str]:
+def _parse_author_and_title(
+    raw_clipping_list: List, grouper: Optional[TitleGrouper] = None
+) -> Tuple[str, str]:
+    author, title, _ = _parse_author_title_and_edition(raw_clipping_list, grouper)
+    return author, title
+
+
+def _parse_author_title_and_edition(
+    raw_clipping_list: List, grouper: Optional[TitleGrouper] = None
+) -> Tuple[str, str, Optional[str]]:
+    """
+    The edition is the title of the clipping if `grouper` filed it under
+    another title, None otherwise.
+    """
     author, title = _parse_raw_author_and_title(raw_clipping_list)
     author, title = _deal_with_exceptions_in_author_name(author, title)
     title = _deal_with_exceptions_in_title(title)
-    return author, title
+    edition = None
+    if grouper is not None:
+        grouped_title = grouper.group_title(title, author)
+        if grouped_title != title:
+            title, edition = grouped_title, title
+    return author, title, edition
 
 
 def _parse_page_location_date_and_note(
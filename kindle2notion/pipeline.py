@@ -0,0 +1,195 @@
+import queue
+import threading
+from functools import partial
+from typing import Callable, Optional, Union
+
+from kindle2notion import models
+from kindle2notion.compacting import with_archives
+from kindle2notion.exporters import (
+    Exporter,
+    export_book,
+    log_unchanged,
+    no_heading_info,
+)
+from kindle2notion.filtering import BookFilter
+from kindle2notion.grouping import TitleGrouper
+from kindle2notion.locating import HeadingInfo, HeadingWorkerPool, get_heading_info
+from kindle2notion.package_logger import logger
+from kindle2notion.merging import ClippingsState, MergedClippings
+from kindle2notion.parsing import iter_books_in_clippings
+
+# Books parsed but not yet enriched, and enriched but not yet uploaded. The
+# second bound also caps how many heading extractions run ahead of uploads.
+DEFAULT_QUEUE_SIZE = 4
+DEFAULT_UPLOAD_WORKERS = 2
+_DONE = object()
+_POLL_SECONDS = 0.1
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class _Stages:
+    """
+    Threads connected by bounded queues. The first error of any stage cancels
+    the others, and is re-raised by `join`.
+    """
+
+    def __init__(self) -> None:
+        self.failed = threading.Event()
+        self.error: Optional[BaseException] = None
+        self._threads: list[threading.Thread] = []
+
+    def start(self, name: str, target: Callable, *args) -> None:
+        def run() -> None:
+            try:
+                target(*args)
+            except _Cancelled:
+                pass
+            except BaseException as e:
+                if not self.failed.is_set():
+                    self.error = e
+                    self.failed.set()
+
+        thread = threading.Thread(target=run, name=f"kindle2notion-{name}", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def put(self, q: queue.Queue, item) -> None:
+        while not self.failed.is_set():
+            try:
+                q.put(item, timeout=_POLL_SECONDS)
+                return
+            except queue.Full:
+                pass
+        raise _Cancelled
+
+    def get(self, q: queue.Queue):
+        while not self.failed.is_set():
+            try:
+                return q.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                pass
+        raise _Cancelled
+
+    def join(self) -> None:
+        try:
+            for thread in self._threads:
+                thread.join()
+        except BaseException:
+            # e.g. KeyboardInterrupt, stop the stages before leaving
+            self.failed.set()
+            raise
+        if self.error is not None:
+            raise self.error
+
+
+def sync_clippings_file(
+    clippings_file: Union[str, list[str]],
+    exporter: Exporter,
+    kindle_root: Optional[str],
+    cache_dir: Optional[str] = None,
+    heading_workers: int = 2,
+    heading_worker_memory_mb: Optional[int] = None,
+    heading_mode: str = "text",
+    heading_pool: Optional[HeadingWorkerPool] = None,
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+    upload_workers: int = DEFAULT_UPLOAD_WORKERS,
+    grouper: Optional[TitleGrouper] = None,
+    select_book: Optional[Callable[[models.Book], bool]] = None,
+    book_filter: Optional[BookFilter] = None,
+    clippings_state: Optional[ClippingsState] = None,
+) -> int:
+    """
+    Exports the books of a clippings file as a pipeline of stages running
+    concurrently: read and parse (books are grouped and pruned as soon as
+    their last clipping is parsed), enrich (heading extraction is submitted
+    and the exporter prepares the book, e.g. fetches its cover) and upload.
+    The first book is written while later ones are still being parsed.
+    `grouper` collects the clippings of title variants under one title.
+    Books `book_filter` rejects are not even parsed, and books `select_book`
+    rejects or the exporter doesn't need to write again are dropped before
+    any enrichment.
+
+    `clippings_file` may be a list of files, which are merged into one stream
+    of clippings along with what was compacted out of them, see
+    `MergedClippings` and `compact_clippings`. With a `clippings_state`, only books
+    with clippings past the checkpoint of their file are synced, and the
+    checkpoints advance once every book has been written.
+    Returns how many books were written.
+    """
+    logger.info("Initiating transfer...\n")
+    owns_pool = heading_pool is None and kindle_root and heading_workers > 0
+    if owns_pool:
+        heading_pool = HeadingWorkerPool(heading_workers, heading_worker_memory_mb)
+    if not exporter.concurrent:
+        upload_workers = 1
+
+    stages = _Stages()
+    parsed: queue.Queue = queue.Queue(maxsize=queue_size)
+    enriched: queue.Queue = queue.Queue(maxsize=queue_size)
+    written = [0]
+    written_lock = threading.Lock()
+
+    clippings_files = with_archives(
+        [clippings_file] if isinstance(clippings_file, str) else clippings_file
+    )
+    merged = MergedClippings(
+        clippings_files,
+        clippings_state.offsets(clippings_files)
+        if clippings_state is not None
+        else None,
+    )
+
+    def parse() -> None:
+        # The files are read twice rather than held in memory
+        for book in iter_books_in_clippings(
+            merged, grouper, book_filter, only_new=clippings_state is not None
+        ):
+            if select_book is None or select_book(book):
+                stages.put(parsed, book)
+        stages.put(parsed, _DONE)
+
+    def enrich() -> None:
+        while (book := stages.get(parsed)) is not _DONE:
+            if not exporter.needs_writing(book):
+                log_unchanged(book)
+                continue
+            load_heading_info: Callable[[], HeadingInfo]
+            if heading_pool is not None and kindle_root:
+                load_heading_info = heading_pool.load(
+                    book, kindle_root, cache_dir, heading_mode
+                )
+            elif kindle_root:
+                load_heading_info = partial(
+                    get_heading_info, book, kindle_root, cache_dir, heading_mode
+                )
+            else:
+                load_heading_info = partial(no_heading_info, book)
+            exporter.prepare_book(book)
+            stages.put(enriched, (book, load_heading_info))
+        for _ in range(upload_workers):
+            stages.put(enriched, _DONE)
+
+    def upload() -> None:
+        while (item := stages.get(enriched)) is not _DONE:
+            book, load_heading_info = item
+            if export_book(exporter, book, load_heading_info):
+                with written_lock:
+                    written[0] += 1
+
+    try:
+        with exporter:
+            stages.start("parse", parse)
+            stages.start("enrich", enrich)
+            for idx in range(upload_workers):
+                stages.start(f"upload-{idx}", upload)
+            stages.join()
+    finally:
+        if owns_pool:
+            heading_pool.close()
+    # Books skipped by a filter or another shard are not synced yet
+    if clippings_state is not None and book_filter is None and select_book is None:
+        clippings_state.advance(merged.end_offsets)
+    return written[0]
@@ -1,19 +1,31 @@
-import glob
+import bisect
+import html
+import mmap
 import os
 import shutil
-import mobi
+from array import array
 from pathlib import Path
-from typing import Optional
+from typing import Iterator, Optional, Union
 import re
 from urllib.parse import unquote
-from bs4 import BeautifulSoup
-from bs4 import XMLParsedAsHTMLWarning
-import warnings
+from xml.etree import ElementTree
 
 from kindle2notion import models
+from kindle2notion.caching import ExtractionCache
+from kindle2notion.indexing import get_inventory
 from kindle2notion.package_logger import logger
 
-warnings.filterwarnings("ignore", category=XMLParsedAsHTMLWarning)
+NAV_FILE_NAMES = ("nav.xhtml", "nav.html", "toc.xhtml")
+
+_SEGMENT_RE = re.compile(rb"<!--.*?-->|<[^>]*>|&#?\w+;|[^<&]+|[<&]", re.S)
+_TAG_NAME_RE = re.compile(rb"<\s*/?\s*([A-Za-z][\w:.-]*)")
+_ANCHOR_RE = re.compile(rb'(?i)\b(?:id|name)\s*=\s*([\'"])(.*?)\1')
+_SPACE_RE = re.compile(r"\s+")
+# Tags that separate words even when there is no whitespace around them
+BLOCK_TAGS = set(
+    b"p div br hr h1 h2 h3 h4 h5 h6 li ul ol dd dt tr td th table blockquote "
+    b"section title body mbp:pagebreak".split()
+)
 
 
 def read_raw_clippings(clippings_file_path: Path) -> str:
@@ -30,84 +42,303 @@ def read_raw_clippings(clippings_file_path: Path) -> str:
     return raw_clippings_text_decoded
 
 
-def remove_special_characters(text):
-    # Replace all non-alphanumeric characters with an empty string
-    return re.sub(r"[^A-Za-z0-9]", "", text)
+CLIPPING_SEPARATOR = b"=========="
 
 
-def _preformat(text: str):
-    return remove_special_characters(text.lower().strip())
+def read_new_clippings(clippings_file_path: str, offset: int) -> tuple[str, int]:
+    """
+    Reads the complete clippings appended after byte `offset`, returning them
+    decoded like `read_raw_clippings` along with the offset to resume from.
+    """
+    with open(clippings_file_path, "rb") as raw_clippings_file:
+        raw_clippings_file.seek(offset)
+        data = raw_clippings_file.read()
 
+    # A clipping that is still being written is left for the next read
+    end = data.rfind(CLIPPING_SEPARATOR)
+    if end == -1:
+        return "", offset
+    end += len(CLIPPING_SEPARATOR)
+    while data[end : end + 1] in (b"\r", b"\n"):
+        end += 1
 
-def find_mobi_file(book: models.Book, kindle_root: str) -> Optional[str]:
-    all_books = glob.glob(os.path.join(kindle_root, "**/*.mobi"))
-    for search_by in [book.title, book.author]:
-        search_by = _preformat(search_by)
-        logger.info(
-            f"Searching mobi file with keyword: [white on dodger_blue1]{search_by}[/white on dodger_blue1]"
-        )
-        matching_books = [x for x in all_books if search_by in _preformat(x)]
-        if len(matching_books) == 1:
-            return matching_books[0]
+    raw_clippings_text = data[:end].decode("utf-8", errors="ignore")
+    raw_clippings_text = raw_clippings_text.replace("\ufeff", "")
+    raw_clippings_text_decoded = raw_clippings_text.encode(
+        "ascii", errors="ignore"
+    ).decode()
+    return raw_clippings_text_decoded, offset + end
+
+
+def find_mobi_file(
+    book: models.Book, kindle_root: str, cache_dir: Optional[str] = None
+) -> Optional[str]:
+    return get_inventory(kindle_root, cache_dir).lookup(book.title, book.author)
+
+
+# Anchors added for toc positions that have no id in the markup, the name
+# KindleUnpack gives them
+FILEPOS_ANCHOR = "filepos{}"
+
+
+class MobiText:
+    """
+    The text of a mobi book decompressed into memory: its html `parts` in
+    reading order, the toc read from the NCX index, with hrefs pointing to
+    `anchors` in those parts.
+    """
+
+    def __init__(
+        self,
+        parts: dict[str, bytes],
+        anchors: dict[str, dict[str, int]],
+        toc_entries: list[models.BookHeading],
+    ) -> None:
+        self.parts = parts
+        self.anchors = anchors
+        self.toc_entries = toc_entries
+
+
+def extract_mobi_text(path: str) -> Optional[MobiText]:
+    """
+    Decompresses the text records and reads the NCX index of a mobi7 or KF8
+    book without unpacking anything to disk. Images and other resources are
+    never decompressed. Returns None for books this can't handle (encrypted,
+    print replica), which have to be unpacked with `mobi.extract`.
+    """
+    # mobi is only imported when a book actually has to be unpacked
+    from mobi.kindleunpack import K8_BOUNDARY
+    from mobi.mobi_header import MobiHeader
+    from mobi.mobi_k8proc import K8Processor, locate_beg_end_of_tag
+    from mobi.mobi_ncx import ncxExtract
+    from mobi.mobi_sectioner import Sectionizer
+
+    sect = Sectionizer(path)
+    if sect.ident not in (b"BOOKMOBI", b"TEXtREAd"):
+        return None
+    mh = MobiHeader(sect, 0)
+    if not mh.isK8():
+        # Combination files hold a mobi7 and a KF8 part after a boundary
+        # section, `mobi.extract` unpacks the KF8 part so it is used here too
+        for i, (start, end) in enumerate(
+            zip(sect.sectionoffsets, sect.sectionoffsets[1:])
+        ):
+            if end - start == len(K8_BOUNDARY) and sect.loadSection(i) == K8_BOUNDARY:
+                mh = MobiHeader(sect, i + 1)
+                break
+    if mh.isEncrypted() or mh.isPrintReplica():
+        return None
+    raw_ml = mh.getRawML()
+    ncx = ncxExtract(mh, None).parseNCX() if mh.hasNCX() else []
+
+    # (part name, id in the markup or offset in the part) of every toc entry
+    targets: list[tuple[str, Union[str, int]]] = []
+    if mh.isK8():
+        k8proc = K8Processor(mh, sect, None)
+        k8proc.buildParts(raw_ml)
+        parts = {info[2]: part for info, part in zip(k8proc.partinfo, k8proc.parts)}
+        for entry in ncx:
+            if entry["pos_fid"] is None:
+                targets.append(("", -1))
+                continue
+            # Resolved like `mobi.extract` does, to the closest tag with an id
+            # before the position, or to the start of the part
+            _, _, _, fid, _, off = entry["pos_fid"].split(":")
+            file_name, id_tag = k8proc.getIDTagByPosFid(fid, off)
+            id_text = id_tag.decode("utf-8", "ignore")
+            if id_text.startswith("aid-"):
+                # Amazon's position ids, which `mobi.extract` turns into ids
+                start, _ = locate_beg_end_of_tag(parts.get(file_name, b""), id_text[4:])
+                targets.append((file_name or "", start))
+            else:
+                targets.append((file_name or "", id_text))
+    else:
+        if mh.codec != "utf-8":
+            # Offsets are into the encoded text, recompute them after transcoding
+            utf8_positions: dict[int, int] = {}
+            done = utf8_len = 0
+            for pos in sorted({e["pos"] for e in ncx if e["pos"] >= 0}):
+                utf8_len += len(raw_ml[done:pos].decode(mh.codec, "replace").encode())
+                utf8_positions[pos], done = utf8_len, pos
+            raw_ml = raw_ml.decode(mh.codec, "replace").encode("utf-8")
+            for entry in ncx:
+                entry["pos"] = utf8_positions.get(entry["pos"], -1)
+        parts = {"book.html": raw_ml}
+        targets = [("book.html", entry["pos"]) for entry in ncx]
+
+    anchors: dict[str, dict[str, int]] = {name: {} for name in parts}
+    toc_entries = []
+    for entry, (file_name, target) in zip(ncx, targets):
+        if file_name not in parts:
+            continue
+        if isinstance(target, str):
+            href = f"{file_name}#{target}" if target else file_name
+        elif target >= 0:
+            anchor = FILEPOS_ANCHOR.format(target)
+            anchors[file_name][anchor] = target
+            href = f"{file_name}#{anchor}"
         else:
-            logger.warning(
-                f"Attempt to search failed. Matching candidates: {matching_books}"
+            continue
+        toc_entries.append(
+            models.BookHeading(
+                title=entry["text"].strip(),
+                href=href,
+                depth=max(entry["hlvl"], 0),
             )
+        )
+    return MobiText(parts, anchors, toc_entries)
 
 
 class MobiHandler:
-    # --- Build TOC positions by locating anchors in the raw HTML string ---
-    ANCHOR_RE_TEMPLATE = r'(?i)\b(?:id|name)\s*=\s*([\'"])%s\1'
+    HTML_EXTENSIONS = (".html", ".htm", ".xhtml")
 
-    def __init__(self, path: str) -> None:
+    def __init__(self, path: str, cache: Optional[ExtractionCache] = None) -> None:
         self.path = path
+        self.cache = cache
+        # set when the text was decompressed in memory instead of unpacked
+        self.mobi_text: Optional[MobiText] = None
         # tuple of (parent directory, html file path)
-        self.html_dir: Optional[str]
-        self.html_file_path: Optional[str]
-        self.toc_entries: Optional[list[models.BookHeading]]
+        self.html_dir: Optional[str] = None
+        self.html_file_path: Optional[str] = None
+        self.toc_entries: Optional[list[models.BookHeading]] = None
+        # TOC hrefs are relative to the directory of the toc file
+        self.toc_dir: Optional[str] = None
+        self.book_text: Optional[BookText] = None
+        # Cached extractions are shared between runs and must not be removed
+        self._owns_html_dir = False
 
     def process(self) -> list[models.BookHeading]:
         """
         Will raise an exception if something went wrong
         """
-        self.extract_to_html()
+        if not self.extract_in_memory():
+            self.extract_to_html()
+        if self.cache is not None:
+            self.toc_entries = self.cache.get_headings(self.path)
+            if self.toc_entries is not None:
+                return self.toc_entries
         self.parse_toc_ncx()
         self.build_toc_positions_for_html()
         assert self.toc_entries is not None
+        if self.cache is not None:
+            self.cache.put_headings(self.path, self.toc_entries)
         return self.toc_entries
 
+    def extract_in_memory(self) -> bool:
+        """
+        Decompresses the text of the book into memory, returns False if the
+        book has to be unpacked to disk with `extract_to_html` instead.
+        """
+        try:
+            self.mobi_text = extract_mobi_text(self.path)
+        except Exception:
+            logger.debug("In memory extraction failed", exc_info=True)
+            self.mobi_text = None
+        if self.mobi_text is None:
+            return False
+        self.html_file_path = next(iter(self.mobi_text.parts), None)
+        self.toc_dir = ""
+        return True
+
     def extract_to_html(self):
+        if self.cache is not None:
+            cached = self.cache.get(self.path)
+            if cached is not None:
+                self.html_dir, self.html_file_path = cached
+                return
+        # mobi is only imported when a book actually has to be unpacked
+        import mobi
+
         try:
-            self.html_dir, self.html_file_path = mobi.extract(self.path)
+            html_dir, html_file_path = mobi.extract(self.path)
         except Exception as e:
             logger.error("An error occured in extraction to html")
             raise e
+        if self.cache is None:
+            self.html_dir, self.html_file_path = html_dir, html_file_path
+            self._owns_html_dir = True
+            return
+        try:
+            self.html_dir, self.html_file_path = self.cache.put(
+                self.path, html_dir, html_file_path
+            )
+        finally:
+            shutil.rmtree(html_dir, ignore_errors=True)
 
-    # --- Parse toc.ncx with html.parser ---
-    def parse_toc_ncx(self):
+    def find_toc_file(self) -> Optional[str]:
+        """
+        Returns the toc of the extracted book: the `toc.ncx` of the mobi7 or
+        KF8 part that the main file belongs to, or an EPUB3 nav document.
+        """
         assert self.html_dir is not None, "No html dir found, aborting"
-        # FIXME: hardcoding mobi7 for now
-        ncx_path = os.path.join(self.html_dir, "mobi7", "toc.ncx")
-        with open(ncx_path, "r", errors="ignore") as f:
-            soup = BeautifulSoup(f.read(), "html.parser")
-
-        entries = []
-        for np in soup.find_all("navpoint"):
-            # <navPoint><navLabel><text>Title</text></navLabel><content src="chapter.html#anchor"/></navPoint>
-            label_wrap = np.find("navlabel")
-            label_tag = label_wrap.find("text") if label_wrap else None
-            content_tag = np.find("content")
-            if label_tag and content_tag and content_tag.get("src"):
-                title = label_tag.get_text(strip=True)
-                href = content_tag["src"]
-                entries.append(models.BookHeading(**{"title": title, "href": href}))
-
-        self.toc_entries = entries
+        assert self.html_file_path is not None
+        main_dir = os.path.dirname(self.html_file_path)
+        for search_dir in [main_dir, self.html_dir]:
+            nav_path = None
+            for dir_path, _, file_names in os.walk(search_dir):
+                for file_name in sorted(file_names):
+                    if file_name.lower().endswith(".ncx"):
+                        return os.path.join(dir_path, file_name)
+                    if nav_path is None and file_name.lower() in NAV_FILE_NAMES:
+                        nav_path = os.path.join(dir_path, file_name)
+            if nav_path is not None:
+                return nav_path
+        return None
+
+    def parse_toc_ncx(self):
+        if self.mobi_text is not None:
+            self.toc_entries = [e.copy() for e in self.mobi_text.toc_entries]
+            return
+        toc_path = self.find_toc_file()
+        assert toc_path is not None, "No toc.ncx or nav document found, aborting"
+        self.toc_dir = os.path.dirname(toc_path)
+        if toc_path.lower().endswith(".ncx"):
+            self.toc_entries = list(iter_ncx_entries(toc_path))
+        else:
+            self.toc_entries = list(iter_nav_entries(toc_path))
+
+    def book_files(self) -> list[str]:
+        """
+        Returns the extracted html files of the book in reading order. The
+        positions of headings are offsets into the concatenation of these files.
+        """
+        if self.mobi_text is not None:
+            return list(self.mobi_text.parts)
+        assert self.html_dir is not None and self.html_file_path is not None
+        main_dir = os.path.dirname(self.html_file_path)
+        # Prefer the package next to the main file, books with both a mobi7
+        # and a KF8 part have one package for each
+        for search_dir in [main_dir, self.html_dir]:
+            for dir_path, _, file_names in os.walk(search_dir):
+                for file_name in file_names:
+                    if file_name.lower().endswith(".opf"):
+                        spine = _read_opf_spine(os.path.join(dir_path, file_name))
+                        if spine:
+                            return spine
+
+        others = sorted(
+            os.path.join(main_dir, f)
+            for f in os.listdir(main_dir)
+            if f.lower().endswith(self.HTML_EXTENSIONS)
+            and os.path.join(main_dir, f) != self.html_file_path
+        )
+        return [self.html_file_path] + others
+
+    def get_book_text(self) -> "BookText":
+        if self.book_text is None:
+            if self.mobi_text is not None:
+                self.book_text = BookText(
+                    self.book_files(), self.mobi_text.parts, self.mobi_text.anchors
+                )
+            else:
+                self.book_text = BookText(self.book_files())
+        return self.book_text
 
     def build_toc_positions_for_html(self):
         """
-        Returns sorted list of (title, index) for toc entries that point into this html_str.
-        If toc href has a different filename than current_filename, it's ignored here.
+        Sets the position of every toc entry to the offset of its anchor in the
+        concatenated html of the book. Anchors of all files are indexed while
+        scanning the book text, so entries are resolved by lookup.
         """
         assert self.toc_entries is not None and len(self.toc_entries) > 0, (
             "no toc found, skipping title matching"
@@ -116,31 +347,247 @@ class MobiHandler:
             "converted html file not found, skipping title matching"
         )
 
-        html_str = open(self.html_file_path, "r", errors="ignore").read()
-        current_filename = os.path.basename(self.html_file_path)
+        anchor_index = self.get_book_text().anchors
 
+        toc_dir = self.toc_dir or os.path.dirname(self.html_file_path)
         for e in self.toc_entries:
-            href = e.href
-            file_part = None
-            frag = None
-            if "#" in href:
-                file_part, frag = href.split("#", 1)
+            file_part, _, frag = e.href.partition("#")
+            if file_part:
+                target = os.path.normpath(os.path.join(toc_dir, unquote(file_part)))
             else:
-                file_part = href
-                frag = None
-
-            # If the TOC points to a different file, skip (or load that file separately).
-            if file_part and current_filename and file_part != current_filename:
+                target = os.path.normpath(self.html_file_path)
+            if target not in anchor_index:
                 continue
 
+            file_base, anchors = anchor_index[target]
             if frag:
-                anchor = unquote(frag)
-                # Match id="anchor" or name="anchor" in any tag
-                pattern = re.compile(self.ANCHOR_RE_TEMPLATE % re.escape(anchor))
-                m = pattern.search(html_str)
-                if m:
-                    e.position = m.start()
+                position = anchors.get(unquote(frag), anchors.get(frag))
+                if position is not None:
+                    e.position = position
+            else:
+                e.position = file_base
 
     def __del__(self):
-        if self.html_dir is not None and os.path.exists(self.html_dir):
+        if self.book_text is not None:
+            self.book_text.close()
+        if (
+            self._owns_html_dir
+            and self.html_dir is not None
+            and os.path.exists(self.html_dir)
+        ):
             shutil.rmtree(self.html_dir)
+
+
+class BookText:
+    """
+    The text of an extracted book, shared by anchor resolution and highlight
+    matching.
+
+    The html files are memory mapped and scanned once. The scan produces a
+    tag stripped, entity decoded and whitespace collapsed `text`, the offset
+    of every id/name anchor, and a compact map from `text` offsets back to
+    byte offsets in the concatenated html. The map has one entry per run of
+    text between two tags; offsets inside a run are exact up to collapsed
+    whitespace and multibyte characters.
+    """
+
+    def __init__(
+        self,
+        paths: list[str],
+        contents: Optional[dict[str, bytes]] = None,
+        anchors: Optional[dict[str, dict[str, int]]] = None,
+    ) -> None:
+        """
+        `contents` holds the html of files that only exist in memory, and
+        `anchors` offsets of anchors that are not in the markup, by file.
+        """
+        self.paths = paths
+        # normalized file path -> (offset of the file, anchor -> offset)
+        self.anchors: dict[str, tuple[int, dict[str, int]]] = {}
+        self._maps: list[mmap.mmap] = []
+        self._text_starts = array("q")
+        self._html_starts = array("q")
+
+        pieces: list[str] = []
+        text_len = 0
+        last_is_space = True
+        base = 0
+        for path in paths:
+            file_anchors = {
+                name: base + offset
+                for name, offset in (anchors or {}).get(path, {}).items()
+            }
+            if contents is not None and path in contents:
+                data = contents[path]
+            else:
+                with open(path, "rb") as f:
+                    if os.fstat(f.fileno()).st_size == 0:
+                        data = b""
+                    else:
+                        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                        self._maps.append(data)
+            size = len(data)
+
+            pending_space = True
+            for m in _SEGMENT_RE.finditer(data):
+                segment = m.group()
+                if len(segment) > 1 and segment[:1] == b"<":
+                    if segment.startswith(b"<!--"):
+                        continue
+                    for a in _ANCHOR_RE.finditer(segment):
+                        file_anchors.setdefault(
+                            a.group(2).decode("utf-8", "ignore"),
+                            base + m.start() + a.start(),
+                        )
+                    name = _TAG_NAME_RE.match(segment)
+                    if name and name.group(1).lower() in BLOCK_TAGS:
+                        pending_space = True
+                    continue
+
+                if len(segment) > 1 and segment[:1] == b"&":
+                    piece = html.unescape(segment.decode("ascii", "ignore"))
+                else:
+                    piece = segment.decode("utf-8", "ignore")
+                piece = _SPACE_RE.sub(" ", piece)
+                if pending_space and not last_is_space:
+                    piece = " " + piece.lstrip(" ")
+                elif last_is_space:
+                    piece = piece.lstrip(" ")
+                pending_space = False
+                if not piece:
+                    continue
+
+                self._text_starts.append(text_len)
+                self._html_starts.append(base + m.start())
+                pieces.append(piece)
+                text_len += len(piece)
+                last_is_space = piece.endswith(" ")
+
+            self.anchors[os.path.normpath(path)] = (base, file_anchors)
+            base += size
+
+        self.text = "".join(pieces)
+        self.html_size = base
+
+    def html_offset(self, text_offset: int) -> int:
+        """
+        Maps an offset in `text` to a byte offset in the concatenated html.
+        """
+        run = bisect.bisect_right(self._text_starts, text_offset) - 1
+        if run < 0:
+            return 0
+        html_offset = self._html_starts[run] + text_offset - self._text_starts[run]
+        if run + 1 < len(self._html_starts):
+            html_offset = min(html_offset, self._html_starts[run + 1] - 1)
+        return html_offset
+
+    def close(self) -> None:
+        for mm in self._maps:
+            mm.close()
+        self._maps = []
+
+
+def _read_opf_spine(opf_path: str) -> list[str]:
+    """
+    Returns the files listed in the spine of an OPF package, in reading order.
+    """
+    try:
+        root = ElementTree.parse(opf_path).getroot()
+    except ElementTree.ParseError:
+        return []
+    manifest = {}
+    spine = []
+    for elem in root.iter():
+        tag = elem.tag.rsplit("}", 1)[-1]
+        if tag == "item" and elem.get("id") and elem.get("href"):
+            manifest[elem.get("id")] = elem.get("href")
+        elif tag == "itemref" and elem.get("idref"):
+            spine.append(elem.get("idref"))
+    opf_dir = os.path.dirname(opf_path)
+    files = []
+    for idref in spine:
+        if idref in manifest:
+            path = os.path.join(opf_dir, unquote(manifest[idref]))
+            if os.path.exists(path):
+                files.append(os.path.normpath(path))
+    return files
+
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1].lower()
+
+
+def iter_ncx_entries(ncx_path: str) -> Iterator[models.BookHeading]:
+    """
+    Streams the navPoints of a `toc.ncx` in document order, along with their
+    nesting depth. Finished navPoints are cleared, so memory stays flat.
+    """
+    # <navPoint><navLabel><text>Title</text></navLabel><content src="chapter.html#anchor"/></navPoint>
+    # one [title, href] pair per open navPoint
+    open_points: list[list[Optional[str]]] = []
+    in_label = False
+    try:
+        for event, elem in ElementTree.iterparse(ncx_path, events=("start", "end")):
+            tag = _local_name(elem.tag)
+            if event == "start":
+                if tag == "navpoint":
+                    open_points.append([None, None])
+                elif tag == "navlabel":
+                    in_label = True
+                continue
+
+            if tag == "navlabel":
+                in_label = False
+            elif tag == "text" and in_label and open_points:
+                open_points[-1][0] = "".join(elem.itertext()).strip()
+            elif tag == "content" and open_points and elem.get("src"):
+                title, href = open_points[-1][0], elem.get("src")
+                open_points[-1][1] = href
+                if title is not None:
+                    yield models.BookHeading(
+                        title=title, href=href, depth=len(open_points) - 1
+                    )
+            elif tag == "navpoint":
+                open_points.pop()
+                elem.clear()
+    except ElementTree.ParseError:
+        logger.warning(f"Stopped reading malformed toc at {ncx_path}", exc_info=True)
+
+
+def iter_nav_entries(nav_path: str) -> Iterator[models.BookHeading]:
+    """
+    Streams the links of the toc `<nav>` of an EPUB3 nav document, along
+    with their nesting depth.
+    """
+    # <nav epub:type="toc"><ol><li><a href="chapter.xhtml#anchor">Title</a><ol>...</ol></li></ol></nav>
+    in_toc = False
+    list_depth = 0
+    try:
+        for event, elem in ElementTree.iterparse(nav_path, events=("start", "end")):
+            tag = _local_name(elem.tag)
+            if tag == "nav":
+                nav_type = next(
+                    (v for k, v in elem.attrib.items() if _local_name(k) == "type"),
+                    None,
+                )
+                if event == "start":
+                    in_toc = nav_type == "toc"
+                else:
+                    in_toc = False
+                    elem.clear()
+                continue
+            if not in_toc:
+                continue
+
+            if tag == "ol":
+                list_depth += 1 if event == "start" else -1
+            elif tag == "a" and event == "end" and elem.get("href"):
+                yield models.BookHeading(
+                    title="".join(elem.itertext()).strip(),
+                    href=elem.get("href"),
+                    depth=max(list_depth - 1, 0),
+                )
+            elif tag == "li" and event == "end":
+                elem.clear()
+    except ElementTree.ParseError:
+        logger.warning(f"Stopped reading malformed toc at {nav_path}", exc_info=True)
@@ -0,0 +1,150 @@
+import json
+from functools import lru_cache
+from typing import Any, Optional
+
+import httpx
+import notional
+from notion_client.errors import HTTPResponseError, RequestTimeoutError
+from notional.text import MAX_TEXT_OBJECT_SIZE, TextObject
+
+# Stands in for the parts of a payload that are rendered separately. It is
+# only ever placed in templates, never in the text of a book.
+_SLOT = "\x00kindle2notion\x00"
+
+
+class RawBlock:
+    """
+    A block rendered straight to the JSON of the Notion API. `id` is set
+    once the block has been appended to a page, like notional's blocks.
+    """
+
+    __slots__ = ("json", "id")
+
+    def __init__(self, json: str) -> None:
+        self.json = json
+        self.id: Optional[str] = None
+
+
+@lru_cache(maxsize=None)
+def _json_options() -> tuple[bool, tuple[str, str]]:
+    # The request body encoding differs between httpx versions, the payloads
+    # have to match whichever one sends the model path's requests
+    body = httpx.Request("POST", "http://localhost", json={"a": ["é", 1]}).content
+    text = body.decode("utf-8")
+    item_separator = ", " if '", 1' in text else ","
+    key_separator = ": " if '": ' in text else ":"
+    return "\\u00e9" in text, (item_separator, key_separator)
+
+
+def encode(value: Any) -> str:
+    """
+    Encodes `value` the way httpx encodes JSON request bodies.
+    """
+    ensure_ascii, separators = _json_options()
+    return json.dumps(
+        value, ensure_ascii=ensure_ascii, separators=separators, allow_nan=False
+    )
+
+
+def _split_on_slot(value: Any) -> list[str]:
+    return encode(value).split(encode(_SLOT))
+
+
+def splice(value: dict, key: str, items: list[str]) -> str:
+    """
+    Encodes `value` with the list under `key` made of already encoded `items`.
+    """
+    head, tail = _split_on_slot({**value, key: [_SLOT]})
+    return head + _json_options()[1][0].join(items) + tail
+
+
+@lru_cache(maxsize=None)
+def _text_template() -> tuple[str, str, str]:
+    # {"type": "text", "plain_text": ..., "text": {"content": ...}}
+    text = TextObject["x"].dict()
+    text["plain_text"] = _SLOT
+    text["text"]["content"] = _SLOT
+    head, middle, tail = _split_on_slot(text)
+    return head, middle, tail
+
+
+@lru_cache(maxsize=None)
+def _block_template(block_type: type) -> tuple[str, str]:
+    block = block_type["x"].dict()
+    block[block["type"]]["rich_text"] = [_SLOT]
+    head, tail = _split_on_slot(block)
+    return head, tail
+
+
+def rich_text(text: str) -> str:
+    """
+    Renders the items of a rich text list, split into text objects of the
+    most characters the API accepts like notional does. Every chunk is
+    escaped once for both of the fields holding it.
+    """
+    head, middle, tail = _text_template()
+    objects = []
+    for idx in range(0, len(text), MAX_TEXT_OBJECT_SIZE):
+        chunk = encode(text[idx : idx + MAX_TEXT_OBJECT_SIZE])
+        objects.append(head + chunk + middle + chunk + tail)
+    return _json_options()[1][0].join(objects)
+
+
+def render(block_type: type, text: str) -> RawBlock:
+    """
+    Renders the payload `block_type[text]` would serialize to, e.g. for
+    `Quote`, `Heading2` or `Paragraph`, without building the model.
+    """
+    head, tail = _block_template(block_type)
+    return RawBlock(head + rich_text(text) + tail)
+
+
+def send(notion: notional.session.Session, method: str, path: str, body: str) -> Any:
+    """
+    Sends an already encoded request body through the session's client, so
+    it is rate limited and its errors are raised like any other request.
+    """
+    client = notion.client
+    request = client.client.build_request(
+        method,
+        path,
+        content=body.encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    try:
+        response = client.client.send(request)
+    except httpx.TimeoutException:
+        raise RequestTimeoutError()
+    return _parse_response(client, response)
+
+
+def _parse_response(client: Any, response: httpx.Response) -> Any:
+    # notion-client has no public way to send a request built elsewhere, its
+    # private parser is the only place API errors are raised from (2.x). A
+    # client without it gets HTTP errors, rather than API errors, raised.
+    parse = getattr(client, "_parse_response", None)
+    if parse is not None:
+        return parse(response)
+    try:
+        response.raise_for_status()
+    except httpx.HTTPStatusError as error:
+        raise HTTPResponseError(error.response)
+    return response.json()
+
+
+def append_blocks(
+    notion: notional.session.Session, parent_id: str, blocks: list[RawBlock]
+) -> None:
+    """
+    Appends the blocks to `parent_id` in one request, and sets their ids.
+    """
+    data = send(
+        notion,
+        "PATCH",
+        f"blocks/{parent_id}/children",
+        splice({}, "children", [block.json for block in blocks]),
+    )
+    results = data.get("results", [])
+    if len(results) == len(blocks):
+        for block, result in zip(blocks, results):
+            block.id = result.get("id")
@@ -0,0 +1,387 @@
+import hashlib
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional, Union
+
+from pydantic import BaseModel
+
+from kindle2notion import models
+from kindle2notion.caching import atomic_writer
+from kindle2notion.exporters import Exporter
+from kindle2notion.indexing import normalize_key
+from kindle2notion.locating import HeadingInfo
+from kindle2notion.package_logger import logger
+from kindle2notion.pipeline import sync_clippings_file
+
+# A lease not renewed for this long belongs to a worker that died
+DEFAULT_LEASE_SECONDS = 600.0
+SUMMARY_FILE_NAME = "summary.json"
+
+
+def book_key(book: models.Book) -> str:
+    """
+    A key of the book that is the same on every host and for every title
+    variant spelled with different punctuation or case.
+    """
+    key = f"{normalize_key(book.title)}\0{normalize_key(book.author)}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def shard_of(book: models.Book, shard_count: int) -> int:
+    return int(book_key(book)[:16], 16) % shard_count
+
+
+def default_run_id(clippings_files: list[str]) -> str:
+    """
+    A run id shared by the workers syncing the same clippings, for runs not
+    given one.
+    """
+    digest = hashlib.sha1()
+    for clippings_file in clippings_files:
+        with open(clippings_file, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+class ShardSummary(BaseModel):
+    shard_index: int
+    shard_count: int
+    worker: str
+    run_id: Optional[str] = None
+    books_assigned: int = 0
+    books_written: int = 0
+    books_unchanged: int = 0
+    # books leased by another worker, e.g. one run with a different shard count
+    books_leased_elsewhere: int = 0
+    seconds: float = 0.0
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class ShardCoordinator:
+    """
+    Coordinates the workers of a sharded sync through files in `shard_dir`,
+    a directory on storage shared by all of them.
+
+    Every worker only takes the books whose key hashes to its shard. Before a
+    book is written the worker creates `leases/<key>`, exclusively, so no
+    book is ever written by two workers at once even if shards overlap. The
+    lease is renewed while the book is written, a lease not renewed for
+    `lease_seconds` is broken. A book written in the run `run_id` is marked
+    in `done/<run_id>/<key>` before its lease is released, so a worker that
+    gets the lease after it doesn't write the book again, even though it
+    found the book had to be written before. Each worker writes its summary to
+    `summaries/`, and the last one of the run `run_id` to finish merges the
+    summaries of that run into `summary.json`.
+    """
+
+    def __init__(
+        self,
+        shard_dir: str,
+        shard_index: int,
+        shard_count: int,
+        lease_seconds: float = DEFAULT_LEASE_SECONDS,
+        worker: Optional[str] = None,
+        run_id: Optional[str] = None,
+    ) -> None:
+        if not 0 <= shard_index < shard_count:
+            raise ValueError(
+                f"Shard index {shard_index} is not in [0, {shard_count}) shards"
+            )
+        self.shard_dir = shard_dir
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.lease_seconds = lease_seconds
+        self.worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+        self.run_id = run_id
+        self.lease_dir = os.path.join(shard_dir, "leases")
+        self.summary_dir = os.path.join(shard_dir, "summaries")
+        self.done_dir = (
+            os.path.join(shard_dir, "done", run_id) if run_id is not None else None
+        )
+        os.makedirs(self.lease_dir, exist_ok=True)
+        os.makedirs(self.summary_dir, exist_ok=True)
+        # A summary left by an earlier run of this shard must not be merged
+        try:
+            os.unlink(self._summary_path(shard_index))
+        except FileNotFoundError:
+            pass
+
+    def _summary_path(self, shard_index: int) -> str:
+        return os.path.join(self.summary_dir, f"shard-{shard_index}.json")
+
+    def owns(self, book: models.Book) -> bool:
+        return shard_of(book, self.shard_count) == self.shard_index
+
+    def _lease_path(self, key: str) -> str:
+        return os.path.join(self.lease_dir, key)
+
+    def acquire(self, key: str) -> bool:
+        """
+        Takes the lease of a book, returns False if another worker holds it.
+        """
+        path = self._lease_path(key)
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if not self._break_stale_lease(path):
+                    return False
+                continue
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"worker": self.worker, "acquired": time.time()}, f)
+            return True
+        return False
+
+    def _break_stale_lease(self, path: str) -> bool:
+        try:
+            age = time.time() - os.stat(path).st_mtime
+        except FileNotFoundError:
+            return True
+        if age < self.lease_seconds:
+            return False
+        # Only one of the workers breaking the lease at once wins the rename
+        stale_path = f"{path}.stale-{self.worker}"
+        try:
+            os.rename(path, stale_path)
+        except FileNotFoundError:
+            return False
+        if time.time() - os.stat(stale_path).st_mtime < self.lease_seconds:
+            # Another worker broke it first and already holds a fresh lease
+            os.rename(stale_path, path)
+            return False
+        os.unlink(stale_path)
+        logger.warning(f"Broke the stale lease {os.path.basename(path)}")
+        return True
+
+    def renew(self, key: str) -> None:
+        try:
+            os.utime(self._lease_path(key))
+        except FileNotFoundError:
+            logger.warning(f"The lease {key} was lost while the book was written")
+
+    @contextmanager
+    def hold(self, key: str) -> Iterator[None]:
+        """
+        Renews the lease of a book in the background until the block exits,
+        so a book written for longer than `lease_seconds` keeps its lease.
+        """
+        done = threading.Event()
+
+        def heartbeat() -> None:
+            while not done.wait(self.lease_seconds / 4):
+                self.renew(key)
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            done.set()
+            thread.join()
+
+    def is_done(self, key: str) -> bool:
+        """
+        Whether the book was written by a worker of this run, only known for
+        runs with a `run_id`.
+        """
+        return self.done_dir is not None and os.path.exists(
+            os.path.join(self.done_dir, key)
+        )
+
+    def mark_done(self, key: str) -> None:
+        if self.done_dir is None:
+            return
+        os.makedirs(self.done_dir, exist_ok=True)
+        with open(os.path.join(self.done_dir, key), "w", encoding="utf-8") as f:
+            f.write(self.worker)
+
+    def release(self, key: str) -> None:
+        try:
+            os.unlink(self._lease_path(key))
+        except FileNotFoundError:
+            pass
+
+    def finish(self, summary: ShardSummary) -> Optional[dict]:
+        """
+        Records the summary of this worker. Returns the merged summary if
+        every shard of this run has finished, which is then also written to
+        `summary.json`.
+        """
+        summary.run_id = self.run_id
+        with atomic_writer(self._summary_path(self.shard_index)) as f:
+            json.dump(summary.dict(), f)
+
+        summaries = []
+        for shard_index in range(self.shard_count):
+            try:
+                with open(self._summary_path(shard_index), encoding="utf-8") as f:
+                    summaries.append(ShardSummary(**json.load(f)))
+            except (OSError, ValueError):
+                return None
+            # A summary of an earlier run, this shard hasn't finished yet
+            if (
+                summaries[-1].shard_count != self.shard_count
+                or summaries[-1].run_id != self.run_id
+            ):
+                return None
+        merged = merge_summaries(summaries)
+        with atomic_writer(os.path.join(self.shard_dir, SUMMARY_FILE_NAME)) as f:
+            json.dump(merged, f, indent=2)
+        if self.done_dir is not None:
+            # Every shard of the run is done writing
+            shutil.rmtree(self.done_dir, ignore_errors=True)
+        return merged
+
+
+def merge_summaries(summaries: list[ShardSummary]) -> dict:
+    totals = {
+        field: sum(getattr(s, field) for s in summaries)
+        for field in (
+            "books_assigned",
+            "books_written",
+            "books_unchanged",
+            "books_leased_elsewhere",
+        )
+    }
+    return {
+        **totals,
+        "seconds": max((s.seconds for s in summaries), default=0.0),
+        "failed_shards": [s.shard_index for s in summaries if not s.ok],
+        "shards": [s.dict() for s in summaries],
+    }
+
+
+def log_merged_summary(merged: dict) -> None:
+    for shard in merged["shards"]:
+        if shard["error"] is None:
+            logger.info(
+                f"[green]✓[/green] shard {shard['shard_index']} ({shard['worker']}): {shard['books_written']} of {shard['books_assigned']} books written in {shard['seconds']:.1f}s"
+            )
+        else:
+            logger.error(
+                f"[red]×[/red] shard {shard['shard_index']} ({shard['worker']}): failed after {shard['seconds']:.1f}s ({shard['error']})"
+            )
+    logger.info(
+        f"{merged['books_written']} of {merged['books_assigned']} books written, {merged['books_unchanged']} unchanged, {len(merged['failed_shards'])} of {len(merged['shards'])} shards failed."
+    )
+
+
+class ShardExporter(Exporter):
+    """
+    Writes the books of one shard through `exporter`, holding the lease of
+    every book while it is written, and counts the outcomes in `summary`.
+    """
+
+    def __init__(self, exporter: Exporter, coordinator: ShardCoordinator) -> None:
+        self.exporter = exporter
+        self.coordinator = coordinator
+        self.concurrent = exporter.concurrent
+        self.summary = ShardSummary(
+            shard_index=coordinator.shard_index,
+            shard_count=coordinator.shard_count,
+            worker=coordinator.worker,
+        )
+        self._lock = threading.Lock()
+
+    def select_book(self, book: models.Book) -> bool:
+        """
+        Whether the book belongs to this shard, counting the ones that do.
+        """
+        if not self.coordinator.owns(book):
+            return False
+        with self._lock:
+            self.summary.books_assigned += 1
+        return True
+
+    def needs_writing(self, book: models.Book) -> bool:
+        if self.exporter.needs_writing(book):
+            return True
+        with self._lock:
+            self.summary.books_unchanged += 1
+        return False
+
+    def prepare_book(self, book: models.Book) -> None:
+        self.exporter.prepare_book(book)
+
+    def write_book(
+        self, book: models.Book, load_heading_info: Callable[[], HeadingInfo]
+    ) -> Optional[str]:
+        key = book_key(book)
+        if not self.coordinator.acquire(key):
+            logger.info(f"{book.title} is being written by another worker")
+            with self._lock:
+                self.summary.books_leased_elsewhere += 1
+            return None
+        try:
+            if self.coordinator.is_done(key):
+                # Written by the worker that held the lease before
+                logger.info(f"{book.title} was written by another worker")
+                with self._lock:
+                    self.summary.books_leased_elsewhere += 1
+                return None
+            with self.coordinator.hold(key):
+                message = self.exporter.write_book(book, load_heading_info)
+            self.coordinator.mark_done(key)
+        finally:
+            self.coordinator.release(key)
+        with self._lock:
+            if message:
+                self.summary.books_written += 1
+            else:
+                self.summary.books_unchanged += 1
+        return message
+
+    def flush(self, failed: bool = False) -> None:
+        self.exporter.flush(failed=failed)
+
+    def close(self, failed: bool = False) -> None:
+        self.exporter.close(failed=failed)
+
+
+def sync_shard(
+    clippings_file: Union[str, list[str]],
+    exporter: Exporter,
+    coordinator: ShardCoordinator,
+    **sync_kwargs,
+) -> ShardSummary:
+    """
+    Syncs the books of the shard of `coordinator` with `sync_clippings_file`.
+    Other books are dropped right after parsing, before any heading, cover or
+    Notion work. Logs the merged summary when this was the last shard.
+    """
+    started = time.monotonic()
+    shard_exporter = ShardExporter(exporter, coordinator)
+    logger.info(
+        f"Syncing shard {coordinator.shard_index} of {coordinator.shard_count} as {coordinator.worker}"
+    )
+    try:
+        sync_clippings_file(
+            clippings_file,
+            shard_exporter,
+            select_book=shard_exporter.select_book,
+            **sync_kwargs,
+        )
+    except Exception as e:
+        logger.error(f"Shard {coordinator.shard_index} failed", exc_info=True)
+        shard_exporter.summary.error = f"{type(e).__name__}: {e}"
+    summary = shard_exporter.summary
+    summary.seconds = time.monotonic() - started
+
+    merged = coordinator.finish(summary)
+    if merged is not None:
+        log_merged_summary(merged)
+    else:
+        logger.info(
+            f"Shard {coordinator.shard_index} done: {summary.books_written} of {summary.books_assigned} books written. Waiting for the other shards to finish for the merged summary."
+        )
+    return summary
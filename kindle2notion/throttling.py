@@ -0,0 +1,59 @@
+import threading
+import time
+
+import httpx
+import notional
+
+# Notion allows an average of three requests per second per integration
+NOTION_REQUESTS_PER_SECOND = 3.0
+NOTION_BURST = 3
+
+
+class RateLimiter:
+    """
+    Thread safe token bucket allowing `rate` acquisitions per second on
+    average, and up to `burst` in a row.
+    """
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= 1
+            # A negative balance is the time this caller has to wait for; the
+            # next caller waits behind it.
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+_SESSIONS: dict[str, notional.session.Session] = {}
+_SESSIONS_LOCK = threading.Lock()
+
+
+def get_session(notion_api_auth_token: str) -> notional.session.Session:
+    """
+    Returns the Notion session of a token, shared by every thread and job of
+    the process. All requests made with a token go through one rate limiter,
+    so concurrent jobs for the same integration don't trip Notion's limits.
+    """
+    with _SESSIONS_LOCK:
+        session = _SESSIONS.get(notion_api_auth_token)
+        if session is None:
+            limiter = RateLimiter(NOTION_REQUESTS_PER_SECOND, NOTION_BURST)
+            client = httpx.Client(
+                event_hooks={"request": [lambda request: limiter.acquire()]}
+            )
+            session = notional.connect(auth=notion_api_auth_token, client=client)
+            _SESSIONS[notion_api_auth_token] = session
+        return session
@@ -0,0 +1,280 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from typing import Callable, Optional
+
+from kindle2notion import models
+from kindle2notion.compacting import archived_clippings
+from kindle2notion.grouping import TitleGrouper
+from kindle2notion.indexing import forget_inventories
+from kindle2notion.package_logger import logger
+from kindle2notion.merging import MergedClippings
+from kindle2notion.parsing import iter_books_in_clippings, iter_complete_books
+from kindle2notion.reading import read_new_clippings
+
+# inotify(7) event masks
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_CLOSE_WRITE
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_UNMOUNT
+)
+_EVENT_HEADER = struct.Struct("iIII")
+
+DEFAULT_DEBOUNCE_SECONDS = 5.0
+POLL_INTERVAL_SECONDS = 10.0
+
+
+class Inotify:
+    """
+    Minimal inotify binding through libc, raises OSError where unavailable.
+    """
+
+    def __init__(self) -> None:
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("libc not found")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError("inotify is not supported on this platform")
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._watches: dict[int, str] = {}
+
+    def add_watch(self, path: str, mask: int = WATCH_MASK) -> None:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+        self._watches[wd] = path
+
+    def clear_watches(self) -> None:
+        for wd in self._watches:
+            self._libc.inotify_rm_watch(self.fd, wd)
+        self._watches = {}
+
+    def read_events(self) -> list[tuple[str, int, str]]:
+        """
+        Returns the pending (watched path, mask, name) events.
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, name_len = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = data[offset : offset + name_len].rstrip(b"\0")
+                offset += name_len
+                events.append((self._watches.get(wd, ""), mask, os.fsdecode(name)))
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class ClippingsLibrary:
+    """
+    The parsed library of a clippings file, kept in memory between syncs.
+
+    The clippings file is append only, so only the bytes added since the last
+    refresh are parsed. If the file was replaced or truncated (a different
+    Kindle was mounted, or the file was cleaned up) the library is rebuilt.
+    The `grouper` is kept across refreshes, so title variants appended later
+    join the book they were first grouped under. The clippings compacted out
+    of the file into archives are read first on every rebuild.
+    """
+
+    def __init__(
+        self, clippings_file: str, grouper: Optional[TitleGrouper] = None
+    ) -> None:
+        self.clippings_file = clippings_file
+        self.grouper = grouper
+        self.books: dict[str, models.Book] = {}
+        self.offset = 0
+        self._identity: Optional[tuple[int, int]] = None
+        # book title -> fingerprints of the highlights in the last sync
+        self._synced: dict[str, frozenset[str]] = {}
+
+    def _reset(self) -> None:
+        self.offset = 0
+        archives = MergedClippings(archived_clippings(self.clippings_file))
+        self.books = {
+            book.title: book for book in iter_books_in_clippings(archives, self.grouper)
+        }
+
+    def refresh(self) -> bool:
+        """
+        Parses what was appended to the clippings file, returns False if the
+        file is not available.
+        """
+        try:
+            stat = os.stat(self.clippings_file)
+        except OSError:
+            return False
+        identity = (stat.st_dev, stat.st_ino)
+        if identity != self._identity or stat.st_size < self.offset:
+            self._identity = identity
+            self._reset()
+
+        new_text, self.offset = read_new_clippings(self.clippings_file, self.offset)
+        if not new_text.strip():
+            return True
+        for book in iter_complete_books(new_text, self.grouper):
+            if book.title in self.books:
+                self.books[book.title].highlights.extend(book.highlights)
+                self.books[book.title].prune_subset_highlights()
+            else:
+                self.books[book.title] = book
+        return True
+
+    def changed_books(self) -> dict[str, models.Book]:
+        return {
+            title: book
+            for title, book in self.books.items()
+            if self._synced.get(title)
+            != frozenset(h.fingerprint for h in book.highlights)
+        }
+
+    def mark_synced(self, books: dict[str, models.Book]) -> None:
+        for title, book in books.items():
+            self._synced[title] = frozenset(h.fingerprint for h in book.highlights)
+
+
+def _deepest_existing_dir(path: str) -> str:
+    path = os.path.dirname(os.path.abspath(path))
+    while not os.path.isdir(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def watch_clippings(
+    clippings_file: str,
+    sync_books: Callable[[dict[str, models.Book]], None],
+    debounce: float = DEFAULT_DEBOUNCE_SECONDS,
+    grouper: Optional[TitleGrouper] = None,
+) -> None:
+    """
+    Syncs `clippings_file` whenever it changes or the volume holding it is
+    mounted, until interrupted. Bursts of events are debounced, and only the
+    books whose highlights changed since the last sync are passed to
+    `sync_books`.
+    """
+    library = ClippingsLibrary(clippings_file, grouper)
+
+    def sync() -> None:
+        if not library.refresh():
+            logger.info(f"Waiting for {clippings_file} to become available...")
+            return
+        changed = library.changed_books()
+        if not changed:
+            logger.info("No new clippings to sync.")
+            return
+        logger.info(f"Syncing {len(changed)} changed books...")
+        try:
+            sync_books(changed)
+            library.mark_synced(changed)
+        except Exception:
+            logger.error("Sync failed, will retry on the next change", exc_info=True)
+
+    try:
+        inotify = Inotify()
+    except OSError:
+        logger.warning(
+            f"inotify is not available, polling every {POLL_INTERVAL_SECONDS:.0f} seconds instead"
+        )
+        _poll_clippings(clippings_file, sync)
+        return
+
+    # /proc/self/mounts reports a priority event whenever the mount table
+    # changes, which is how a freshly mounted Kindle is noticed.
+    mounts = (
+        open("/proc/self/mounts", "rb") if os.path.exists("/proc/self/mounts") else None
+    )
+    poller = select.poll()
+    poller.register(inotify.fd, select.POLLIN)
+    if mounts is not None:
+        poller.register(mounts.fileno(), select.POLLPRI | select.POLLERR)
+
+    def arm() -> None:
+        inotify.clear_watches()
+        try:
+            inotify.add_watch(_deepest_existing_dir(clippings_file))
+        except OSError:
+            # The directory vanished in between (e.g. the Kindle was ejected),
+            # the mount table event will re-arm the watch
+            logger.debug("Could not watch clippings directory", exc_info=True)
+
+    arm()
+    sync()
+    last_event: Optional[float] = None
+    try:
+        while True:
+            timeout = None
+            if last_event is not None:
+                timeout = max(debounce - (time.monotonic() - last_event), 0) * 1000
+            ready = poller.poll(timeout)
+            if ready:
+                mount_changed = False
+                for fd, _ in ready:
+                    if fd == inotify.fd:
+                        inotify.read_events()
+                    elif mounts is not None and fd == mounts.fileno():
+                        mounts.seek(0)
+                        mounts.read()
+                        mount_changed = True
+                if mount_changed:
+                    # a newly mounted Kindle may hold books that were not there before
+                    forget_inventories()
+                arm()
+                last_event = time.monotonic()
+            elif last_event is not None:
+                last_event = None
+                sync()
+    except KeyboardInterrupt:
+        logger.info("Stopped watching.")
+    finally:
+        inotify.close()
+        if mounts is not None:
+            mounts.close()
+
+
+def _poll_clippings(clippings_file: str, sync: Callable[[], None]) -> None:
+    last_seen = None
+    try:
+        while True:
+            try:
+                stat = os.stat(clippings_file)
+                seen = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                seen = None
+            if seen != last_seen:
+                if last_seen is None and seen is not None:
+                    forget_inventories()
+                last_seen = seen
+                sync()
+            time.sleep(POLL_INTERVAL_SECONDS)
+    except KeyboardInterrupt:
+        logger.info("Stopped watching.")
@@ -0,0 +1,52 @@
+from datetime import datetime
+from typing import Optional
+
+from kindle2notion.models import Book, Highlight
+
+
+def make_book(
+    title: str = "Title 1", count: int = 3, texts: Optional[list[str]] = None
+) -> Book:
+    """
+    A book with `count` highlights, or one per text of `texts`, ten locations
+    apart.
+    """
+    if texts is None:
+        texts = [f"This is test highlight {i}." for i in range(1, count + 1)]
+    return Book(
+        title=title,
+        author="Ben Horowitz",
+        highlights=[
+            Highlight(
+                text=text,
+                page=None,
+                location=(i * 10, i * 10 + 2),
+                date=datetime(2020, 9, 22, 9, 23, 48),
+                is_note=False,
+            )
+            for i, text in enumerate(texts, start=1)
+        ],
+    )
+
+
+def make_clipping(
+    title: str,
+    location: str,
+    time: str = "9:23:48",
+    text: Optional[str] = None,
+    newline: str = "\n",
+) -> str:
+    """
+    A highlight as the Kindle appends it to the clippings file.
+    """
+    text = text if text is not None else f"Highlight of {title} at {location}."
+    return newline.join(
+        [
+            f"{title} (Horowitz, Ben)",
+            f"- Your Highlight on page 11 | Location {location} | Added on Tuesday, September 22, 2020 {time} AM",
+            "",
+            text,
+            "==========",
+            "",
+        ]
+    )
@@ -0,0 +1,91 @@
+import json
+from pathlib import Path
+from types import SimpleNamespace
+
+from kindle2notion import batching
+from kindle2notion.batching import BatchJob, load_manifest, run_batch
+from kindle2notion.throttling import RateLimiter
+
+TEST_CLIPPINGS_FILE = str(
+    Path(__file__).parent.absolute() / "test_data/Test Clippings.txt"
+)
+
+
+def test_load_manifest_should_expand_environment_variables(tmp_path, monkeypatch):
+    # Given
+    monkeypatch.setenv("ALICE_NOTION_TOKEN", "secret_alice")
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(
+        json.dumps(
+            {
+                "jobs": [
+                    {
+                        "name": "alice",
+                        "clippings_file": TEST_CLIPPINGS_FILE,
+                        "notion_auth_token": "$ALICE_NOTION_TOKEN",
+                        "notion_database_id": "db-alice",
+                        "options": {"separate_blocks": True},
+                    }
+                ]
+            }
+        )
+    )
+
+    # When
+    actual = load_manifest(str(manifest))
+
+    # Then
+    assert len(actual) == 1
+    assert actual[0].notion_auth_token == "secret_alice"
+    assert actual[0].options.separate_blocks is True
+    assert actual[0].options.enable_location is True
+
+
+def test_run_batch_should_report_every_job_even_when_one_fails(monkeypatch):
+    # Given
+    databases = SimpleNamespace(retrieve=lambda database_id: {"id": database_id})
+    monkeypatch.setattr(
+        batching, "get_session", lambda token: SimpleNamespace(databases=databases)
+    )
+
+    def fake_export(all_books, notion_database_id, **options):
+        if notion_database_id == "db-bob":
+            raise RuntimeError("boom")
+        return len(all_books)
+
+    monkeypatch.setattr(batching, "export_to_notion", fake_export)
+    jobs = [
+        BatchJob(
+            name=name,
+            clippings_file=TEST_CLIPPINGS_FILE,
+            notion_auth_token=f"secret_{name}",
+            notion_database_id=f"db-{name}",
+        )
+        for name in ("alice", "bob")
+    ]
+
+    # When
+    actual = run_batch(jobs, workers=2)
+
+    # Then
+    assert [result.job for result in actual] == ["alice", "bob"]
+    assert actual[0].ok and actual[0].books_written == 3
+    assert not actual[1].ok and "boom" in actual[1].error
+
+
+def test_rate_limiter_should_space_out_acquisitions_past_the_burst(monkeypatch):
+    # Given
+    now = [0.0]
+    slept = []
+    monkeypatch.setattr("kindle2notion.throttling.time.monotonic", lambda: now[0])
+    monkeypatch.setattr(
+        "kindle2notion.throttling.time.sleep", lambda seconds: slept.append(seconds)
+    )
+    limiter = RateLimiter(rate=2.0, burst=2)
+
+    # When
+    for _ in range(4):
+        limiter.acquire()
+
+    # Then
+    assert slept == [0.5, 1.0]
@@ -0,0 +1,109 @@
+import os
+from datetime import datetime
+
+from kindle2notion import models
+from kindle2notion.caching import ExtractionCache
+from kindle2notion.locating import get_heading_info
+
+
+def _fake_extraction(tmp_path):
+    html_dir = tmp_path / "mobiex"
+    (html_dir / "mobi7" / "Images").mkdir(parents=True, exist_ok=True)
+    (html_dir / "mobi7" / "book.html").write_text("<html>book</html>")
+    (html_dir / "mobi7" / "toc.ncx").write_text("<ncx></ncx>")
+    (html_dir / "mobi7" / "Images" / "cover.jpg").write_bytes(b"\xff" * 100)
+    return str(html_dir), str(html_dir / "mobi7" / "book.html")
+
+
+def test_extraction_cache_should_return_the_cached_text_files_of_an_unchanged_book(
+    tmp_path,
+):
+    # Given
+    book_path = tmp_path / "book.mobi"
+    book_path.write_bytes(b"mobi data")
+    cache = ExtractionCache(str(tmp_path / "cache"))
+    html_dir, html_file_path = _fake_extraction(tmp_path)
+
+    # When
+    missed = cache.get(str(book_path))
+    put = cache.put(str(book_path), html_dir, html_file_path)
+    hit = cache.get(str(book_path))
+
+    # Then
+    assert missed is None
+    assert hit == put
+    entry_dir, main_file = hit
+    assert open(main_file).read() == "<html>book</html>"
+    assert os.path.exists(os.path.join(entry_dir, "mobi7", "toc.ncx"))
+    assert not os.path.exists(os.path.join(entry_dir, "mobi7", "Images"))
+
+
+def test_extraction_cache_should_store_headings_by_book(tmp_path):
+    # Given
+    book_path = tmp_path / "book.mobi"
+    book_path.write_bytes(b"mobi data")
+    other_path = tmp_path / "other.mobi"
+    other_path.write_bytes(b"other mobi data")
+    cache = ExtractionCache(str(tmp_path / "cache"))
+    headings = [models.BookHeading(title="Chapter 1", href="#c1", position=10)]
+
+    # When
+    cache.put_headings(str(book_path), headings)
+
+    # Then
+    assert cache.get_headings(str(book_path)) == headings
+    assert cache.get_headings(str(other_path)) is None
+
+
+def test_extraction_cache_should_evict_the_least_recently_used_book(tmp_path):
+    # Given
+    cache = ExtractionCache(str(tmp_path / "cache"), max_bytes=60)
+    first_book = tmp_path / "first.mobi"
+    second_book = tmp_path / "second.mobi"
+    first_book.write_bytes(b"first")
+    second_book.write_bytes(b"second")
+    cache.put(str(first_book), *_fake_extraction(tmp_path))
+
+    # When
+    cache.put(str(second_book), *_fake_extraction(tmp_path))
+
+    # Then
+    remembered = [
+        open(os.path.join(cache.stat_dir, name)).read()
+        for name in os.listdir(cache.stat_dir)
+    ]
+    assert remembered == [cache.digest(str(second_book))]
+    assert cache.get(str(first_book)) is None
+    assert cache.get(str(second_book)) is not None
+
+
+def test_get_heading_info_should_only_use_cached_assignments_when_all_highlights_are_known(
+    tmp_path,
+):
+    # Given
+    kindle_root = tmp_path / "kindle"
+    (kindle_root / "documents").mkdir(parents=True)
+    book_path = kindle_root / "documents" / "Relativity.mobi"
+    book_path.write_bytes(b"not a real mobi file")
+    cache_dir = str(tmp_path / "cache")
+    highlight = models.Highlight(
+        text="This is a test highlight.",
+        page=None,
+        location=(10, 12),
+        date=datetime(2021, 4, 30),
+        is_note=False,
+    )
+    book = models.Book(
+        title="Relativity", author="Albert Einstein", highlights=[highlight]
+    )
+    headings = [models.BookHeading(title="Chapter 1", href="#c1", position=10)]
+    cache = ExtractionCache(cache_dir)
+    cache.put_assignments(
+        cache.digest(str(book_path)), "text", headings, {highlight.fingerprint: 0}
+    )
+
+    # When
+    actual = get_heading_info(book, str(kindle_root), cache_dir)
+
+    # Then
+    assert actual == (headings, [0])
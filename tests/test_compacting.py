@@ -0,0 +1,127 @@
+import os
+import shutil
+
+from helpers import make_clipping
+
+from kindle2notion.compacting import (
+    ARCHIVE_DIR_NAME,
+    archived_clippings,
+    compact_clippings,
+)
+from kindle2notion.exporters import Exporter
+from kindle2notion.merging import ClippingsState
+from kindle2notion.pipeline import sync_clippings_file
+from kindle2notion.watching import ClippingsLibrary
+
+
+class RecordingExporter(Exporter):
+    incremental = True
+
+    def __init__(self):
+        self.written = {}
+
+    def write_book(self, book, load_heading_info):
+        self.written[book.title] = [h.location for h in book.highlights]
+        return "written"
+
+
+def test_compact_should_keep_the_unsynced_tail_and_later_syncs_complete(tmp_path):
+    # Given
+    clippings_file = tmp_path / "My Clippings.txt"
+    clippings_file.write_bytes(
+        (
+            "\ufeff"
+            + make_clipping("Title 1", "10-12", "9:00:00", newline="\r\n")
+            + make_clipping("Title 2", "10-12", "9:10:00", newline="\r\n")
+        ).encode("utf-8")
+    )
+    state_dir = str(tmp_path / "state")
+    clippings_state = ClippingsState.for_sync({"target": "test"}, state_dir)
+
+    def sync():
+        exporter = RecordingExporter()
+        sync_clippings_file(
+            str(clippings_file),
+            exporter,
+            kindle_root=None,
+            cache_dir=state_dir,
+            clippings_state=ClippingsState(clippings_state.path),
+        )
+        return exporter.written
+
+    sync()
+    unsynced = make_clipping("Title 1", "20-22", "9:20:00", newline="\r\n")
+    with open(clippings_file, "a", encoding="utf-8", newline="") as f:
+        f.write(unsynced)
+
+    # When
+    result = compact_clippings(
+        str(clippings_file), ClippingsState(clippings_state.path)
+    )
+
+    # Then
+    assert result.archived_clippings == 2
+    assert archived_clippings(str(clippings_file)) == [result.archive]
+    assert os.path.dirname(result.archive) == str(tmp_path / ARCHIVE_DIR_NAME)
+    assert clippings_file.read_bytes() == ("\ufeff" + unsynced).encode("utf-8")
+    # Only the book of the tail is written, with its archived clippings
+    assert sync() == {"Title 1": [(10, 12), (20, 22)]}
+    assert sync() == {}
+    library = ClippingsLibrary(str(clippings_file))
+    library.refresh()
+    assert sorted(library.books) == ["Title 1", "Title 2"]
+    assert len(library.books["Title 1"].highlights) == 2
+
+
+def test_compact_should_leave_a_file_without_synced_clippings_alone(tmp_path):
+    # Given
+    clippings_file = tmp_path / "My Clippings.txt"
+    original = make_clipping("Title 1", "10-12", "9:00:00", newline="\r\n").encode(
+        "utf-8"
+    )
+    clippings_file.write_bytes(original)
+    state_dir = str(tmp_path / "state")
+
+    # When
+    result = compact_clippings(
+        str(clippings_file), ClippingsState.for_sync({}, state_dir)
+    )
+
+    # Then
+    assert result.archive is None
+    assert archived_clippings(str(clippings_file)) == []
+    assert clippings_file.read_bytes() == original
+
+
+def test_compact_should_keep_archives_found_on_another_mount_and_cache(tmp_path):
+    # Given
+    kindle = tmp_path / "kindle"
+    kindle.mkdir()
+    clippings_file = kindle / "My Clippings.txt"
+    clippings_file.write_bytes(
+        make_clipping("Title 1", "10-12", "9:00:00", newline="\r\n").encode("utf-8")
+    )
+    clippings_state = ClippingsState.for_sync({}, str(tmp_path / "state"))
+    sync_clippings_file(
+        str(clippings_file),
+        RecordingExporter(),
+        kindle_root=None,
+        clippings_state=clippings_state,
+    )
+    with open(clippings_file, "a", encoding="utf-8", newline="") as f:
+        f.write(make_clipping("Title 1", "20-22", "9:20:00", newline="\r\n"))
+    compact_clippings(str(clippings_file), ClippingsState(clippings_state.path))
+    remounted = tmp_path / "remounted"
+    shutil.copytree(kindle, remounted)
+
+    # When
+    exporter = RecordingExporter()
+    sync_clippings_file(
+        str(remounted / "My Clippings.txt"),
+        exporter,
+        kindle_root=None,
+        clippings_state=ClippingsState.for_sync({}, str(tmp_path / "other")),
+    )
+
+    # Then
+    assert exporter.written == {"Title 1": [(10, 12), (20, 22)]}
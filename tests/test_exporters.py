@@ -0,0 +1,186 @@
+import json
+
+import pytest
+from helpers import make_book
+
+from kindle2notion.exporters import JsonLinesExporter, MarkdownExporter, export_books
+from kindle2notion.models import BookHeading
+
+
+def test_markdown_exporter_should_write_a_file_per_book_with_headings(tmp_path):
+    # Given
+    book = make_book("Title 1: A Great Book")
+    headings = [
+        BookHeading(title="Chapter 1", href="c1.html", position=0),
+        BookHeading(title="Chapter 2", href="c2.html", position=100),
+    ]
+    exporter = MarkdownExporter(
+        str(tmp_path), enable_location=True, enable_highlight_date=False
+    )
+
+    # When
+    with exporter:
+        exporter.write_book(book, lambda: (headings, [0, 0, 1]))
+
+    # Then
+    assert (tmp_path / "Title 1_ A Great Book.md").read_text() == (
+        "# Title 1: A Great Book\n\n*Ben Horowitz*\n\n"
+        "## Chapter 1\n\n"
+        "This is test highlight 1.\nLocation: 10-12\n\n"
+        "This is test highlight 2.\nLocation: 20-22\n\n"
+        "## Chapter 2\n\n"
+        "This is test highlight 3.\nLocation: 30-32\n\n"
+    )
+
+
+def test_jsonl_exporter_should_write_a_line_per_highlight(tmp_path):
+    # Given
+    all_books = {"Title 1": make_book("Title 1"), "Title 2": make_book("Title 2")}
+    exporter = JsonLinesExporter(
+        str(tmp_path), enable_location=False, enable_highlight_date=False
+    )
+
+    # When
+    written = export_books(exporter, all_books, kindle_root=None)
+
+    # Then
+    records = [
+        json.loads(line)
+        for line in (tmp_path / "highlights.jsonl").read_text().splitlines()
+    ]
+    assert written == 2
+    assert [(r["title"], r["location"]) for r in records] == [
+        (title, [i * 10, i * 10 + 2])
+        for title in ("Title 1", "Title 2")
+        for i in range(1, 4)
+    ]
+    assert records[0]["formatted"] == "This is test highlight 1.\n\n"
+
+
+def test_jsonl_exporter_should_keep_the_previous_export_when_a_book_fails(tmp_path):
+    # Given
+    (tmp_path / "highlights.jsonl").write_text("previous\n")
+    exporter = JsonLinesExporter(
+        str(tmp_path), enable_location=True, enable_highlight_date=True
+    )
+
+    def failing_heading_info():
+        raise RuntimeError("boom")
+
+    # When
+    with pytest.raises(RuntimeError):
+        with exporter:
+            exporter.write_book(
+                make_book("Title 1: A Great Book"), failing_heading_info
+            )
+
+    # Then
+    assert (tmp_path / "highlights.jsonl").read_text() == "previous\n"
+    assert [p.name for p in tmp_path.iterdir()] == ["highlights.jsonl"]
+
+
+def test_jsonl_exporter_should_keep_the_records_of_books_not_exported_again(
+    tmp_path,
+):
+    # Given
+    export_books(
+        JsonLinesExporter(
+            str(tmp_path), enable_location=False, enable_highlight_date=False
+        ),
+        {"Title 1": make_book("Title 1"), "Title 2": make_book("Title 2")},
+        kindle_root=None,
+    )
+    updated = make_book("Title 2")
+    updated.highlights = updated.highlights[:1]
+
+    # When
+    export_books(
+        JsonLinesExporter(
+            str(tmp_path), enable_location=False, enable_highlight_date=False
+        ),
+        {"Title 2": updated},
+        kindle_root=None,
+    )
+
+    # Then
+    records = [
+        json.loads(line)
+        for line in (tmp_path / "highlights.jsonl").read_text().splitlines()
+    ]
+    assert sorted((r["title"], r["location"][0]) for r in records) == [
+        ("Title 1", 10),
+        ("Title 1", 20),
+        ("Title 1", 30),
+        ("Title 2", 10),
+    ]
+
+
+def test_exporters_kept_open_should_flush_every_export(tmp_path):
+    # Given
+    jsonl = JsonLinesExporter(
+        str(tmp_path), enable_location=False, enable_highlight_date=False
+    )
+    markdown = MarkdownExporter(
+        str(tmp_path), enable_location=False, enable_highlight_date=False
+    )
+    updated = make_book("Title 1")
+    updated.highlights = updated.highlights[:1]
+
+    # When
+    with jsonl, markdown:
+        for exporter in (jsonl, markdown):
+            export_books(
+                exporter,
+                {"Title 1": make_book("Title 1")},
+                kindle_root=None,
+                close=False,
+            )
+            export_books(
+                exporter,
+                {"Title 2": make_book("Title 2")},
+                kindle_root=None,
+                close=False,
+            )
+            export_books(exporter, {"Title 1": updated}, kindle_root=None, close=False)
+        flushed = (tmp_path / "highlights.jsonl").read_text()
+
+    # Then
+    records = [json.loads(line) for line in flushed.splitlines()]
+    assert sorted((r["title"], r["location"][0]) for r in records) == [
+        ("Title 1", 10),
+        ("Title 2", 10),
+        ("Title 2", 20),
+        ("Title 2", 30),
+    ]
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "Title 1.md",
+        "Title 2.md",
+        "highlights.jsonl",
+    ]
+
+
+def test_markdown_exporter_should_not_overwrite_another_books_file_in_a_later_export(
+    tmp_path,
+):
+    # Given
+    first = make_book("Title 1: A Great Book")
+    # Same file name once unsafe characters are replaced
+    second = make_book("Title 1/ A Great Book")
+    MarkdownExporter(
+        str(tmp_path), enable_location=False, enable_highlight_date=False
+    ).write_book(first, lambda: ([], [None] * 3))
+
+    # When
+    messages = []
+    for _ in range(2):
+        exporter = MarkdownExporter(
+            str(tmp_path), enable_location=False, enable_highlight_date=False
+        )
+        messages.append(exporter.write_book(second, lambda: ([], [None] * 3)))
+        exporter.write_book(first, lambda: ([], [None] * 3))
+
+    # Then
+    assert messages[0] == messages[1]
+    files = {p.name: p.read_text().split("\n")[0] for p in tmp_path.iterdir()}
+    assert files.pop("Title 1_ A Great Book.md") == "# Title 1: A Great Book"
+    assert list(files.values()) == ["# Title 1/ A Great Book"]
@@ -0,0 +1,190 @@
+from types import SimpleNamespace
+
+from helpers import make_book
+from notional.types import Number, RichText
+
+from kindle2notion import exporting
+from kindle2notion.exporting import _page_batches, _write_to_page
+from kindle2notion.journaling import SyncJournal
+from kindle2notion.models import BookHeading
+
+
+def test_write_to_page_should_skip_the_batches_already_written():
+    # Given
+    appended = []
+    notion = SimpleNamespace(
+        blocks=SimpleNamespace(
+            children=SimpleNamespace(
+                append=lambda page, *blocks: appended.append(len(blocks))
+            )
+        )
+    )
+    batches = _page_batches(
+        make_book(count=250),
+        ([], [None] * 250),
+        separate_blocks=True,
+        enable_location=True,
+        enable_highlight_date=True,
+        raw_payloads=False,
+    )
+    written = []
+
+    # When
+    _write_to_page(notion, None, batches, skip_batches=1, on_batch=written.append)
+
+    # Then
+    assert [len(batch) for batch in batches] == [99, 99, 52]
+    assert appended == [99, 52]
+    assert written == batches[1:]
+
+
+def test_create_page_should_send_cover_properties_and_children_at_once(monkeypatch):
+    # Given
+    requests = []
+    notion = SimpleNamespace(
+        client=SimpleNamespace(
+            pages=SimpleNamespace(
+                create=lambda **request: (
+                    requests.append(request)
+                    or {"object": "page", "id": "a8aec43384f447ed84390e8e42c2e089"}
+                )
+            )
+        )
+    )
+    monkeypatch.setattr(
+        exporting, "_get_book_cover_uri", lambda title, author: "https://cover"
+    )
+    book = make_book()
+    batches = _page_batches(
+        book, ([], [None] * 3), True, True, True, raw_payloads=False
+    )
+
+    # When
+    exporting._create_page(
+        notion,
+        book,
+        "a8aec43384f447ed84390e8e42c2e089",
+        enable_book_cover=True,
+        separate_blocks=True,
+        enable_location=True,
+        enable_highlight_date=True,
+        children=batches[0],
+        digest="digest-1",
+    )
+
+    # Then
+    assert len(requests) == 1
+    request = requests[0]
+    assert request["cover"] == {
+        "type": "external",
+        "external": {"url": "https://cover"},
+    }
+    assert request["properties"]["Highlights"] == {"type": "number", "number": 3}
+    assert "Last Synced" in request["properties"]
+    assert request["properties"]["Content Digest"]["rich_text"][0]["plain_text"] == (
+        "digest-1"
+    )
+    assert len(request["children"]) == 3
+
+
+def test_add_book_to_notion_should_not_make_requests_for_unchanged_books(
+    monkeypatch,
+):
+    # Given
+    monkeypatch.setattr(exporting, "get_session", lambda token: SimpleNamespace())
+    book = make_book()
+    digest = book.content_digest(True, True, False)
+    page = SimpleNamespace(id="page-1", properties={"Content Digest": RichText[digest]})
+
+    # When
+    actual = exporting._add_book_to_notion(
+        book,
+        "secret",
+        "db-1",
+        enable_book_cover=True,
+        separate_blocks=False,
+        enable_location=True,
+        enable_highlight_date=True,
+        kindle_root=None,
+        page_index={book.title: page},
+    )
+
+    # Then
+    assert actual is None
+
+
+def test_add_book_to_notion_should_not_rewrite_a_page_with_more_highlights(
+    monkeypatch,
+):
+    # Given
+    monkeypatch.setattr(exporting, "get_session", lambda token: SimpleNamespace())
+    book = make_book()
+    page = SimpleNamespace(
+        id="page-1",
+        properties={
+            "Content Digest": RichText["older-digest"],
+            "Highlights": Number[5],
+        },
+    )
+
+    # When
+    actual = exporting._add_book_to_notion(
+        book,
+        "secret",
+        "db-1",
+        enable_book_cover=False,
+        separate_blocks=False,
+        enable_location=True,
+        enable_highlight_date=True,
+        kindle_root=None,
+        page_index={book.title: page},
+    )
+
+    # Then
+    assert actual is None
+
+
+def test_add_book_to_notion_should_start_over_when_the_headings_changed(
+    tmp_path, monkeypatch
+):
+    # Given
+    book = make_book()
+    digest = book.content_digest(True, True, False)
+    journal = SyncJournal(str(tmp_path / "journal.json"))
+    journal.begin("Title 1", digest, "page-1", headings_digest="without-headings")
+    interrupted = SimpleNamespace(id="page-1", archived=False)
+    deleted = []
+    notion = SimpleNamespace(
+        pages=SimpleNamespace(
+            retrieve=lambda page_id: interrupted, delete=deleted.append
+        ),
+        blocks=SimpleNamespace(children=SimpleNamespace(list=lambda page: [])),
+    )
+    monkeypatch.setattr(exporting, "get_session", lambda token: notion)
+    created = []
+    monkeypatch.setattr(
+        exporting,
+        "_create_page",
+        lambda *args, **kwargs: created.append(kwargs) or SimpleNamespace(id="page-2"),
+    )
+    headings = [BookHeading(title="Chapter 1", href="c1.html", position=0)]
+
+    # When
+    exporting._add_book_to_notion(
+        book,
+        "secret",
+        "db-1",
+        enable_book_cover=False,
+        separate_blocks=False,
+        enable_location=True,
+        enable_highlight_date=True,
+        kindle_root=None,
+        load_heading_info=lambda: (headings, [0, 0, 0]),
+        journal=journal,
+        page_index={},
+    )
+
+    # Then
+    assert deleted == [interrupted]
+    assert len(created) == 1
+    assert journal.get("Title 1", digest).page_id == "page-2"
@@ -0,0 +1,166 @@
+import json
+
+from kindle2notion.grouping import (
+    TitleGrouper,
+    canonicalize_title,
+    load_title_overrides,
+)
+from kindle2notion.parsing import parse_raw_clippings_text
+
+
+def test_canonicalize_title_should_drop_store_suffixes_and_editions():
+    # Given
+    titles = [
+        "Dune",
+        "Dune_B00B7NPRY8",
+        "Dune (Kindle Edition)",
+        "The Dune",
+        "dune-EBOK",
+    ]
+
+    # When
+    keys = {canonicalize_title(title)[0] for title in titles}
+
+    # Then
+    assert keys == {"dune"}
+    assert canonicalize_title("Dune: Deluxe Edition: A Novel") == (
+        "dune a novel",
+        "dune",
+    )
+    assert canonicalize_title("Foundation (Book 2)")[0] == "foundation book 2"
+
+
+def test_title_grouper_should_group_variants_by_the_same_author():
+    # Given
+    grouper = TitleGrouper()
+
+    # When
+    groups = [
+        grouper.group_title(title, author)
+        for title, author in [
+            ("Thinking, Fast and Slow", "Daniel Kahneman"),
+            ("Thinking, Fast and Slow: A Summary", "Kahneman"),
+            ("Thinking Fast and Slow_B00555X8OA", "Daniel Kahneman"),
+            ("Thinking, Fast and Slo", "Daniel Kahneman"),
+            ("Thinking, Fast and Slow", "Someone Else"),
+            ("Foundation (Book 1)", "Isaac Asimov"),
+            ("Foundation (Book 2)", "Isaac Asimov"),
+        ]
+    ]
+
+    # Then
+    assert groups == [
+        "Thinking, Fast and Slow",
+        "Thinking, Fast and Slow",
+        "Thinking, Fast and Slow",
+        "Thinking, Fast and Slow",
+        # authors don't agree
+        "Thinking, Fast and Slow",
+        "Foundation (Book 1)",
+        "Foundation (Book 2)",
+    ]
+    assert len(grouper._groups) == 4
+
+
+def test_title_grouper_should_keep_numbered_and_subtitled_volumes_apart():
+    # Given
+    grouper = TitleGrouper()
+    titles = [
+        ("Foundation", "Isaac Asimov"),
+        ("Foundation: Book 2", "Isaac Asimov"),
+        ("Foundation - Volume 3", "Isaac Asimov"),
+        ("The Lord of the Rings", "J. R. R. Tolkien"),
+        ("The Lord of the Rings: The Two Towers", "J. R. R. Tolkien"),
+        ("Dune: Part Two", "Frank Herbert"),
+        ("Dune", "Frank Herbert"),
+        ("Sapiens", "Yuval Noah Harari"),
+        ("Sapiens: A Brief History of Humankind", "Yuval Noah Harari"),
+    ]
+
+    # When
+    groups = [grouper.group_title(title, author) for title, author in titles]
+
+    # Then
+    assert groups == [
+        "Foundation",
+        "Foundation: Book 2",
+        "Foundation - Volume 3",
+        "The Lord of the Rings",
+        "The Lord of the Rings: The Two Towers",
+        "Dune: Part Two",
+        "Dune",
+        "Sapiens",
+        "Sapiens",
+    ]
+
+
+def test_title_grouper_should_apply_overrides(tmp_path):
+    # Given
+    overrides_file = tmp_path / "overrides.json"
+    overrides_file.write_text(
+        json.dumps({"Dune: Part Two": "Dune: Part Two", "Arrakis": "Dune"})
+    )
+    grouper = TitleGrouper(load_title_overrides(str(overrides_file)))
+
+    # When
+    groups = [
+        grouper.group_title(title, "Frank Herbert")
+        for title in ["Dune", "Dune: Part Two", "Arrakis", "Dune_B00B7NPRY8"]
+    ]
+
+    # Then
+    assert groups == ["Dune", "Dune: Part Two", "Dune", "Dune"]
+
+
+def test_parse_raw_clippings_text_should_merge_title_variants():
+    # Given
+    raw_clippings_text = (
+        "Dune (Frank Herbert)\n"
+        "- Your Highlight on page 1 | Location 10-11 | Added on Friday, April 30, 2021 12:31:29 AM\n"
+        "\n"
+        "Fear is the mind-killer.\n"
+        "==========\n"
+        "Dune_B00B7NPRY8 (Frank Herbert)\n"
+        "- Your Highlight on page 2 | Location 20-21 | Added on Friday, April 30, 2021 12:32:29 AM\n"
+        "\n"
+        "The spice must flow.\n"
+        "==========\n"
+    )
+
+    # When
+    all_books = parse_raw_clippings_text(raw_clippings_text, TitleGrouper())
+
+    # Then
+    assert list(all_books) == ["Dune"]
+    assert len(all_books["Dune"].highlights) == 2
+
+
+def test_parse_raw_clippings_text_should_prune_each_edition_on_its_own():
+    # Given
+    raw_clippings_text = (
+        "Dune (Frank Herbert)\n"
+        "- Your Highlight on page 1 | Location 100-110 | Added on Friday, April 30, 2021 12:31:29 AM\n"
+        "\n"
+        "Fear is the mind-killer.\n"
+        "==========\n"
+        "Dune (Deluxe Edition) (Frank Herbert)\n"
+        "- Your Highlight on page 1 | Location 95-120 | Added on Friday, April 30, 2021 12:32:29 AM\n"
+        "\n"
+        "The spice must flow.\n"
+        "==========\n"
+        "Dune (Deluxe Edition) (Frank Herbert)\n"
+        "- Your Highlight on page 1 | Location 96-119 | Added on Friday, April 30, 2021 12:33:29 AM\n"
+        "\n"
+        "The spice must.\n"
+        "==========\n"
+    )
+
+    # When
+    all_books = parse_raw_clippings_text(raw_clippings_text, TitleGrouper())
+
+    # Then
+    assert list(all_books) == ["Dune"]
+    assert [h.text for h in all_books["Dune"].highlights] == [
+        "Fear is the mind-killer.",
+        "The spice must flow.",
+    ]
@@ -0,0 +1,55 @@
+import subprocess
+import sys
+
+# Budget for importing the CLI entry point, in microseconds. Generous enough
+# for slow CI machines, far below the second the full dependency tree takes.
+IMPORT_BUDGET_US = 200_000
+# Dependencies that must only be imported by the stages that use them
+HEAVY_MODULES = {
+    "notional",
+    "notion_client",
+    "httpx",
+    "dateparser",
+    "mobi",
+    "fuzzysearch",
+    "requests",
+    "pydantic",
+    "rich",
+}
+
+
+def _import_times(*args):
+    """
+    Runs python with `-X importtime` and returns {module: cumulative us}.
+    """
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        capture_output=True,
+        text=True,
+    )
+    times = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, module = line.split("|")
+        if cumulative.strip().isdigit():
+            times[module.strip()] = int(cumulative)
+    return times
+
+
+def test_importing_the_cli_should_stay_within_the_budget():
+    # When
+    times = _import_times("-c", "import kindle2notion.__main__")
+
+    # Then
+    assert times["kindle2notion.__main__"] < IMPORT_BUDGET_US
+    assert HEAVY_MODULES.isdisjoint(times)
+
+
+def test_help_should_not_import_heavy_dependencies():
+    # When
+    times = _import_times("-m", "kindle2notion", "--help")
+
+    # Then
+    assert "click" in times
+    assert HEAVY_MODULES.isdisjoint(times)
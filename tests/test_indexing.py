@@ -0,0 +1,94 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from kindle2notion.indexing import EbookInventory, get_inventory
+
+
+def _touch(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"")
+
+
+def test_lookup_should_find_books_in_nested_folders(tmp_path):
+    # Given
+    _touch(tmp_path / "documents" / "Duke" / "Thinking in Bets_B0752.mobi")
+    _touch(tmp_path / "documents" / "Sapiens - Yuval Noah Harari.azw3")
+    inventory = EbookInventory.scan(str(tmp_path))
+
+    # When
+    actual = inventory.lookup("Thinking in Bets", "Annie Duke")
+
+    # Then
+    assert actual == str(
+        tmp_path / "documents" / "Duke" / "Thinking in Bets_B0752.mobi"
+    )
+
+
+def test_lookup_should_fall_back_to_ranked_matching_when_the_title_is_not_a_substring(
+    tmp_path,
+):
+    # Given
+    _touch(tmp_path / "documents" / "Thinking in Bets - Annie Duke.mobi")
+    _touch(tmp_path / "documents" / "Sapiens - Yuval Noah Harari.mobi")
+    inventory = EbookInventory.scan(str(tmp_path))
+
+    # When
+    actual = inventory.lookup(
+        "Thinking in Bets: Making Smarter Decisions", "Duke Annie"
+    )
+
+    # Then
+    assert actual == str(tmp_path / "documents" / "Thinking in Bets - Annie Duke.mobi")
+
+
+def test_lookup_should_return_none_when_nothing_matches(tmp_path):
+    # Given
+    _touch(tmp_path / "documents" / "Sapiens - Yuval Noah Harari.mobi")
+    inventory = EbookInventory.scan(str(tmp_path))
+
+    # When
+    actual = inventory.lookup("The Pragmatic Programmer", "Andrew Hunt")
+
+    # Then
+    assert actual is None
+
+
+def test_get_inventory_should_reuse_the_persisted_inventory_until_the_root_changes(
+    tmp_path,
+):
+    # Given
+    root = tmp_path / "kindle"
+    cache_dir = tmp_path / "cache"
+    _touch(root / "documents" / "Sapiens.mobi")
+    get_inventory(str(root), str(cache_dir))
+    inventory_path = next(cache_dir.glob("inventory-*.json"))
+
+    # When
+    unchanged = EbookInventory.load(str(inventory_path), str(root))
+    _touch(root / "documents" / "Thinking in Bets.mobi")
+    changed = EbookInventory.load(str(inventory_path), str(root))
+
+    # Then
+    assert unchanged is not None and len(unchanged.entries) == 1
+    assert changed is None
+
+
+def test_inventory_save_should_be_safe_from_concurrent_writers(tmp_path):
+    # Given
+    _touch(tmp_path / "kindle" / "documents" / "Sapiens.mobi")
+    inventory = EbookInventory.scan(str(tmp_path / "kindle"))
+    inventory_path = str(tmp_path / "inventory.json")
+
+    def save_repeatedly():
+        for _ in range(50):
+            inventory.save(inventory_path)
+
+    # When
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for future in [executor.submit(save_repeatedly) for _ in range(4)]:
+            future.result()
+    inventory.save(str(tmp_path / "missing" / "inventory.json"))
+
+    # Then
+    loaded = EbookInventory.load(inventory_path, str(tmp_path / "kindle"))
+    assert loaded is not None and len(loaded.entries) == 1
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["inventory.json", "kindle"]
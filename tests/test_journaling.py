@@ -0,0 +1,71 @@
+from helpers import make_book
+
+from kindle2notion.journaling import SyncJournal
+
+
+def test_journal_should_survive_a_restart_and_ignore_changed_content(tmp_path):
+    # Given
+    path = str(tmp_path / "journal.json")
+    journal = SyncJournal(path)
+    journal.begin("Title 1", "digest-1", "page-1")
+    journal.record_batch("Title 1", "block-99", 99)
+
+    # When
+    reloaded = SyncJournal(path)
+
+    # Then
+    progress = reloaded.get("Title 1", "digest-1")
+    assert progress.page_id == "page-1"
+    assert progress.batches_done == 1
+    assert progress.blocks_done == 99
+    assert progress.last_block_id == "block-99"
+    assert not progress.complete
+    assert reloaded.get("Title 1", "digest-2") is None
+
+
+def test_journal_should_keep_the_books_other_processes_recorded(tmp_path):
+    # Given
+    path = str(tmp_path / "journal.json")
+    first = SyncJournal(path)
+    second = SyncJournal(path)
+
+    # When
+    first.begin("Title 1", "digest-1", "page-1")
+    second.begin("Title 2", "digest-2", "page-2")
+    first.record_batch("Title 1", "block-99", 99)
+
+    # Then
+    reloaded = SyncJournal(path)
+    assert reloaded.get("Title 1", "digest-1").blocks_done == 99
+    assert reloaded.get("Title 2", "digest-2").page_id == "page-2"
+
+
+def test_content_digest_should_change_with_highlights_and_options():
+    # Given
+    book = make_book()
+    edited = make_book()
+    edited.highlights[1].text = "This is an edited highlight."
+
+    # When
+    digest = book.content_digest(True, True, False)
+
+    # Then
+    assert digest == make_book().content_digest(True, True, False)
+    assert digest != edited.content_digest(True, True, False)
+    assert digest != book.content_digest(True, True, True)
+
+
+def test_content_digest_should_change_when_headings_are_enabled():
+    # Given
+    book = make_book()
+
+    # When
+    without_headings = book.content_digest(True, True, False)
+    with_headings = book.content_digest(True, True, False, heading_mode="text")
+
+    # Then
+    assert with_headings != without_headings
+    assert with_headings != book.content_digest(
+        True, True, False, heading_mode="location"
+    )
+    assert without_headings == book.content_digest(True, True, False, "flat", None)
@@ -0,0 +1,162 @@
+from datetime import datetime
+
+from kindle2notion import models
+from kindle2notion.locating import (
+    HeadingInfoPrefetcher,
+    LocationMap,
+    TextLocator,
+    _assign_by_location,
+    normalize_words,
+)
+from kindle2notion.reading import BookText
+
+BOOK_HTML = (
+    "<html><body><h2 id='c1'>Chapter One</h2>"
+    "<p>It was a bright cold day in April, and the clocks were striking thirteen.</p>"
+    "<h2 id='c2'>Chapter Two</h2>"
+    "<p>The hallway smelt of boiled cabbage and old rag mats. At one end of it "
+    "a coloured poster, too large for indoor display, had been tacked to the wall.</p>"
+    "<p>Winston, who didn&#8217;t care, made for the stairs.</p>"
+    "</body></html>"
+)
+
+
+def test_normalize_words_should_skip_markup_and_keep_offsets():
+    # Given
+    text = "<p class='x'>Don’t <i>panic</i></p>"
+
+    # When
+    words, starts = normalize_words(text)
+
+    # Then
+    assert words == ["dont", "panic"]
+    assert [text[s : s + 3] for s in starts] == ["Don", "pan"]
+
+
+def test_locate_should_find_a_verbatim_highlight_without_fuzzy_scans():
+    # Given
+    locator = TextLocator(BOOK_HTML)
+
+    # When
+    actual = locator.locate("The hallway smelt of boiled cabbage and old rag mats.")
+
+    # Then
+    assert actual == BOOK_HTML.index("The hallway")
+    assert locator.fuzzy_scans == 0
+
+
+def test_locate_should_find_a_slightly_different_highlight_inside_a_seeded_window():
+    # Given
+    locator = TextLocator(BOOK_HTML)
+
+    # When
+    actual = locator.locate(
+        "a coloured postr, too large for indoor display, had been tacked to the wall."
+    )
+
+    # Then
+    assert actual == BOOK_HTML.index("a coloured poster")
+    assert locator.fuzzy_scans == 1
+
+
+def test_locate_should_return_none_for_text_that_is_not_in_the_book():
+    # Given
+    locator = TextLocator(BOOK_HTML)
+
+    # When
+    actual = locator.locate("Call me Ishmael. Some years ago, never mind how long")
+
+    # Then
+    assert actual is None
+
+
+def test_heading_info_prefetcher_should_return_the_heading_info_of_every_book_in_order(
+    tmp_path,
+):
+    # Given
+    books = [
+        models.Book(
+            title=f"Book {i}",
+            author="Author",
+            highlights=[
+                models.Highlight(
+                    text="Some text",
+                    page=None,
+                    location=(i, i + 1),
+                    date=datetime(2021, 4, 30),
+                    is_note=False,
+                )
+            ],
+        )
+        for i in range(3)
+    ]
+
+    # When
+    with HeadingInfoPrefetcher(books, str(tmp_path), workers=2) as prefetcher:
+        actual = [
+            prefetcher.result(prefetcher.future(i), book)
+            for i, book in enumerate(books)
+        ]
+        start_method = prefetcher.pool.mp_context.get_start_method()
+
+    # Then
+    assert actual == [([], [None])] * 3
+    # Workers are not forked from the threads of the sync
+    assert start_method in ("forkserver", "spawn")
+
+
+def test_location_map_should_interpolate_and_drop_out_of_order_anchors():
+    # Given
+    anchors = [(100, 1000), (200, 2000), (250, 100), (300, 3000)]
+
+    # When
+    location_map = LocationMap.from_anchors(anchors)
+
+    # Then
+    assert location_map.locations == [100, 200, 300]
+    assert location_map.offset(150) == 1500
+    assert location_map.offset(400) == 4000
+    assert location_map.offset(0) == 0
+
+
+def test_get_heading_info_by_location_should_place_highlights_without_text_search(
+    tmp_path,
+):
+    # Given
+    chapters = []
+    for c in range(3):
+        paragraphs = "".join(
+            f"<p>Chapter {c} paragraph {p} talks about topic number {c * 100 + p} at length.</p>"
+            for p in range(40)
+        )
+        chapters.append(f'<h2 id="c{c}">Chapter {c}</h2>{paragraphs}')
+    html = "<html><body>" + "".join(chapters) + "</body></html>"
+    html_path = tmp_path / "book.html"
+    html_path.write_text(html)
+    book_text = BookText([str(html_path)])
+    headings = [
+        models.BookHeading(
+            title=f"Chapter {c}", href=f"#c{c}", position=html.index(f'id="c{c}"')
+        )
+        for c in range(3)
+    ]
+    highlights = []
+    for c, p in [(0, 5), (0, 30), (1, 10), (1, 35), (2, 3), (2, 20)]:
+        text = f"Chapter {c} paragraph {p} talks about topic number {c * 100 + p} at length."
+        location = html.index(text) // 150
+        highlights.append(
+            models.Highlight(
+                text=text,
+                page=None,
+                location=(location, location + 1),
+                date=datetime(2021, 4, 30),
+                is_note=False,
+            )
+        )
+    book = models.Book(title="Book", author="Author", highlights=highlights)
+
+    # When
+    actual = _assign_by_location(book, headings, book_text)
+
+    # Then
+    assert actual == [0, 0, 1, 1, 2, 2]
@@ -0,0 +1,124 @@
+from helpers import make_clipping
+
+from kindle2notion.exporters import Exporter
+from kindle2notion.merging import ClippingsState, MergedClippings
+from kindle2notion.pipeline import sync_clippings_file
+
+
+class RecordingExporter(Exporter):
+    incremental = True
+
+    def __init__(self):
+        self.written = {}
+
+    def write_book(self, book, load_heading_info):
+        self.written[book.title] = [h.location for h in book.highlights]
+        return "written"
+
+
+def test_merged_clippings_should_be_in_date_order_without_duplicates(tmp_path):
+    # Given
+    first = tmp_path / "first.txt"
+    second = tmp_path / "second.txt"
+    first.write_text(
+        "\ufeff"
+        + make_clipping("Title 1", "10-12", "9:00:00", newline="\r\n")
+        + make_clipping("Title 2", "10-12", "9:20:00", newline="\r\n")
+        + make_clipping("Title 1", "30-32", "9:40:00", newline="\r\n"),
+        encoding="utf-8",
+    )
+    second.write_text(
+        make_clipping("Title 1", "20-22", "9:10:00", newline="\r\n")
+        + make_clipping("Title 2", "10-12", "9:20:00", newline="\r\n")
+        + make_clipping("Title 3", "10-12", "9:30:00", newline="\r\n")
+        # still being written
+        + "Title 4 (Horowitz, Ben)\r\n",
+        encoding="utf-8",
+    )
+
+    # When
+    merged = MergedClippings([str(first), str(second)])
+    clippings = [lines for lines, _ in merged]
+
+    # Then
+    assert [(lines[0], lines[1].split(" | ")[1]) for lines in clippings] == [
+        ("Title 1 (Horowitz, Ben)", "Location 10-12"),
+        ("Title 1 (Horowitz, Ben)", "Location 20-22"),
+        ("Title 2 (Horowitz, Ben)", "Location 10-12"),
+        ("Title 3 (Horowitz, Ben)", "Location 10-12"),
+        ("Title 1 (Horowitz, Ben)", "Location 30-32"),
+    ]
+    assert clippings[0][3] == "Highlight of Title 1 at 10-12."
+    assert merged.duplicates == 1
+    assert merged.end_offsets[str(second)] < second.stat().st_size
+
+
+def test_merged_clippings_should_yield_the_same_clippings_when_iterated_again(
+    tmp_path,
+):
+    # Given
+    clippings_file = tmp_path / "clippings.txt"
+    clippings_file.write_text(
+        make_clipping("Title 1", "10-12", "9:00:00", newline="\r\n")
+        + make_clipping("Title 2", "10-12", "9:20:00", newline="\r\n"),
+        encoding="utf-8",
+    )
+    merged = MergedClippings([str(clippings_file)])
+    first = list(merged)
+    end_offsets = dict(merged.end_offsets)
+
+    # When
+    with open(clippings_file, "a", encoding="utf-8") as f:
+        f.write(make_clipping("Title 3", "10-12", "9:30:00", newline="\r\n"))
+    second = list(merged)
+
+    # Then
+    assert second == first
+    assert merged.end_offsets == end_offsets
+    assert merged.clippings == 2
+
+
+def test_sync_should_only_parse_books_with_clippings_past_each_files_checkpoint(
+    tmp_path,
+):
+    # Given
+    first = tmp_path / "first.txt"
+    second = tmp_path / "second.txt"
+    first.write_text(
+        make_clipping("Title 1", "10-12", "9:00:00", newline="\r\n")
+        + make_clipping("Title 2", "10-12", "9:20:00", newline="\r\n"),
+        encoding="utf-8",
+    )
+    second.write_text(
+        make_clipping("Title 3", "10-12", "9:30:00", newline="\r\n"), encoding="utf-8"
+    )
+    files = [str(first), str(second)]
+    state_path = str(tmp_path / "state.json")
+
+    def sync():
+        exporter = RecordingExporter()
+        sync_clippings_file(
+            files,
+            exporter,
+            kindle_root=None,
+            clippings_state=ClippingsState(state_path),
+        )
+        return exporter.written
+
+    # When
+    initial = sync()
+    unchanged = sync()
+    with open(second, "a", encoding="utf-8") as f:
+        f.write(make_clipping("Title 1", "20-22", "9:50:00", newline="\r\n"))
+    appended = sync()
+    first.write_text(
+        make_clipping("Title 2", "10-12", "9:20:00", newline="\r\n"), encoding="utf-8"
+    )
+    replaced = sync()
+
+    # Then
+    assert sorted(initial) == ["Title 1", "Title 2", "Title 3"]
+    assert unchanged == {}
+    # the book is written with the clippings of both files
+    assert appended == {"Title 1": [(10, 12), (20, 22)]}
+    assert replaced == {"Title 2": [(10, 12)]}
@@ -0,0 +1,160 @@
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pytest
+from helpers import make_clipping
+
+from kindle2notion import parsing
+from kindle2notion.exporters import Exporter
+from kindle2notion.filtering import BookFilter, parse_since
+from kindle2notion.parsing import iter_complete_books, parse_raw_clippings_text
+from kindle2notion.pipeline import sync_clippings_file
+from kindle2notion.reading import read_raw_clippings
+
+TEST_CLIPPINGS_FILE = str(
+    Path(__file__).parent.absolute() / "test_data/Test Clippings.txt"
+)
+
+
+class RecordingExporter(Exporter):
+    concurrent = True
+
+    def __init__(self, fail_on=None):
+        self.fail_on = fail_on
+        self.prepared = []
+        self.written = []
+        self.closed_failed = None
+
+    def prepare_book(self, book):
+        self.prepared.append(book.title)
+
+    def write_book(self, book, load_heading_info):
+        if book.title == self.fail_on:
+            raise RuntimeError("boom")
+        headings, indices = load_heading_info()
+        assert headings == [] and len(indices) == len(book.highlights)
+        self.written.append(book.title)
+        return "written"
+
+    def close(self, failed=False):
+        self.closed_failed = failed
+
+
+def test_iter_complete_books_should_yield_books_once_their_last_clipping_is_parsed():
+    # Given
+    raw_clippings_text = (
+        make_clipping("Title 1", "10-12")
+        + make_clipping("Title 2", "10-12")
+        + make_clipping("Title 1", "20-22")
+        + make_clipping("Title 3", "10-12")
+    )
+
+    # When
+    actual = list(iter_complete_books(raw_clippings_text))
+
+    # Then
+    assert [book.title for book in actual] == ["Title 2", "Title 1", "Title 3"]
+    assert len(actual[1].highlights) == 2
+
+
+def test_iter_complete_books_should_match_parse_raw_clippings_text():
+    # Given
+    raw_clippings_text = read_raw_clippings(TEST_CLIPPINGS_FILE)
+
+    # When
+    actual = {book.title: book for book in iter_complete_books(raw_clippings_text)}
+
+    # Then
+    assert actual == parse_raw_clippings_text(raw_clippings_text)
+
+
+def test_sync_clippings_file_should_prepare_and_write_every_book():
+    # Given
+    exporter = RecordingExporter()
+
+    # When
+    written = sync_clippings_file(TEST_CLIPPINGS_FILE, exporter, kindle_root=None)
+
+    # Then
+    assert written == 3
+    assert sorted(exporter.written) == sorted(exporter.prepared)
+    assert exporter.closed_failed is False
+
+
+def test_sync_clippings_file_should_not_enrich_books_the_exporter_has_written():
+    # Given
+    exporter = RecordingExporter()
+    exporter.needs_writing = lambda book: book.title != "Title 2 Is Good Too"
+
+    # When
+    written = sync_clippings_file(TEST_CLIPPINGS_FILE, exporter, kindle_root=None)
+
+    # Then
+    assert written == 2
+    assert "Title 2 Is Good Too" not in exporter.prepared + exporter.written
+
+
+def test_sync_clippings_file_should_stop_and_raise_on_the_first_failure():
+    # Given
+    exporter = RecordingExporter(fail_on="Title 2 Is Good Too")
+
+    # When
+    with pytest.raises(RuntimeError, match="boom"):
+        sync_clippings_file(TEST_CLIPPINGS_FILE, exporter, kindle_root=None)
+
+    # Then
+    assert exporter.closed_failed is True
+
+
+def test_iter_complete_books_should_only_parse_books_the_filter_selects(monkeypatch):
+    # Given
+    raw_clippings_text = read_raw_clippings(TEST_CLIPPINGS_FILE)
+    parsed = []
+    original = parsing._parse_highlight
+    monkeypatch.setattr(
+        parsing,
+        "_parse_highlight",
+        lambda raw, edition=None: parsed.append(raw[0]) or original(raw, edition),
+    )
+
+    # When
+    by_date = list(
+        iter_complete_books(
+            raw_clippings_text, book_filter=BookFilter(since=datetime(2021, 5, 1))
+        )
+    )
+    by_author = list(
+        iter_complete_books(
+            raw_clippings_text, book_filter=BookFilter(author="colin b*")
+        )
+    )
+    by_title = list(
+        iter_complete_books(raw_clippings_text, book_filter=BookFilter(book="GREAT"))
+    )
+
+    # Then
+    assert [book.title for book in by_date] == [
+        "Title 3 Is Clean (Robert C. Martin Series)"
+    ]
+    assert [book.title for book in by_author] == ["Title 2 Is Good Too"]
+    assert [book.title for book in by_title] == ["Title 1: A Great Book"]
+    assert len(parsed) == 6
+
+
+def test_book_filter_should_compare_a_since_with_an_offset_in_local_time():
+    # Given
+    raw_clippings_text = read_raw_clippings(TEST_CLIPPINGS_FILE)
+
+    # When
+    since = parse_since("2021-05-10T00:00:00+00:00")
+    books = list(
+        iter_complete_books(raw_clippings_text, book_filter=BookFilter(since=since))
+    )
+
+    # Then
+    assert since == datetime(2021, 5, 10, tzinfo=timezone.utc).astimezone().replace(
+        tzinfo=None
+    )
+    assert [book.title for book in books] == [
+        "Title 3 Is Clean (Robert C. Martin Series)"
+    ]
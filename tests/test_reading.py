@@ -1,6 +1,17 @@
+import re
+import struct
+import tempfile
 from pathlib import Path
 
-from kindle2notion.reading import read_raw_clippings
+from kindle2notion import models
+from kindle2notion.reading import (
+    BookText,
+    MobiHandler,
+    MobiText,
+    iter_nav_entries,
+    iter_ncx_entries,
+    read_raw_clippings,
+)
 
 
 def test_read_raw_clippings_should_return_all_clippings_data_as_string():
@@ -45,3 +56,327 @@ This is test highlight 6.
 
     # Then
     assert expected == actual
+
+
+def test_build_toc_positions_for_html_should_resolve_anchors_in_every_book_file(
+    tmp_path,
+):
+    # Given
+    text_dir = tmp_path / "mobi8" / "OEBPS"
+    text_dir.mkdir(parents=True)
+    first_part = '<html><h1 id="c1">One</h1><p>text</p></html>'
+    second_part = "<html><h1 name='c2'>Two</h1><p>more</p></html>"
+    (text_dir / "part0000.xhtml").write_text(first_part)
+    (text_dir / "part0001.xhtml").write_text(second_part)
+    (text_dir / "content.opf").write_text(
+        '<package xmlns="http://www.idpf.org/2007/opf"><manifest>'
+        '<item id="p0" href="part0000.xhtml"/><item id="p1" href="part0001.xhtml"/>'
+        '</manifest><spine><itemref idref="p0"/><itemref idref="p1"/></spine></package>'
+    )
+    handler = MobiHandler("book.azw3")
+    handler.html_dir = str(tmp_path)
+    handler.html_file_path = str(tmp_path / "mobi8" / "book.epub")
+    handler.toc_dir = str(text_dir)
+    handler.toc_entries = [
+        models.BookHeading(title="One", href="part0000.xhtml#c1"),
+        models.BookHeading(title="Two", href="part0001.xhtml#c2"),
+        models.BookHeading(title="Missing", href="part0001.xhtml#c3"),
+    ]
+
+    # When
+    handler.build_toc_positions_for_html()
+
+    # Then
+    assert [e.position for e in handler.toc_entries] == [
+        first_part.index('id="c1"'),
+        len(first_part) + second_part.index("name='c2'"),
+        -1,
+    ]
+    assert handler.get_book_text().text == "One text Two more"
+
+
+def test_iter_ncx_entries_should_stream_nested_nav_points_with_their_depth(tmp_path):
+    # Given
+    ncx_path = tmp_path / "toc.ncx"
+    ncx_path.write_text(
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+        "<docTitle><text>The Book</text></docTitle><navMap>"
+        '<navPoint id="n1"><navLabel><text>Part One</text></navLabel>'
+        '<content src="book.html#filepos10"/>'
+        '<navPoint id="n2"><navLabel><text>Chapter 1</text></navLabel>'
+        '<content src="book.html#filepos20"/></navPoint>'
+        "</navPoint>"
+        '<navPoint id="n3"><navLabel><text>Part Two</text></navLabel>'
+        '<content src="book.html#filepos30"/></navPoint>'
+        "</navMap></ncx>"
+    )
+
+    # When
+    actual = list(iter_ncx_entries(str(ncx_path)))
+
+    # Then
+    assert actual == [
+        models.BookHeading(title="Part One", href="book.html#filepos10", depth=0),
+        models.BookHeading(title="Chapter 1", href="book.html#filepos20", depth=1),
+        models.BookHeading(title="Part Two", href="book.html#filepos30", depth=0),
+    ]
+
+
+def test_iter_nav_entries_should_read_the_toc_of_an_epub3_nav_document(tmp_path):
+    # Given
+    nav_path = tmp_path / "nav.xhtml"
+    nav_path.write_text(
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">'
+        '<body><nav epub:type="landmarks"><ol><li><a href="part0000.xhtml">Cover</a></li></ol></nav>'
+        '<nav epub:type="toc"><ol>'
+        '<li><a href="part0000.xhtml#c1">Chapter <b>1</b></a>'
+        '<ol><li><a href="part0000.xhtml#s1">Section</a></li></ol></li>'
+        '<li><a href="part0001.xhtml">Chapter 2</a></li>'
+        "</ol></nav></body></html>"
+    )
+
+    # When
+    actual = list(iter_nav_entries(str(nav_path)))
+
+    # Then
+    assert actual == [
+        models.BookHeading(title="Chapter 1", href="part0000.xhtml#c1", depth=0),
+        models.BookHeading(title="Section", href="part0000.xhtml#s1", depth=1),
+        models.BookHeading(title="Chapter 2", href="part0001.xhtml", depth=0),
+    ]
+
+
+def test_book_text_should_strip_markup_and_map_text_offsets_back_to_the_html(
+    tmp_path,
+):
+    # Given
+    html_path = tmp_path / "book.html"
+    html = (
+        "<html><body><p>Winston, who didn&#8217;t care,\n   made for</p>"
+        "<p>the <i>stairs</i>.</p></body></html>"
+    )
+    html_path.write_text(html)
+
+    # When
+    book_text = BookText([str(html_path)])
+
+    # Then
+    assert book_text.text == "Winston, who didn’t care, made for the stairs."
+    assert book_text.html_offset(book_text.text.index("Winston")) == html.index(
+        "Winston"
+    )
+    assert book_text.html_offset(book_text.text.index("stairs")) == html.index("stairs")
+    book_text.close()
+
+
+def _palmdoc_file(path, text):
+    # PalmDB header, a one entry record list, the PalmDOC header and the text
+    record0 = struct.pack(">HHLHHHH", 1, 0, len(text), 1, 4096, 0, 0)
+    header = b"Book".ljust(60, b"\0") + b"TEXtREAd" + b"\0" * 8 + struct.pack(">H", 2)
+    start = len(header) + 2 * 8 + 2
+    records = struct.pack(">LLLL", start, 0, start + len(record0), 1)
+    path.write_bytes(header + records + b"\0\0" + record0 + text)
+
+
+def test_extract_in_memory_should_decompress_the_text_without_unpacking(
+    tmp_path, monkeypatch
+):
+    # Given
+    book_path = tmp_path / "book.mobi"
+    _palmdoc_file(book_path, b"<html><h1>One</h1><p>text</p></html>")
+
+    def fail(*args, **kwargs):
+        raise AssertionError("nothing should be unpacked to disk")
+
+    monkeypatch.setattr(tempfile, "mkdtemp", fail)
+    handler = MobiHandler(str(book_path))
+
+    # When
+    extracted = handler.extract_in_memory()
+
+    # Then
+    assert extracted
+    assert handler.book_files() == ["book.html"]
+    assert handler.get_book_text().text == "One text"
+
+
+def test_build_toc_positions_for_html_should_resolve_in_memory_anchors():
+    # Given
+    first_part = b"<html><h1>One</h1><p>text</p></html>"
+    second_part = b"<html><h1>Two</h1><p>more</p></html>"
+    handler = MobiHandler("book.azw3")
+    handler.mobi_text = MobiText(
+        parts={"part0000.xhtml": first_part, "part0001.xhtml": second_part},
+        anchors={"part0000.xhtml": {"filepos6": 6}, "part0001.xhtml": {"filepos6": 6}},
+        toc_entries=[
+            models.BookHeading(title="One", href="part0000.xhtml#filepos6"),
+            models.BookHeading(title="Two", href="part0001.xhtml#filepos6"),
+        ],
+    )
+    handler.html_file_path = "part0000.xhtml"
+    handler.toc_dir = ""
+
+    # When
+    handler.parse_toc_ncx()
+    handler.build_toc_positions_for_html()
+
+    # Then
+    assert [e.position for e in handler.toc_entries] == [6, len(first_part) + 6]
+    assert handler.get_book_text().text == "One text Two more"
+
+
+def _vwi(value):
+    # Forward encoded, the last byte is flagged
+    out = [value & 0x7F | 0x80]
+    value >>= 7
+    while value:
+        out.append(value & 0x7F)
+        value >>= 7
+    return bytes(reversed(out))
+
+
+def _indx_header(start=0, count=0, total=0, nctoc=0):
+    words = (0xC0, 0, 0, 0, start, count, 65001, 0, total, 0, 0, 0, nctoc)
+    return (b"INDX" + struct.pack(">13L", *words)).ljust(0xC0, b"\0")
+
+
+def _index(tags, entries, cncx=b""):
+    # The main INDX record with the tag table, one data record holding every
+    # (name, {tag: values}) entry, and the CNCX record if there is one
+    tagx = b"TAGX" + struct.pack(">LL", 12 + 4 * (len(tags) + 1), 1)
+    for i, (tag, count) in enumerate(tags):
+        tagx += struct.pack(">BBBB", tag, count, 1 << i, 0)
+    tagx += b"\0\0\0\1"
+    body, offsets = b"", []
+    for name, values in entries:
+        offsets.append(0xC0 + len(body))
+        control = sum(1 << i for i, (tag, _) in enumerate(tags) if tag in values)
+        body += bytes([len(name)]) + name + bytes([control])
+        body += b"".join(_vwi(v) for tag, _ in tags for v in values.get(tag, ()))
+    idxt = b"IDXT" + b"".join(struct.pack(">H", o) for o in offsets)
+    main = _indx_header(count=1, total=len(entries), nctoc=1 if cncx else 0) + tagx
+    data = _indx_header(start=0xC0 + len(body), count=len(entries)) + body + idxt
+    return [main, data] + ([cncx] if cncx else [])
+
+
+def _cncx(strings):
+    # Strings of an index, each prefixed by its length
+    data, offsets = b"", []
+    for s in strings:
+        offsets.append(len(data))
+        data += _vwi(len(s)) + s
+    return data, offsets
+
+
+def _kf8_file(path, bodies, toc):
+    """
+    Writes a KF8 only book, a part per body. `toc` holds (title, part, offset
+    of the target in the body) entries.
+    """
+    head = b'<?xml version="1.0" encoding="utf-8"?><html><head><title>Book</title></head><body aid="0">'
+    tail = b"</body></html>"
+    text, skeletons, fragments = b"", [], []
+    aids, aid_offsets = _cncx([b"P-//*[@aid='0']"] * len(bodies))
+    for i, body in enumerate(bodies):
+        skel_pos = len(text)
+        text += head + tail + body
+        skeletons.append((b"SKEL%010d" % i, {1: [1], 6: [skel_pos, len(head + tail)]}))
+        fragments.append(
+            (
+                b"%d" % (skel_pos + len(head)),
+                {2: [aid_offsets[i]], 3: [i], 4: [i], 6: [0, len(body)]},
+            )
+        )
+    titles, title_offsets = _cncx([t.encode() for t, _, _ in toc])
+    entries = [
+        (b"%d" % n, {3: [title_offsets[n]], 4: [0], 6: [part, offset]})
+        for n, (_, part, offset) in enumerate(toc)
+    ]
+    text_records = [text[i : i + 4096] for i in range(0, len(text), 4096)]
+    first_index = 1 + len(text_records)
+    indexes = (
+        _index([(1, 1), (6, 2)], skeletons)
+        + _index([(2, 1), (3, 1), (4, 1), (6, 2)], fragments, aids)
+        + _index([(3, 1), (4, 1), (6, 2)], entries, titles)
+    )
+
+    # Record 0, the PalmDOC header and a version 8 MOBI header pointing at the
+    # skeleton, fragment and NCX indexes, without EXTH, FDST or resources
+    title = b"Book"
+    mobi = bytearray(0x108)
+    struct.pack_into(
+        ">HHLHHHH", mobi, 0, 1, 0, len(text), len(text_records), 4096, 0, 0
+    )
+    mobi[0x10:0x14] = b"MOBI"
+    struct.pack_into(">LLLLL", mobi, 0x14, len(mobi) - 16, 2, 65001, 1, 8)
+    mobi[0x28:0x50] = b"\xff" * 0x28
+    struct.pack_into(">LLL", mobi, 0x50, first_index, len(mobi), len(title))
+    struct.pack_into(">LL", mobi, 0x68, 8, len(text_records) + len(indexes) + 1)
+    mobi[0xC0:0xC8] = b"\xff\xff\xff\xff\0\0\0\0"
+    struct.pack_into(">L", mobi, 0xF4, first_index + 5)
+    struct.pack_into(">L", mobi, 0xF8, first_index + 2)
+    struct.pack_into(">L", mobi, 0xFC, first_index)
+    struct.pack_into(">L", mobi, 0x104, 0xFFFFFFFF)
+    records = (
+        [bytes(mobi) + title + b"\0\0"] + text_records + indexes + [b"\xe9\x8e\r\n"]
+    )
+
+    header = b"Book".ljust(60, b"\0") + b"BOOKMOBI" + b"\0" * 8
+    header += struct.pack(">H", len(records))
+    offset = len(header) + 8 * len(records) + 2
+    for n, record in enumerate(records):
+        header += struct.pack(">LL", offset, n)
+        offset += len(record)
+    path.write_bytes(header + b"\0\0" + b"".join(records))
+
+
+def test_extract_in_memory_should_resolve_kf8_toc_entries_like_extract_to_html(
+    tmp_path,
+):
+    # Given
+    book_path = tmp_path / "book.azw3"
+    first_body = (
+        b'<h1 id="c1">Chapter One</h1><p>It was a bright cold day.</p>'
+        b'<h2 id="s1">Section</h2><p>The clocks were striking.</p>'
+    )
+    second_body = (
+        b'<p>Intro</p><h1 aid="9">Chapter Two</h1><p>Winston made for the stairs.</p>'
+    )
+    _kf8_file(
+        book_path,
+        [first_body, second_body],
+        [
+            ("Chapter One", 0, 0),
+            ("Section", 0, first_body.index(b"<h2")),
+            ("Chapter Two", 1, second_body.index(b"<h1")),
+        ],
+    )
+
+    def headings(extract):
+        handler = MobiHandler(str(book_path))
+        extract(handler)
+        handler.parse_toc_ncx()
+        handler.build_toc_positions_for_html()
+        contents = handler.mobi_text.parts if handler.mobi_text else {}
+        html = b"".join(
+            contents[path] if path in contents else Path(path).read_bytes()
+            for path in handler.book_files()
+        )
+        # The text each heading points at, from inside its tag or before it
+        return [
+            (e.title, re.sub(rb"^[^<]*>|<[^>]*>", b" ", html[e.position :]).split()[:4])
+            for e in handler.toc_entries
+        ]
+
+    # When
+    in_memory = headings(lambda handler: handler.extract_in_memory())
+    on_disk = headings(lambda handler: handler.extract_to_html())
+
+    # Then
+    assert in_memory == on_disk
+    assert [words for _, words in in_memory] == [
+        [b"Chapter", b"One", b"It", b"was"],
+        [b"Section", b"The", b"clocks", b"were"],
+        [b"Chapter", b"Two", b"Winston", b"made"],
+    ]
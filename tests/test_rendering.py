@@ -0,0 +1,182 @@
+import json
+import uuid
+from datetime import datetime
+
+import httpx
+import notional
+import pytest
+from helpers import make_book
+from notion_client.client import BaseClient
+from notion_client.errors import APIResponseError, HTTPResponseError
+from notional.blocks import Page
+
+from kindle2notion import exporting
+from kindle2notion.exporting import _page_batches, _write_to_page
+from kindle2notion.models import BookHeading
+from kindle2notion.rendering import send
+
+DATABASE_ID = "a8aec43384f447ed84390e8e42c2e089"
+
+
+def _book():
+    texts = [
+        'A "quoted" highlight with a backslash \\ and a tab\t.',
+        "Ünïcödé, emoji 📚 and a line\nbreak.",
+        "x" * 4500,
+    ]
+    book = make_book(texts=texts * 70)
+    for i, highlight in enumerate(book.highlights):
+        highlight.page = i
+        highlight.is_note = i == 1
+    return book
+
+
+def _recording_session(bodies):
+    def handle(request):
+        bodies.append(request.content)
+        if request.url.path.endswith("/children"):
+            children = json.loads(request.content)["children"]
+            results = [{**child, "id": str(uuid.uuid4())} for child in children]
+            return httpx.Response(200, json={"object": "list", "results": results})
+        return httpx.Response(200, json={"object": "page", "id": DATABASE_ID})
+
+    client = httpx.Client(transport=httpx.MockTransport(handle))
+    return notional.connect(auth="token", client=client)
+
+
+def _sync(monkeypatch, raw_payloads, separate_blocks):
+    monkeypatch.setattr(
+        exporting, "_get_book_cover_uri", lambda title, author: "https://cover"
+    )
+    monkeypatch.setattr(
+        exporting, "datetime", type("Fixed", (), {"now": lambda: datetime(2024, 1, 1)})
+    )
+    bodies = []
+    notion = _recording_session(bodies)
+    book = _book()
+    headings = [BookHeading(title="Chapter 1", href="#c1")]
+    batches = _page_batches(
+        book,
+        (headings, [None] + [0] * (len(book.highlights) - 1)),
+        separate_blocks,
+        True,
+        True,
+        raw_payloads=raw_payloads,
+    )
+    page = exporting._create_page(
+        notion,
+        book,
+        DATABASE_ID,
+        True,
+        separate_blocks,
+        True,
+        True,
+        children=batches[0],
+    )
+    ids = []
+    _write_to_page(
+        notion,
+        page,
+        batches,
+        skip_batches=1,
+        on_batch=lambda batch: ids.append(batch[-1].id is not None),
+    )
+    return bodies, ids
+
+
+def test_raw_payloads_should_send_the_same_bytes_as_the_models(monkeypatch):
+    for separate_blocks in (True, False):
+        # Given
+        model_bodies, model_ids = _sync(monkeypatch, False, separate_blocks)
+
+        # When
+        raw_bodies, raw_ids = _sync(monkeypatch, True, separate_blocks)
+
+        # Then
+        assert len(raw_bodies) == (3 if separate_blocks else 1)
+        assert raw_bodies == model_bodies
+        assert raw_ids == model_ids == [True] * (len(raw_bodies) - 1)
+
+
+def test_create_page_should_return_the_created_page(monkeypatch):
+    # Given
+    monkeypatch.setattr(
+        exporting, "_get_book_cover_uri", lambda title, author: "https://cover"
+    )
+    notion = _recording_session([])
+    book = _book()
+
+    # When
+    page = exporting._create_page(
+        notion,
+        book,
+        DATABASE_ID,
+        True,
+        True,
+        True,
+        True,
+        children=_page_batches(book, ([], [None] * 210), True, True, True)[0],
+    )
+
+    # Then
+    assert isinstance(page, Page)
+    assert page.id.hex == DATABASE_ID
+
+
+def test_send_should_raise_errors_like_any_other_request(monkeypatch):
+    # Given
+    def handle(request):
+        return httpx.Response(
+            400, json={"code": "validation_error", "message": "Invalid body"}
+        )
+
+    client = httpx.Client(transport=httpx.MockTransport(handle))
+    notion = notional.connect(auth="token", client=client)
+
+    # When / Then
+    with pytest.raises(APIResponseError, match="Invalid body"):
+        send(notion, "PATCH", "blocks/x/children", "{}")
+    monkeypatch.delattr(BaseClient, "_parse_response")
+    with pytest.raises(HTTPResponseError):
+        send(notion, "PATCH", "blocks/x/children", "{}")
+
+
+def test_write_chapters_should_fill_every_chapter_under_its_own_toggle():
+    # Given
+    bodies = []
+    appends = {}
+
+    def handle(request):
+        bodies.append(request.content)
+        children = json.loads(request.content)["children"]
+        results = [{**child, "id": str(uuid.uuid4())} for child in children]
+        appends.setdefault(request.url.path.split("/")[-2], []).append(results)
+        return httpx.Response(200, json={"object": "list", "results": results})
+
+    notion = notional.connect(
+        auth="token", client=httpx.Client(transport=httpx.MockTransport(handle))
+    )
+    page = Page.parse_obj({"object": "page", "id": DATABASE_ID})
+    book = _book()
+    headings = [BookHeading(title=f"Chapter {i}", href=f"#c{i}") for i in range(3)]
+    # One highlight before the first chapter, then 3 chapters of 40, 100 and 69
+    heading_indices = [None] + [0] * 40 + [1] * 100 + [2] * 69
+
+    # When
+    intro, chapters = exporting._chapter_batches(
+        book, (headings, heading_indices), True, True, True
+    )
+    exporting._write_chapters(
+        notion, page, "toggles", intro, chapters, chapter_workers=3
+    )
+
+    # Then
+    assert [title for title, _ in chapters] == ["Chapter 0", "Chapter 1", "Chapter 2"]
+    page_appends = appends.pop(str(page.id))
+    assert [len(results) for results in page_appends] == [1, 3]
+    toggles = page_appends[1]
+    assert [toggle["type"] for toggle in toggles] == ["toggle"] * 3
+    assert [
+        sum(len(results) for results in appends[toggle["id"]]) for toggle in toggles
+    ] == [40, 100, 69]
+    assert len(bodies) == 2 + 3
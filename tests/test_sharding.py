@@ -0,0 +1,135 @@
+import json
+import os
+import time
+from pathlib import Path
+
+from kindle2notion.exporters import Exporter
+from kindle2notion.models import Book
+from kindle2notion.sharding import (
+    SUMMARY_FILE_NAME,
+    ShardCoordinator,
+    ShardExporter,
+    sync_shard,
+)
+
+TEST_CLIPPINGS_FILE = str(
+    Path(__file__).parent.absolute() / "test_data/Test Clippings.txt"
+)
+
+
+class RecordingExporter(Exporter):
+    def __init__(self):
+        self.written = []
+
+    def write_book(self, book, load_heading_info):
+        self.written.append(book.title)
+        return "written"
+
+
+def test_sync_shard_should_write_every_book_once_and_merge_the_summaries(tmp_path):
+    # Given
+    exporters = [RecordingExporter(), RecordingExporter()]
+    coordinators = [
+        ShardCoordinator(str(tmp_path), shard_index, 2, worker=f"w{shard_index}")
+        for shard_index in range(2)
+    ]
+
+    # When
+    first = sync_shard(
+        TEST_CLIPPINGS_FILE, exporters[0], coordinators[0], kindle_root=None
+    )
+    merged_after_first = os.path.exists(tmp_path / SUMMARY_FILE_NAME)
+    second = sync_shard(
+        TEST_CLIPPINGS_FILE, exporters[1], coordinators[1], kindle_root=None
+    )
+
+    # Then
+    written = exporters[0].written + exporters[1].written
+    assert sorted(written) == sorted(set(written)) and len(written) == 3
+    assert first.ok and second.ok
+    assert not merged_after_first
+    merged = json.loads((tmp_path / SUMMARY_FILE_NAME).read_text())
+    assert merged["books_written"] == 3 and merged["books_assigned"] == 3
+    assert merged["failed_shards"] == []
+    assert os.listdir(tmp_path / "leases") == []
+
+
+def test_shard_coordinator_should_only_break_stale_leases(tmp_path):
+    # Given
+    first = ShardCoordinator(str(tmp_path), 0, 2, lease_seconds=60, worker="w0")
+    second = ShardCoordinator(str(tmp_path), 1, 2, lease_seconds=60, worker="w1")
+
+    # When
+    acquired = first.acquire("book")
+    held = second.acquire("book")
+    stale = time.time() - 120
+    os.utime(tmp_path / "leases" / "book", (stale, stale))
+    taken_over = second.acquire("book")
+
+    # Then
+    assert acquired and not held and taken_over
+    assert json.loads((tmp_path / "leases" / "book").read_text())["worker"] == "w1"
+
+
+def test_shard_coordinator_should_renew_the_lease_while_a_book_is_written(
+    tmp_path,
+):
+    # Given
+    first = ShardCoordinator(str(tmp_path), 0, 2, lease_seconds=0.4, worker="w0")
+    second = ShardCoordinator(str(tmp_path), 1, 2, lease_seconds=0.4, worker="w1")
+    first.acquire("book")
+
+    # When
+    with first.hold("book"):
+        time.sleep(0.6)
+        taken_over = second.acquire("book")
+
+    # Then
+    assert not taken_over
+
+
+def test_shard_coordinator_should_not_merge_the_summaries_of_another_run(tmp_path):
+    # Given
+    for shard_index in range(2):
+        sync_shard(
+            TEST_CLIPPINGS_FILE,
+            RecordingExporter(),
+            ShardCoordinator(str(tmp_path), shard_index, 2, run_id="run-1"),
+            kindle_root=None,
+        )
+    os.unlink(tmp_path / SUMMARY_FILE_NAME)
+
+    # When
+    sync_shard(
+        TEST_CLIPPINGS_FILE,
+        RecordingExporter(),
+        ShardCoordinator(str(tmp_path), 0, 2, run_id="run-2"),
+        kindle_root=None,
+    )
+
+    # Then
+    assert not os.path.exists(tmp_path / SUMMARY_FILE_NAME)
+
+
+def test_shard_exporter_should_not_rewrite_a_book_written_earlier_in_the_run(
+    tmp_path,
+):
+    # Given
+    book = Book(title="Title 1", author="Author", highlights=[])
+    # Two workers of the same run that both found the book had to be written
+    exporters = [
+        ShardExporter(
+            RecordingExporter(),
+            ShardCoordinator(str(tmp_path), i, 2, worker=f"w{i}", run_id="run-1"),
+        )
+        for i in range(2)
+    ]
+
+    # When
+    messages = [exporter.write_book(book, lambda: ([], [])) for exporter in exporters]
+
+    # Then
+    assert messages == ["written", None]
+    assert exporters[1].exporter.written == []
+    assert exporters[1].summary.books_leased_elsewhere == 1
+    assert os.listdir(tmp_path / "leases") == []
@@ -0,0 +1,68 @@
+from helpers import make_clipping
+
+from kindle2notion.reading import read_new_clippings
+from kindle2notion.watching import ClippingsLibrary
+
+
+def test_read_new_clippings_should_leave_an_incomplete_clipping_for_the_next_read(
+    tmp_path,
+):
+    # Given
+    clippings_file = tmp_path / "My Clippings.txt"
+    complete = make_clipping("Title 1", "111-114", text="This is test highlight 1.")
+    clippings_file.write_text(complete + "Title 1 (Horowitz, Ben)\n- Your Hig")
+
+    # When
+    text, offset = read_new_clippings(str(clippings_file), 0)
+    rest, rest_offset = read_new_clippings(str(clippings_file), offset)
+
+    # Then
+    assert text == complete
+    assert offset == len(complete)
+    assert rest == ""
+    assert rest_offset == offset
+
+
+def test_clippings_library_should_only_report_books_changed_since_the_last_sync(
+    tmp_path,
+):
+    # Given
+    clippings_file = tmp_path / "My Clippings.txt"
+    clippings_file.write_text(
+        make_clipping("Title 1", "111-114", text="This is test highlight 1.")
+        + make_clipping("Title 2", "184-185", text="This is test highlight 2.")
+    )
+    library = ClippingsLibrary(str(clippings_file))
+    library.refresh()
+    library.mark_synced(library.changed_books())
+
+    # When
+    with open(clippings_file, "a") as f:
+        f.write(make_clipping("Title 2", "682-684", text="This is test highlight 3."))
+    library.refresh()
+    actual = library.changed_books()
+
+    # Then
+    assert list(actual) == ["Title 2"]
+    assert [h.text for h in actual["Title 2"].highlights] == [
+        "This is test highlight 2.",
+        "This is test highlight 3.",
+    ]
+
+
+def test_clippings_library_should_rebuild_when_the_file_is_truncated(tmp_path):
+    # Given
+    clippings_file = tmp_path / "My Clippings.txt"
+    clippings_file.write_text(
+        make_clipping("Title 1", "111-114", text="This is test highlight 1.")
+        + make_clipping("Title 1", "115-116", text="This is test highlight 2.")
+    )
+    library = ClippingsLibrary(str(clippings_file))
+    library.refresh()
+
+    # When
+    clippings_file.write_text(make_clipping("Title 1", "111-114", text="Rewritten."))
+    library.refresh()
+
+    # Then
+    assert [h.text for h in library.books["Title 1"].highlights] == ["Rewritten."]